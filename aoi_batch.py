@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Description: Batch mode for many small AOIs (e.g. mine sites or pastoral leases) in one run.
+             The AOIs are read from a GeoPackage or GeoJSON, one search covers all of them,
+             and each product found is matched to the AOIs it overlaps with an STRtree spatial
+             index. Every product is then downloaded and processed once, whatever the number
+             of AOIs it serves, and its output is clipped to each of them.
+"""
+import json
+import logging
+import re
+from pathlib import Path
+
+from shapely import wkt
+from shapely.geometry import mapping, shape
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+
+from footprint_filter import product_footprint
+
+log = logging.getLogger(__name__)
+
+
+def safe_aoi_id(value):
+    """An AOI id usable as a directory name"""
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip("_") or "aoi"
+
+
+def load_aois(path, id_field=None):
+    """
+    Reads the AOIs of a batch run
+
+    Parameters
+    ----------
+    path : str
+        A GeoJSON, GeoPackage (or any other vector file GDAL's ogr reads), in lon/lat
+    id_field : str, optional
+        The attribute naming each AOI. Defaults to the feature's position in the file.
+
+    Returns
+    -------
+    dict
+        {aoi id: shapely geometry}, in file order
+    """
+    path = Path(path).expanduser()
+    features = []
+    if path.suffix.lower() in (".geojson", ".json"):
+        with open(path, "r") as f:
+            data = json.load(f)
+        for num, feature in enumerate(data.get("features", [data])):
+            properties = feature.get("properties") or {}
+            aoi_id = properties.get(id_field, num) if id_field else num
+            features.append((aoi_id, shape(feature["geometry"])))
+    else:
+        from osgeo import ogr
+
+        data_source = ogr.Open(path.as_posix())
+        if data_source is None:
+            raise ValueError(f"Unable to read the AOI file {path}")
+        layer = data_source.GetLayer()
+        for num, feature in enumerate(layer):
+            aoi_id = feature.GetField(id_field) if id_field else num
+            features.append((aoi_id, wkt.loads(feature.GetGeometryRef().ExportToWkt())))
+        data_source = None
+
+    aois = {}
+    for aoi_id, geometry in features:
+        aoi_id = safe_aoi_id(aoi_id)
+        if aoi_id in aois:
+            # Features sharing an id are treated as one AOI
+            geometry = aois[aoi_id].union(geometry)
+        aois[aoi_id] = geometry
+    log.info(f"Read {len(aois)} AOIs from {path}")
+    return aois
+
+
+def union_search_geom(aois):
+    """The {"lonmin", "latmin", "lonmax", "latmax"} box around every AOI, to search with"""
+    lonmin, latmin, lonmax, latmax = unary_union(list(aois.values())).bounds
+    return {"lonmin": lonmin, "latmin": latmin, "lonmax": lonmax, "latmax": latmax}
+
+
+def write_cutlines(aois, directory):
+    """
+    Writes each AOI to its own GeoJSON, for clipping outputs with gdal.Warp
+
+    Returns
+    -------
+    dict
+        {aoi id: path of its GeoJSON}
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for aoi_id, geometry in aois.items():
+        path = directory / f"{aoi_id}.geojson"
+        feature = {
+            "type": "Feature",
+            "properties": {"aoi_id": aoi_id},
+            "geometry": mapping(geometry),
+        }
+        with open(path, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": [feature]}, f)
+        paths[aoi_id] = path.as_posix()
+    return paths
+
+
+class AoiMatcher:
+    """
+    Matches products to the AOIs their footprint overlaps, through an STRtree of the AOIs.
+
+    Parameters
+    ----------
+    aois : dict
+        {aoi id: shapely geometry}, e.g. from load_aois
+    """
+
+    def __init__(self, aois):
+        self.aoi_ids = list(aois)
+        self.geometries = list(aois.values())
+        self.tree = STRtree(self.geometries)
+        # shapely < 2 returns the geometries from a query rather than their positions
+        self._positions = {id(geometry): num for num, geometry in enumerate(self.geometries)}
+        self.served = set()
+        self.matched = 0
+        self.unmatched = 0
+
+    def match(self, footprint):
+        """The ids of the AOIs a footprint overlaps, in AOI file order"""
+        try:
+            positions = self.tree.query(footprint, predicate="intersects")
+        except TypeError:
+            positions = [
+                self._positions[id(geometry)]
+                for geometry in self.tree.query(footprint)
+                if geometry.intersects(footprint)
+            ]
+        return [self.aoi_ids[num] for num in sorted(int(num) for num in positions)]
+
+    def annotate(self, product):
+        """Records the AOIs a product serves in its "aoi_ids" property, and returns it"""
+        footprint = product_footprint(product)
+        if footprint is not None:
+            product.properties["aoi_ids"] = self.match(footprint)
+        return product
+
+    def filter(self, products):
+        """Yields the (annotated) products serving at least one AOI"""
+        for product in products:
+            aoi_ids = product.properties.get("aoi_ids")
+            if aoi_ids is None:
+                # No footprint to match, so it may serve any of them
+                aoi_ids = product.properties["aoi_ids"] = list(self.aoi_ids)
+            if not aoi_ids:
+                self.unmatched += 1
+                log.info(f"Skipping {product.properties['title']}, it serves none of the AOIs")
+                continue
+            self.matched += 1
+            self.served.update(aoi_ids)
+            yield product
+        log.info(
+            f"AOI batch: {self.matched} products serve {len(self.served)} of "
+            f"{len(self.aoi_ids)} AOIs, {self.unmatched} products serve none"
+        )
+        missed = [aoi_id for aoi_id in self.aoi_ids if aoi_id not in self.served]
+        if missed:
+            log.warning(f"No products found for AOIs {missed}")
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Description: Drops redundant search results before they are downloaded: reprocessed versions
+             of the same acquisition (which differ only in the product unique id, the last
+             _XXXX of the title) and the same scene found at more than one provider.
+             Products are grouped by mission, mode, product type, start/stop time and absolute
+             orbit, and one product is kept from each group by a configurable policy.
+"""
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+POLICIES = ("newest", "preferred_provider")
+
+
+def acquisition_key(product):
+    """
+    The acquisition a product is a version of, from its title, e.g.
+    S1A_IW_GRDH_1SDV_20230131T214327_20230131T214352_046992_05A2B5_2F4A gives
+    ("S1A", "IW", "GRDH", "20230131T214327", "20230131T214352", "046992").
+    None if the title is not a Sentinel-1 product name.
+    """
+    parts = product.properties["title"].split("_")
+    if len(parts) < 9:
+        return None
+    mission, mode, product_type = parts[0], parts[1], parts[2]
+    start, stop, orbit = parts[4], parts[5], parts[6]
+    return mission, mode, product_type, start, stop, orbit
+
+
+def product_size(product):
+    """The product's size in bytes if the catalogue gives one, else None"""
+    size = product.properties.get("size") or product.properties.get("productSize")
+    try:
+        return int(size) if size else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Deduplicator:
+    """
+    Keeps one product per acquisition from a stream of search results.
+
+    Products of one acquisition are returned together, by the same search page or shard, so
+    groups are only held for the next `window` products before the best of each is yielded.
+    A product reaches the downloads at most `window` results after it is found, rather than
+    once the whole search has finished.
+
+    Parameters
+    ----------
+    policy : str, optional
+        "newest" keeps the latest processing (by processing baseline, then publication date,
+        then product unique id). "preferred_provider" keeps the product of the first provider
+        in `preferred_providers`, then the newest. Default is "newest".
+    preferred_providers : list of str, optional
+        Providers in order of preference, e.g. ["thredds", "sara"]
+    window : int, optional
+        Number of products a group is held open for. Default is 50.
+    """
+
+    def __init__(self, policy="newest", preferred_providers=None, window=50):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown deduplication policy {policy!r}, use one of {POLICIES}")
+        self.policy = policy
+        self.preferred_providers = [provider.lower() for provider in preferred_providers or []]
+        self.window = max(1, int(window))
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.skipped_unknown_size = 0
+
+    def newest_rank(self, product):
+        properties = product.properties
+        return (
+            str(properties.get("processingBaseline") or ""),
+            str(properties.get("publicationDate") or properties.get("modificationDate") or ""),
+            properties["title"].split("_")[-1],
+        )
+
+    def provider_rank(self, product):
+        provider = str(getattr(product, "provider", "") or "").lower()
+        if provider in self.preferred_providers:
+            return -self.preferred_providers.index(provider)
+        return -len(self.preferred_providers)
+
+    def rank(self, product):
+        """Products with a higher rank are kept"""
+        if self.policy == "preferred_provider":
+            return self.provider_rank(product), self.newest_rank(product)
+        return self.newest_rank(product), self.provider_rank(product)
+
+    def drop(self, product, kept):
+        self.skipped += 1
+        size = product_size(product)
+        if size is None:
+            self.skipped_unknown_size += 1
+        else:
+            self.skipped_bytes += size
+        log.info(f"Skipping {product.properties['title']}, a duplicate of {kept}")
+
+    def filter(self, products):
+        """Yields the products of a search with one product per acquisition, in search order"""
+        groups = OrderedDict()
+        for num, product in enumerate(products):
+            # Products without a Sentinel-1 name are kept, each as its own group
+            key = acquisition_key(product) or product.properties["title"]
+            if key in groups:
+                best, _ = groups[key]
+                if self.rank(product) > self.rank(best):
+                    best, product = product, best
+                self.drop(product, best.properties["title"])
+                groups[key] = (best, groups[key][1])
+            else:
+                groups[key] = (product, num)
+            # Groups opened `window` products ago are taken as complete
+            while groups and next(iter(groups.values()))[1] <= num - self.window:
+                yield groups.popitem(last=False)[1][0]
+        for best, _ in groups.values():
+            yield best
+        self.log()
+
+    def log(self):
+        unknown = ""
+        if self.skipped_unknown_size:
+            unknown = f" ({self.skipped_unknown_size} of unknown size)"
+        log.info(
+            f"Deduplication skipped {self.skipped} redundant products, "
+            f"{self.skipped_bytes / 1e9:.2f} GB{unknown}"
+        )
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Description: A small client for the Docker Engine API, talking to the docker daemon over its unix
+             socket rather than running the docker CLI. Answers that don't change during a run
+             (whether an image exists, whether docker is rootless) are asked once per process,
+             containers are created from structured arguments rather than a shell string, and
+             their logs are streamed straight from the daemon.
+             Only the standard library is used. The socket path is a parameter, so the client can
+             be pointed at a fake server speaking HTTP over a unix socket.
+"""
+import http.client
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+from urllib.parse import quote, urlencode
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class DockerAPIError(Exception):
+    """An error response from the docker daemon"""
+
+    def __init__(self, status, message):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a unix socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def default_socket_path():
+    """
+    The daemon's socket, as the docker CLI finds it: from DOCKER_HOST, otherwise the system
+    socket, or a rootless daemon's socket in XDG_RUNTIME_DIR if there is no system socket
+    """
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://") :]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not os.path.exists(DEFAULT_SOCKET) and runtime_dir:
+        rootless_socket = os.path.join(runtime_dir, "docker.sock")
+        if os.path.exists(rootless_socket):
+            return rootless_socket
+    return DEFAULT_SOCKET
+
+
+def get_client(socket_path=None):
+    """The (shared) client of a socket, by default that of default_socket_path"""
+    socket_path = socket_path or default_socket_path()
+    with _clients_lock:
+        if socket_path not in _clients:
+            _clients[socket_path] = DockerClient(socket_path)
+        return _clients[socket_path]
+
+
+def demultiplex(response):
+    """
+    Yields the payload of each frame of a log stream. Containers without a tty send their
+    stdout and stderr as frames, each with an 8 byte header: the stream, 3 zero bytes, and the
+    payload's size (big endian).
+    """
+    while True:
+        header = response.read(8)
+        if len(header) < 8:
+            return
+        _, size = struct.unpack(">BxxxL", header)
+        payload = response.read(size)
+        if not payload:
+            return
+        yield payload
+
+
+class DockerClient:
+    """
+    A client of the Docker Engine API, over a unix socket
+
+    Parameters
+    ----------
+    socket_path : str, optional
+        The daemon's socket. Default is from default_socket_path.
+    api_version : str, optional
+        The API version asked for, e.g. "1.41". Default is the daemon's own.
+    timeout : float, optional
+        Seconds to wait for a (non streaming) response. Default is 60.
+    """
+
+    def __init__(self, socket_path=None, api_version=None, timeout=60):
+        self.socket_path = socket_path or default_socket_path()
+        self.api_version = api_version
+        self.timeout = timeout
+        self._info = None
+        self._images = set()
+        self._lock = threading.Lock()
+
+    def _url(self, path, params=None):
+        url = f"/v{self.api_version}{path}" if self.api_version else path
+        params = {key: val for key, val in (params or {}).items() if val is not None}
+        return f"{url}?{urlencode(params)}" if params else url
+
+    def request(self, method, path, params=None, body=None, stream=False):
+        """
+        Makes a request of the daemon
+
+        Parameters
+        ----------
+        method : str
+            e.g. "GET" or "POST"
+        path : str
+            e.g. "/containers/create"
+        params : dict, optional
+            The query parameters. Those given as None are left out.
+        body : dict, optional
+            Sent as json
+        stream : bool, optional
+            Return the response itself, to be read as it arrives, without a timeout
+
+        Returns
+        -------
+        dict, list, http.client.HTTPResponse or None
+            The decoded json response, or with stream, the response
+
+        Raises
+        ------
+        DockerAPIError
+            If the daemon answers with an error
+        """
+        conn = UnixHTTPConnection(self.socket_path, timeout=None if stream else self.timeout)
+        headers = {"Host": "docker"}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        conn.request(method, self._url(path, params), body=data, headers=headers)
+        response = conn.getresponse()
+        if response.status >= 400:
+            content = response.read()
+            conn.close()
+            try:
+                message = json.loads(content)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = content.decode("utf-8", "replace")
+            raise DockerAPIError(response.status, message)
+        if stream:
+            return response
+        content = response.read()
+        conn.close()
+        if not content:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return content.decode("utf-8", "replace")
+
+    def ping(self):
+        return self.request("GET", "/_ping") == "OK"
+
+    def info(self):
+        """The daemon's system info, asked once"""
+        with self._lock:
+            if self._info is None:
+                self._info = self.request("GET", "/info")
+            return self._info
+
+    def is_rootless(self):
+        """Whether the daemon runs rootless, asked once"""
+        security_options = self.info().get("SecurityOptions") or []
+        return any("rootless" in option for option in security_options)
+
+    def image_exists(self, name):
+        """Whether an image is in the local cache. Found images are remembered."""
+        if name in self._images:
+            return True
+        try:
+            self.request("GET", f"/images/{quote(name, safe='/:')}/json")
+        except DockerAPIError as exc:
+            if exc.status == 404:
+                return False
+            raise
+        self._images.add(name)
+        return True
+
+    def create_container(
+        self,
+        image,
+        command=None,
+        name=None,
+        binds=None,
+        environment=None,
+        user=None,
+        cpuset_cpus=None,
+        nano_cpus=None,
+        memory=None,
+        auto_remove=False,
+    ):
+        """
+        Creates a container
+
+        Parameters
+        ----------
+        image : str
+        command : list of str, optional
+            Arguments to the image's entrypoint
+        name : str, optional
+        binds : list of str, optional
+            e.g. ["/data:/app/data", "/mirror:/mirror:ro"]
+        environment : dict, optional
+        user : str, optional
+            e.g. "1000:1000"
+        cpuset_cpus : str, optional
+            e.g. "0-3,8"
+        nano_cpus : int, optional
+            The CPU quota, in billionths of a CPU
+        memory : int, optional
+            The memory limit, in bytes
+        auto_remove : bool, optional
+            Remove the container when it exits (docker run --rm). Default is False.
+
+        Returns
+        -------
+        str
+            The container's id
+        """
+        host_config = {"Binds": binds or [], "AutoRemove": auto_remove}
+        if cpuset_cpus:
+            host_config["CpusetCpus"] = cpuset_cpus
+        if nano_cpus:
+            host_config["NanoCpus"] = int(nano_cpus)
+        if memory:
+            host_config["Memory"] = int(memory)
+        body = {
+            "Image": image,
+            "Cmd": list(command or []),
+            "Env": [f"{key}={val}" for key, val in (environment or {}).items()],
+            "HostConfig": host_config,
+        }
+        if user:
+            body["User"] = user
+        return self.request("POST", "/containers/create", params={"name": name}, body=body)["Id"]
+
+    def start_container(self, container):
+        self.request("POST", f"/containers/{container}/start")
+
+    def wait_container(self, container):
+        """Waits for a container to exit, returning its exit code"""
+        # Streamed, as it takes as long as the container does
+        response = self.request("POST", f"/containers/{container}/wait", stream=True)
+        return json.loads(response.read())["StatusCode"]
+
+    def stop_container(self, container, timeout=10):
+        self.request("POST", f"/containers/{container}/stop", params={"t": timeout})
+
+    def remove_container(self, container, force=False):
+        try:
+            self.request("DELETE", f"/containers/{container}", params={"force": int(force)})
+        except DockerAPIError as exc:
+            # Already removed, e.g. by auto_remove
+            if exc.status != 404:
+                raise
+
+    def running_containers(self, names):
+        """The names among names of the containers that are running"""
+        filters = json.dumps({"name": [f"^/{name}$" for name in names]})
+        containers = self.request("GET", "/containers/json", params={"filters": filters})
+        running = {name.lstrip("/") for container in containers for name in container["Names"]}
+        return running & set(names)
+
+    def logs(self, container, follow=True, since=None):
+        """
+        Yields the lines a container writes to stdout and stderr, as they arrive
+
+        Parameters
+        ----------
+        container : str
+            The container's id or name
+        follow : bool, optional
+            Keep streaming until the container exits. Default is True.
+        since : int, optional
+            Only lines written since this unix time
+        """
+        params = {"stdout": 1, "stderr": 1, "follow": int(follow), "since": since}
+        response = self.request("GET", f"/containers/{container}/logs", params, stream=True)
+        pending = b""
+        for payload in demultiplex(response):
+            *lines, pending = (pending + payload).split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8", "replace").rstrip("\r")
+        if pending:
+            yield pending.decode("utf-8", "replace")
+
+    def run(self, image, command=None, on_line=None, **create_args):
+        """
+        Runs a container to the end, like `docker run --rm`
+
+        Parameters
+        ----------
+        image : str
+        command : list of str, optional
+            Arguments to the image's entrypoint
+        on_line : callable, optional
+            Called with each line of the container's output
+        **create_args:
+            Passed on to create_container
+
+        Returns
+        -------
+        int
+            The container's exit code
+        """
+        container = self.create_container(image, command, **create_args)
+        try:
+            self.start_container(container)
+            for line in self.logs(container, follow=True):
+                if on_line is not None:
+                    on_line(line)
+            return self.wait_container(container)
+        finally:
+            self.remove_container(container, force=True)
@@ -5,18 +5,29 @@ Original Author: leigh.tyers@curtin.edu.au
 Creation Date: 2023-01-13
 """
 
-import json
+import hashlib
 import logging
 import os
+import queue
 from os.path import join, isfile
 from pathlib import Path
 from subprocess import PIPE, STDOUT
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 
 
 from main_config import log_fname, data_directory, docker_image_name
+from main_config import local_mirror_roots, product_store_dir, jvm_max_heap_fraction
+from main_config import docker_socket
+from docker_api import DockerAPIError, get_client
+from snappy_processing.product_store import CONTAINER_DATA_DIR, HOST_DATA_DIR_ENV
+from snappy_processing.spool import FINISHED_STATES, WORKER_FAILED_EXIT_CODE, Spool
+from snappy_processing.resource_tuner import SnapSettings, available_cpus, available_memory_gb
+from snappy_processing.resource_tuner import largest_product_memory_gb
 
 log_fname = os.path.join(data_directory, log_fname)
 log_fname = Path(log_fname).expanduser().resolve().as_posix()
@@ -29,28 +40,26 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# Stops two pipeline workers from building the image at the same time
+_image_lock = threading.Lock()
+
+
+def docker_client():
+    """The Docker Engine API client (see docker_api.py), shared by the whole process"""
+    return get_client(docker_socket)
+
 
 def docker_is_root():
     """
-    Checks if the docker version on linux is a root install (not rootless) via a system call
+    Checks if the docker version on linux is a root install (not rootless).
+    The daemon is only asked once per process.
     """
-    try:
-        text_output = subprocess.check_output("docker version | grep rootlesskit", shell=True)
-    except:
-        text_output = None
-    is_root = False if (text_output) else True
-    return is_root
+    return not docker_client().is_rootless()
 
 
 def check_docker_image_exists(container_name: str) -> bool:
-    """Checks if a docker image is in the local cache"""
-    cmd = 'docker image list --filter "reference={container_name}" --format json'
-    proc = subprocess.Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    std_out, err = proc.communicate()
-    # output is a byte string so we need to decode it
-    std_out_split = std_out.decode("utf-8").split("\n")
-    images = [json.loads(line) for line in std_out_split if line]
-    image_exists = any([image["Repository"] == container_name for image in images])
+    """Checks if a docker image is in the local cache, remembering it once it is"""
+    image_exists = docker_client().image_exists(container_name)
     log.info(f"Does docker image {container_name} exist: {image_exists}")
     return image_exists
 
@@ -61,47 +70,257 @@ def build_docker_container(container_name: str, location: str = "snappy_processi
     location_path_full = Path(base_path) / location
     log.info(f"Building docker container {container_name} from {location_path_full}")
     log.info("This can take up to 20+ minutes due to the SNAP installation")
-    cmd = f"docker build {location_path_full} -t {container_name}"
-    log.info(f"Running cmd '{cmd}'")
-    proc = subprocess.Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
+    # Building through the API would mean sending the build context as a tar, so the CLI
+    # is still used for this rare step
+    cmd = ["docker", "build", str(location_path_full), "-t", container_name]
+    log.info(f"Running cmd '{' '.join(cmd)}'")
+    proc = subprocess.Popen(cmd, stdout=PIPE, stderr=STDOUT)
     with proc.stdout:
         log_subprocess_output(proc.stdout, initial_text="Docker build ouput: ")
     proc.wait()
     return
 
 
-def form_docker_command(
-    run_dir, container_name="s1_preproc", filename=None, file_list=None, **kwargs
+def cpuset_string(cpus):
+    """The --cpuset-cpus of a list of CPUs, e.g. "0-3,8" for [0, 1, 2, 3, 8]"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(low) if low == high else f"{low}-{high}" for low, high in ranges)
+
+
+def host_resources():
+    """The CPUs this process may run on, and its memory in GB, within any cgroup limits"""
+    return available_cpus(), available_memory_gb()
+
+
+class ContainerLimits:
+    """
+    The share of the host given to one container: its CPUs and memory, and the JVM and SNAP
+    settings to match (see snappy_processing/resource_tuner.py)
+
+    Parameters
+    ----------
+    cpus : list of int
+        The host CPUs the container runs on
+    memory_gb : float
+        The container's memory limit
+    **tuning:
+        Passed on to resource_tuner.SnapSettings, e.g. heap_fraction
+    """
+
+    def __init__(self, cpus, memory_gb, **tuning):
+        self.cpus = list(cpus)
+        self.memory_gb = memory_gb
+        self.settings = SnapSettings(len(self.cpus), memory_gb, **tuning)
+
+    def java_options(self):
+        return self.settings.java_options()
+
+    def container_options(self):
+        """The limits as arguments of docker_api.DockerClient.create_container"""
+        return {
+            "cpuset_cpus": cpuset_string(self.cpus),
+            "nano_cpus": len(self.cpus) * 10**9,
+            "memory": int(self.memory_gb * 1024**3),
+            # The JVM started by snappy inside the container picks up JAVA_TOOL_OPTIONS
+            "environment": self.settings.environment(),
+        }
+
+    def __str__(self):
+        return f"CPUs {cpuset_string(self.cpus)}, {self.memory_gb:.1f}GB memory, {self.settings}"
+
+
+def partition_host(
+    num_containers=None,
+    min_cpus=4,
+    min_memory_gb=16,
+    heap_fraction=0.75,
+    reserve_memory_gb=4,
+    tile_cache_fraction=0.5,
+    product_paths=None,
+):
+    """
+    Splits the host's CPUs and memory between containers running at once
+
+    Parameters
+    ----------
+    num_containers : int, optional
+        The number of containers. By default, as many as have min_cpus CPUs and min_memory_gb
+        of memory each (or more, if the products need a larger heap), and at least 1.
+    min_cpus : int, optional
+        The fewest CPUs a container is given when num_containers is worked out. Default is 4.
+    min_memory_gb : float, optional
+        The least memory a container is given when num_containers is worked out. Default is 16.
+    heap_fraction : float, optional
+        Fraction of a container's memory given to its JVM heap. Default is 0.75.
+    reserve_memory_gb : float, optional
+        Memory left for the host (the downloads, COG conversion, etc.). Default is 4.
+    tile_cache_fraction : float, optional
+        Fraction of a container's heap given to SNAP's tile cache. Default is 0.5.
+    product_paths : list of str, optional
+        The products to be processed, whose size sets the heap a container needs.
+        By default a typical IW GRDH product.
+
+    Returns
+    -------
+    list of ContainerLimits
+        One for each container, with CPUs that do not overlap
+    """
+    cpus, memory_gb = host_resources()
+    # Never more than half the host's memory is held back
+    memory_gb = max(memory_gb - reserve_memory_gb, memory_gb / 2)
+    product_gb = largest_product_memory_gb(product_paths)
+    if not num_containers:
+        # Each container with at least the memory for its heap to hold a product
+        container_memory_gb = max(min_memory_gb, product_gb / heap_fraction)
+        num_containers = max(
+            1, min(len(cpus) // min_cpus, int(memory_gb // container_memory_gb))
+        )
+    # Each container needs a CPU of its own
+    num_containers = max(1, min(int(num_containers), len(cpus)))
+    # Contiguous CPUs, spread as evenly as they go
+    bounds = [round(num * len(cpus) / num_containers) for num in range(num_containers + 1)]
+    limits = [
+        ContainerLimits(
+            cpus[bounds[num] : bounds[num + 1]],
+            memory_gb / num_containers,
+            heap_fraction=heap_fraction,
+            tile_cache_fraction=tile_cache_fraction,
+            product_gb=product_gb,
+        )
+        for num in range(num_containers)
+    ]
+    log.info(
+        f"Host ({len(cpus)} CPUs, {memory_gb:.0f}GB free for containers) split between "
+        f"{num_containers} containers for products needing {product_gb:.1f}GB, "
+        f"the first with {limits[0]}"
+    )
+    return limits
+
+
+class ContainerSlots:
+    """
+    Hands out the ContainerLimits of a partition (see partition_host) to the containers
+    running at once, so no two of them share CPUs
+
+    Parameters
+    ----------
+    limits : list of ContainerLimits
+    """
+
+    def __init__(self, limits):
+        self.limits = list(limits)
+        self._free = queue.Queue()
+        for container_limits in self.limits:
+            self._free.put(container_limits)
+
+    def __len__(self):
+        return len(self.limits)
+
+    @contextmanager
+    def acquire(self):
+        """Waits for a free slot, and holds it until the block ends"""
+        container_limits = self._free.get()
+        try:
+            yield container_limits
+        finally:
+            self._free.put(container_limits)
+
+
+def container_options(run_dir, limits=None):
+    """
+    The mounts and user of a container over the data directory run_dir, and its resource
+    limits, given its ContainerLimits, as arguments of docker_api.DockerClient.create_container
+    """
+    binds = [f"{run_dir}/:{CONTAINER_DATA_DIR}"]
+    # Products symlinked from a local mirror need the mirror at the same path in the container
+    for mirror_root in local_mirror_roots:
+        mirror_root = Path(mirror_root).expanduser().resolve().as_posix()
+        if os.path.isdir(mirror_root):
+            binds.append(f"{mirror_root}:{mirror_root}:ro")
+    # Raw products linked from the shared product store need it at the same path too
+    if product_store_dir:
+        store_root = Path(product_store_dir).expanduser().resolve().as_posix()
+        binds.append(f"{store_root}:{store_root}")
+    # The product store's references are recorded by host path, also from inside the container
+    options = {"binds": binds, "environment": {HOST_DATA_DIR_ENV: run_dir}}
+    if docker_is_root():
+        # Or else the files created are owned by root
+        options["user"] = f"{os.getuid()}:{os.getgid()}"
+    if limits is not None:
+        limit_options = limits.container_options()
+        options["environment"].update(limit_options.pop("environment", {}))
+        options.update(limit_options)
+    return options
+
+
+def ensure_docker_image(image_name=docker_image_name):
+    """Builds the docker image, unless it is in the local cache"""
+    with _image_lock:
+        image_exists = check_docker_image_exists(container_name=image_name)
+        if not image_exists:
+            build_docker_container(container_name=image_name)
+
+
+def copy_config(data_directory, config_override=True):
+    """Copies main_config.py to data_directory/config.py, where the container reads it"""
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    try:
+        if (not isfile(join(data_directory, "config.py"))) or config_override:
+            os.makedirs(data_directory, exist_ok=True)
+            # Copy then rename, so a container started by another pipeline worker
+            # never reads a half written config
+            tmp_config = join(data_directory, f"config.py.{os.getpid()}.{threading.get_ident()}")
+            shutil.copy(join(code_dir, "main_config.py"), tmp_config)
+            os.replace(tmp_config, join(data_directory, "config.py"))
+    except shutil.SameFileError:
+        pass
+
+
+def form_container_args(
+    run_dir,
+    filename=None,
+    file_list=None,
+    list_fname="files_to_process.txt",
+    recycle_every=None,
+    max_heap_fraction=None,
+    **kwargs,
 ):
-    """Forms the command to run docker
+    """Forms the arguments of the container. A file_list is written to run_dir/list_fname.
 
     See Also
     --------
     run_docker_container : Uses this function
     """
-    cmd = f"docker run --rm -v {run_dir}/:/app/data "
-    if docker_is_root():
-        cmd += " --user $(id -u):$(id -g) "
-    cmd += f" {container_name} "
-
+    args = []
     if file_list:
-        cmd += " --filelist 'data/files_to_process.txt'"
+        args += ["--filelist", f"data/{list_fname}"]
         # Santise files and output
         file_list = [os.path.basename(f) for f in file_list]
-        with open(join(data_directory, "files_to_process.txt"), "w") as f:
+        # Written to the directory mounted as data/ in the container
+        with open(join(run_dir, list_fname), "w") as f:
             f.writelines("\n".join(file_list))
+        # The container's JVM is restarted through the list (see snappy_processing/supervisor.py)
+        if recycle_every:
+            args += ["--recycle-every", str(int(recycle_every))]
+        if max_heap_fraction:
+            args += ["--max-heap-fraction", str(max_heap_fraction)]
     elif filename:
-        cmd += f" --filename {filename}"
+        args += ["--filename", os.path.basename(filename)]
     else:
         raise ValueError("File_list and filename are not valid.")
 
     for key, val in kwargs.items():
         if key == "shapefile":
-            cmd += f"  --{key} '{join('data', os.path.basename(val))}'"
+            args += [f"--{key}", join("data", os.path.basename(val))]
         else:
-            cmd += f"  --{key} '{val}'"
+            args += [f"--{key}", str(val)]
 
-    return cmd
+    return args
 
 
 def log_subprocess_output(pipe, initial_text="Docker Output: ") -> None:
@@ -113,7 +332,12 @@ def log_subprocess_output(pipe, initial_text="Docker Output: ") -> None:
 
 
 def run_docker_container(
-    filename=None, file_list=None, data_directory="data", config_override=True, **kwargs
+    filename=None,
+    file_list=None,
+    data_directory="data",
+    config_override=True,
+    slots=None,
+    **kwargs,
 ) -> None:
     """
     Runs the docker container with appropriate cmdline arguments
@@ -128,6 +352,14 @@ def run_docker_container(
         The directory where the data is located, default is "data"
     config_override : bool, optional
         A flag to indicate if the config file should be overridden, default is False
+    recycle_every : int, optional
+        With a file_list, the container's JVM is restarted after this many products
+    max_heap_fraction : float, optional
+        With a file_list, the container's JVM is restarted once more than this fraction of its
+        heap is in use after a product
+    slots : ContainerSlots, optional
+        Slots of the host's CPUs and memory. The container waits for a free slot, and runs
+        within its limits. By default the container is not limited.
     **kwargs:
         Additional command line arguments passed to the container
 
@@ -144,34 +376,357 @@ def run_docker_container(
     run_dir = os.path.abspath(data_directory)
 
     image_name = docker_image_name
-    image_exists = check_docker_image_exists(container_name=image_name)
-    if not image_exists:
-        build_docker_container(container_name=image_name)
+    ensure_docker_image(image_name)
 
-    cmd = form_docker_command(
-        run_dir=run_dir, container_name=image_name, filename=filename, file_list=file_list, **kwargs
-    )
-    log.info(f"Docker command is: {cmd}")
+    # Each run has its own file list, as several may run at once
+    list_fname = f"files_to_process_{os.getpid()}_{threading.get_ident()}.txt"
     # The docker image needs a local copy of config in the appropriate directory.
-    code_dir = os.path.dirname(os.path.realpath(__file__))
-    try:
-        if (not isfile(join(data_directory, "config.py"))) or config_override:
-            os.makedirs(data_directory, exist_ok=True)
-            shutil.copy(join(code_dir, "main_config.py"), join(data_directory, "config.py"))
-    except shutil.SameFileError:
-        pass
+    copy_config(data_directory, config_override)
     # move shapefile into relevat
 
-    log.info(["-" * 50])
-    log.info([f"    Processing file {filename}  "])
-    process = subprocess.Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    with process.stdout:
-        log_subprocess_output(process.stdout)
+    args = form_container_args(
+        run_dir=run_dir, filename=filename, file_list=file_list, list_fname=list_fname, **kwargs
+    )
+    with slots.acquire() if slots is not None else nullcontext() as limits:
+        options = container_options(run_dir, limits)
+        log.info(f"Docker image {image_name}, arguments {args}, options {options}")
+        if limits is not None:
+            log.info(f"    Container limits: {limits}")
 
-    exitcode = process.wait()  # 0 means success
+        log.info(["-" * 50])
+        log.info([f"    Processing file {filename or f'list of {len(file_list)} files'}  "])
+        try:
+            exitcode = docker_client().run(
+                image_name, args, on_line=lambda line: log.info(f"Docker Output: {line}"), **options
+            )  # 0 means success
+        except (DockerAPIError, OSError) as exc:
+            log.error(f"    Unable to run the docker container: {exc}")
+            exitcode = -1
     if not exitcode:
         log.info("    Exitcode 0, docker container success")
     else:
-        log.error(f"    Exitcode nonzero for file: {filename}")
+        log.error(f"    Exitcode nonzero for file: {filename or file_list}")
         log.error(f"    Exitcode was: {exitcode}")
+    if file_list and os.path.exists(join(run_dir, list_fname)):
+        os.remove(join(run_dir, list_fname))
     return
+
+
+def run_parallel_containers(file_list, data_directory="data", slots=None, **kwargs):
+    """
+    Splits a file list between containers run at once, one for each of the slots
+
+    Parameters
+    ----------
+    file_list : list
+        The files to be processed
+    data_directory : str, optional
+        The directory where the data is located, default is "data"
+    slots : ContainerSlots, optional
+        The share of the host each container is given. By default the host is split up
+        with partition_host.
+    **kwargs:
+        Passed on to run_docker_container
+    """
+    if slots is None:
+        slots = ContainerSlots(partition_host())
+    num_containers = min(len(slots), len(file_list))
+    threads = [
+        threading.Thread(
+            target=run_docker_container,
+            kwargs=dict(
+                file_list=file_list[num::num_containers],
+                data_directory=data_directory,
+                slots=slots,
+                **kwargs,
+            ),
+            name=f"container-{num}",
+        )
+        for num in range(num_containers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class WorkerPool:
+    """
+    A pool of long-lived worker containers (`main.py --worker`), each keeping snappy and its
+    JVM warm between products. Jobs are passed through a spool in the data directory
+    (see snappy_processing/spool.py), which reports each job's status back.
+
+    Workers are named after the data directory, so a pool started again over the same
+    directory (e.g. by the next run) reuses the workers still running. They are started by
+    start, or by the first job processed, so a run with nothing to process starts none.
+
+    Parameters
+    ----------
+    data_directory : str
+        The data directory mounted into the workers
+    num_workers : int, optional
+        Number of worker containers. Default is 1.
+    image_name : str, optional
+        The docker image. Default is docker_image_name from the config.
+    poll_seconds : float, optional
+        Seconds between looks at a job's status. Default is 2.
+    limits : list of ContainerLimits, optional
+        The share of the host given to each worker (see partition_host). By default the workers
+        are not limited.
+    sizing : dict, optional
+        Without limits, options for partition_host, which splits the host between the workers
+        when they are started (and may leave fewer workers than num_workers)
+    """
+
+    def __init__(
+        self,
+        data_directory,
+        num_workers=1,
+        image_name=docker_image_name,
+        poll_seconds=2,
+        limits=None,
+        sizing=None,
+    ):
+        self.data_directory = data_directory
+        self.limits = limits
+        self.sizing = sizing
+        self.run_dir = os.path.abspath(data_directory)
+        self.image_name = image_name
+        self.poll_seconds = poll_seconds
+        self.spool = Spool(join(self.run_dir, ".spool"))
+        run_hash = hashlib.sha1(self.run_dir.encode("utf-8")).hexdigest()[:8]
+        self.names = [f"{image_name}_worker_{run_hash}_{num}" for num in range(max(1, num_workers))]
+        self._log_threads = []
+        self._started = False
+        self._start_lock = threading.Lock()
+        # Workers that exited with WORKER_FAILED_EXIT_CODE, which are not started again
+        self.failed_workers = set()
+
+    def running_workers(self):
+        """The names of this pool's workers that are running"""
+        return docker_client().running_containers(self.names)
+
+    @staticmethod
+    def _follow_logs(name, since):
+        try:
+            for line in docker_client().logs(name, follow=True, since=since):
+                log.info(f"{name}: {line}")
+        except (DockerAPIError, OSError) as exc:
+            log.warning(f"Stopped following the logs of {name}: {exc}")
+
+    def _start_worker(self, num, name):
+        """Starts one worker container, and follows its logs"""
+        log.info(f"Starting SNAP worker {name}")
+        # A heartbeat left by an earlier worker is not taken for this one's
+        self.spool.forget_worker(str(num))
+        worker_limits = self.limits[num] if self.limits else None
+        if worker_limits is not None:
+            log.info(f"    {name} limits: {worker_limits}")
+        args = ["--worker", "--worker-id", str(num)]
+        if jvm_max_heap_fraction:
+            # Restarted with a fresh JVM when its heap fills up
+            args += ["--max-heap-fraction", str(jvm_max_heap_fraction)]
+        container = docker_client().create_container(
+            self.image_name,
+            args,
+            name=name,
+            auto_remove=True,
+            **container_options(self.run_dir, worker_limits),
+        )
+        docker_client().start_container(container)
+        self._follow(name)
+
+    def _follow(self, name):
+        # Only the output from now on, when following a reused worker
+        thread = threading.Thread(
+            target=self._follow_logs,
+            args=(name, int(time.time())),
+            name=f"{name}-logs",
+            daemon=True,
+        )
+        thread.start()
+        self._log_threads.append(thread)
+
+    def start(self):
+        """Starts the workers that are not already running, and follows their logs"""
+        if self.limits is None and self.sizing is not None:
+            self.limits = partition_host(len(self.names), **self.sizing)
+            self.names = self.names[: len(self.limits)]
+        ensure_docker_image(self.image_name)
+        self.failed_workers = set()
+        running = self.running_workers()
+        if not running:
+            # Nothing is left to finish jobs claimed by workers of an earlier pool
+            self.spool.requeue_running()
+            self.spool.clear_stop()
+        copy_config(self.data_directory)
+        for num, name in enumerate(self.names):
+            if name in running:
+                log.info(f"Reusing SNAP worker {name}")
+                self._follow(name)
+            else:
+                self._start_worker(num, name)
+        self._started = True
+        return self
+
+    def ensure_started(self):
+        """Starts the workers, unless they have been already"""
+        with self._start_lock:
+            if not self._started:
+                self.start()
+        return self
+
+    def restart_dead_workers(self):
+        """
+        Starts again the workers of a started pool that have exited (e.g. after a JVM crash),
+        returning their names. A worker that exited as it cannot run (WORKER_FAILED_EXIT_CODE)
+        is not, and once none can run, the queued jobs are failed.
+        """
+        with self._start_lock:
+            if not self._started or self.spool.stop_requested():
+                return []
+            running = self.running_workers()
+            dead = [
+                (num, name)
+                for num, name in enumerate(self.names)
+                if name not in running and name not in self.failed_workers
+            ]
+            restarted = []
+            for num, name in dead:
+                heartbeat = self.spool.heartbeat_of(str(num)) or {}
+                if heartbeat.get("exit_code") == WORKER_FAILED_EXIT_CODE:
+                    log.error(f"SNAP worker {name} cannot run: {heartbeat.get('error')}")
+                    self.failed_workers.add(name)
+                    continue
+                log.warning(f"SNAP worker {name} is not running")
+                try:
+                    self._start_worker(num, name)
+                except DockerAPIError as exc:
+                    # e.g. the exited container is still being removed, tried again later
+                    log.warning(f"Unable to restart SNAP worker {name}: {exc}")
+                restarted.append(name)
+            if self.failed_workers.issuperset(self.names):
+                failed = self.spool.fail_queued("No SNAP worker can run, see the worker logs")
+                if failed:
+                    log.error(f"Failed {failed} queued jobs, as no SNAP worker can run")
+            return restarted
+
+    def worker_name(self, worker_id):
+        """The container name of a worker id, as in job statuses, or None if it is not ours"""
+        try:
+            return self.names[int(worker_id)]
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def submit(self, filename, operators=None):
+        """Queues a raw zip for processing (starting the workers if need be), returning its id"""
+        if self._started:
+            self.restart_dead_workers()
+        self.ensure_started()
+        return self.spool.submit(filename, operators)
+
+    def job_lost(self, status, running):
+        """
+        Whether a job a worker has claimed is left without one: its worker's container is not
+        running, or the worker has since moved on to another job (or none)
+        """
+        name = self.worker_name(status.get("worker"))
+        if name is None or name not in running:
+            return True
+        # A worker beats with the job it claims, and without one once idle again
+        heartbeat = self.spool.heartbeat_of(status["worker"]) or {}
+        moved_on = heartbeat.get("job") != status.get("id")
+        return moved_on and heartbeat.get("time", 0) > status.get("time", 0)
+
+    def wait(self, job_id, timeout=None, liveness_seconds=30, max_requeues=1):
+        """
+        Waits for a job to finish. Every liveness_seconds, a job claimed by a worker that has
+        since gone (see job_lost) is put back in the queue, or failed after max_requeues, and
+        the workers that have exited are started again.
+
+        Parameters
+        ----------
+        job_id : str
+            From submit
+        timeout : float, optional
+            Seconds to wait before giving up. By default waits for as long as a worker runs.
+        liveness_seconds : float, optional
+            Seconds between checks that the job's worker is still running. Default is 30.
+        max_requeues : int, optional
+            The times a job lost with its worker is queued again before it is failed.
+            Default is 1, as a product can itself be what crashes the worker.
+
+        Returns
+        -------
+        dict
+            The job's status: "state" ("done" or "failed"), "worker", "seconds", and
+            "output" when done or "error" when failed
+        """
+        start = last_check = time.time()
+        requeues = 0
+        while True:
+            status = self.spool.status(job_id) or {}
+            if status.get("state") in FINISHED_STATES:
+                self.spool.forget(job_id)
+                if status["state"] == "failed":
+                    filename = status.get("filename")
+                    log.error(f"Job {job_id} ({filename}) failed: {status.get('error')}")
+                return status
+            now = time.time()
+            if timeout is not None and now - start > timeout:
+                raise TimeoutError(f"Job {job_id} did not finish within {timeout} seconds")
+            if now - last_check > liveness_seconds:
+                last_check = now
+                running = status.get("state") == "running"
+                if running and self.job_lost(status, self.running_workers()):
+                    requeues = self._recover_lost_job(job_id, status, requeues, max_requeues)
+                    continue
+                self.restart_dead_workers()
+            time.sleep(self.poll_seconds)
+
+    def _recover_lost_job(self, job_id, status, requeues, max_requeues):
+        """Queues a job lost with its worker again, or fails it, returning the requeues so far"""
+        worker = self.worker_name(status.get("worker")) or status.get("worker")
+        # Neither is done once the job is no longer claimed, e.g. if it has finished since
+        if requeues < max_requeues:
+            if self.spool.requeue(job_id):
+                log.warning(f"SNAP worker {worker} is gone, job {job_id} is queued again")
+                requeues += 1
+        elif self.spool.fail_lost(job_id, f"SNAP worker {worker} exited while processing it"):
+            log.warning(f"SNAP worker {worker} is gone, job {job_id} failed with it")
+        self.restart_dead_workers()
+        return requeues
+
+    def process(self, filename, operators=None, timeout=None):
+        """Processes a raw zip on one of the workers, returning the job's status"""
+        return self.wait(self.submit(filename, operators), timeout=timeout)
+
+    def stop(self, timeout=600):
+        """Asks the workers to exit once the queue is empty, and stops them after timeout seconds"""
+        if not self._started:
+            return
+        self.spool.request_stop()
+        deadline = time.time() + timeout
+        while self.running_workers() and time.time() < deadline:
+            time.sleep(self.poll_seconds)
+        left = self.running_workers()
+        if left:
+            log.warning(f"Stopping SNAP workers {sorted(left)} that did not exit")
+            for name in sorted(left):
+                try:
+                    docker_client().stop_container(name)
+                except DockerAPIError as exc:
+                    log.warning(f"Unable to stop {name}: {exc}")
+        # The log streams end with the workers
+        for thread in self._log_threads:
+            thread.join(timeout=self.poll_seconds)
+        self._log_threads = []
+        self.spool.clear_stop()
+        self._started = False
+        log.info("SNAP workers stopped")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -20,33 +20,227 @@
 # limitations under the License.
 #
 
+import base64
+import binascii
+import json
 import logging
 from pathlib import Path
 import sys
 import os
-from os.path import join
 import hashlib
-import errno
-import traceback as tb
-import requests
+import re
+import threading
+import time
+import zipfile
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from eodag.utils import sanitize
 from eodag.utils import ProgressCallback
 
+from mirror import find_in_mirrors
+from remote_zip import download_polarisations, measurement_polarisation, zip_polarisations
+from remote_zip import is_partial, zip_bursts
+from s3_backend import S3Archive
+from snappy_processing import http_transport
+from snappy_processing.product_store import ProductStore, link_file
+from snappy_processing import state_db
+
 from main_config import log_fname, data_directory
+from main_config import thredds_download_connections, thredds_segment_size_mb
+from main_config import product_store_dir, state_db_fname
+from main_config import thredds_polarisations
+from main_config import s3_archive
 
-log_fname = os.path.join(data_directory, log_fname)
-log_fname = Path(log_fname).expanduser().resolve().as_posix()
+# Scripts importing this (e.g. insar_processing's downloader) may already log to a file of their own
+if not logging.getLogger().handlers:
+    log_fname = os.path.join(data_directory, log_fname)
+    log_fname = Path(log_fname).expanduser().resolve().as_posix()
 
-logging.basicConfig(
-    format="%(asctime)s %(levelname)-8s %(message)s",
-    level=logging.INFO,
-    handlers=[logging.FileHandler(log_fname), logging.StreamHandler(sys.stdout)],
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s",
+        level=logging.INFO,
+        handlers=[logging.FileHandler(log_fname), logging.StreamHandler(sys.stdout)],
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
 log = logging.getLogger(__name__)
 
 
+class AggregateProgress:
+    """
+    Progress of all the downloads running at once, logged as one line every `interval` seconds.
+
+    Parameters
+    ----------
+    total_products : int, optional
+        The number of products to be downloaded, if known
+    interval : float, optional
+        Seconds between progress log lines. Default is 30.
+    quiet_bars : bool, optional
+        Hide the per-product progress bars, which garble the terminal when several
+        downloads run at once. Default is False.
+    """
+
+    def __init__(self, total_products=None, interval=30, quiet_bars=False):
+        self.total_products = total_products
+        self.interval = interval
+        self.quiet_bars = quiet_bars
+        self.lock = threading.Lock()
+        self.active = 0
+        self.finished = 0
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_log = self.start_time
+
+    def add_total(self, size):
+        with self.lock:
+            self.total_bytes += size
+
+    def update(self, size):
+        with self.lock:
+            self.done_bytes += size
+            now = time.monotonic()
+            if now - self.last_log < self.interval:
+                return
+            self.last_log = now
+        self.log()
+
+    def started(self):
+        with self.lock:
+            self.active += 1
+
+    def stopped(self):
+        with self.lock:
+            self.active -= 1
+            self.finished += 1
+
+    def log(self):
+        """Logs the number of active downloads, the bytes downloaded and the overall rate"""
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-6)
+            products = f"{self.finished}"
+            if self.total_products:
+                products += f"/{self.total_products}"
+            log.info(
+                f"Downloads: {self.active} active, {products} products finished, "
+                f"{self.done_bytes / 1e9:.2f}/{self.total_bytes / 1e9:.2f} GB, "
+                f"{self.done_bytes / elapsed / 1e6:.1f} MB/s"
+            )
+
+
+class ProductProgressCallback(ProgressCallback):
+    """
+    A progress bar for one product which also feeds an AggregateProgress.
+    Can be given to both download_product_thredds and EODAG's product.download.
+    If `throttle_url` is given, each update waits for the bandwidth limit of its host,
+    which governs downloads (like EODAG's) that do not go through http_transport.
+    """
+
+    def __init__(self, aggregate, *args, throttle_url=None, **kwargs):
+        self.aggregate = aggregate
+        self.counted_total = 0
+        self.throttle_url = throttle_url
+        super().__init__(*args, **kwargs)
+
+    def reset(self, total=None):
+        # reset is also called while the bar is being constructed
+        aggregate = getattr(self, "aggregate", None)
+        if aggregate is not None and total:
+            aggregate.add_total(total - self.counted_total)
+            self.counted_total = total
+        return super().reset(total=total)
+
+    def update(self, n=1):
+        if getattr(self, "aggregate", None) is not None:
+            self.aggregate.update(n)
+        if getattr(self, "throttle_url", None):
+            http_transport.consume(self.throttle_url, n)
+        return super().update(n)
+
+
+class ProviderLimits:
+    """
+    Limits the number of downloads running at once from each provider.
+
+    Parameters
+    ----------
+    limits : dict
+        Maximum concurrent downloads for each provider name, e.g. {"sara": 2, "thredds": 4}.
+        Providers not listed are not limited (beyond the number of download workers).
+    """
+
+    def __init__(self, limits):
+        self.semaphores = {
+            str(provider).lower(): threading.BoundedSemaphore(max(1, int(limit)))
+            for provider, limit in (limits or {}).items()
+        }
+
+    def slot(self, provider):
+        """A context manager holding one download slot for `provider`"""
+        semaphore = self.semaphores.get(str(provider).lower())
+        return semaphore if semaphore is not None else _NoLimit()
+
+
+class _NoLimit:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_product_store = None
+_product_store_lock = threading.Lock()
+_s3_archive = None
+
+
+def get_product_store():
+    """The shared raw product store set by `product_store_dir` in the config, or None"""
+    global _product_store
+    if not product_store_dir:
+        return None
+    with _product_store_lock:
+        if _product_store is None:
+            _product_store = ProductStore(product_store_dir)
+        return _product_store
+
+
+def get_state_db(data_path):
+    """The state database of the project holding data_path (its data_raw or data_processed)"""
+    return state_db.for_data_path(data_path, state_db_fname)
+
+
+def get_s3_archive():
+    """The S3 archive set by `s3_archive` in the config, or None"""
+    global _s3_archive
+    if not s3_archive:
+        return None
+    with _product_store_lock:
+        if _s3_archive is None:
+            _s3_archive = S3Archive(**s3_archive)
+        return _s3_archive
+
+
+def fetch_from_store(product, raw_data_path):
+    """
+    Links a product from the shared product store into raw_data_path, if the store has it
+
+    Returns
+    -------
+    str or None
+        The path of the linked product, or None if it is not in the store
+    """
+    store = get_product_store()
+    if store is None or product_downloaded(product, raw_data_path):
+        return None
+    fs_path = get_fpath(product, raw_data_path)
+    if not store.fetch(product.properties["title"], fs_path):
+        return None
+    declare_downloaded(product, raw_data_path, fs_path)
+    return fs_path
+
+
 def get_fpath(product, raw_data_path):
     """
     Given an eodag product object, returns the filepath of the file to be downloaded, mimics the naming of the file from EODAG
@@ -82,11 +276,13 @@ def get_fpath(product, raw_data_path):
     return fs_path
 
 
-def declare_downloaded(product, raw_data_path):
+def declare_downloaded(product, raw_data_path, fs_path=None, key=None):
     """
-    Declares a product as downloaded by creating a .done file in the raw data path directory.
-    The file name is the product's name + '.done', in the folder '.downloaded' relative to the original file
-    Will mimic EODAGs syntax, by using the hash of the original download link (which will be re-created)
+    Declares a product as downloaded by recording it in the project's state database,
+    with the original download link (as EODAG names its downloads by the link's hash),
+    the file's size and its checksum.
+    With a product store configured, the file is moved into the store and linked back,
+    unless it only holds some polarisations (so it cannot stand in for the product).
 
     Parameters
     ----------
@@ -94,38 +290,741 @@ def declare_downloaded(product, raw_data_path):
         an EODAG product object
     raw_data_path : str
         The directory where the raw data is stored
+    fs_path : str, optional
+        The downloaded file, if it differs from get_fpath(product, raw_data_path)
+    key : str, optional
+        "<algorithm>-<hexdigest>" of the file, if known, for the product store
 
     Returns
     -------
     None
     """
+    store = get_product_store()
+    fs_path = fs_path or get_fpath(product, raw_data_path)
+    if store is not None and not is_partial_zip(fs_path):
+        key = store.adopt(product.properties["title"], fs_path, key)
+    get_state_db(raw_data_path).mark_downloaded(
+        product.properties["title"], url=product.remote_location, raw_path=fs_path, checksum=key
+    )
+    return True
+
+
+def probe_range_support(url):
+    """
+    Checks whether a server honours HTTP range requests for a url
+
+    Parameters
+    ----------
+    url : str
+        The url of the file to check
+
+    Returns
+    -------
+    tuple of (int or None, bool, dict)
+        The total size of the file in bytes (None if unknown),
+        whether the server returned a partial response to a range request,
+        and the response headers
+    """
+    with http_transport.stream(url, headers={"Range": "bytes=0-0"}) as response:
+        response.raise_for_status()
+        content_range = response.headers.get("content-range", "")
+        if response.status_code == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[-1]
+            if total.isdigit():
+                return int(total), True, response.headers
+        # Server ignored the Range header and is sending the whole file
+        total = response.headers.get("content-length")
+        return (int(total) if total else None), False, response.headers
+
+
+class CorruptDownloadError(IOError):
+    """Raised when a downloaded file fails its checksum or structural checks"""
+
+
+def checksum_from_headers(headers):
+    """
+    Finds a checksum for a file in the headers of a HTTP response, if the server gave one
+
+    Looks at `Content-Digest` and `Digest` (sha-256 or md5), `Content-MD5`,
+    and a plain md5 `ETag` (as S3 and similar object stores give for single part uploads).
+
+    Parameters
+    ----------
+    headers : dict
+        The (case insensitive) response headers
+
+    Returns
+    -------
+    tuple of (str, str) or None
+        The hashlib algorithm name and the hex digest, or None if no checksum was found
+    """
+    algorithms = {"sha-256": "sha256", "sha-512": "sha512", "md5": "md5"}
+    for header in ("content-digest", "digest"):
+        for value in headers.get(header, "").split(","):
+            name, _, encoded = value.strip().partition("=")
+            name = name.strip().lower()
+            if name in algorithms and encoded:
+                try:
+                    digest = base64.b64decode(encoded.strip().strip(":")).hex()
+                except (ValueError, binascii.Error):
+                    continue
+                return algorithms[name], digest
+    if headers.get("content-md5"):
+        try:
+            return "md5", base64.b64decode(headers["content-md5"]).hex()
+        except (ValueError, binascii.Error):
+            pass
+    etag = headers.get("etag", "").strip('W/"')
+    if re.fullmatch("[0-9a-fA-F]{32}", etag):
+        return "md5", etag.lower()
+    return None
+
+
+# The hashlib algorithm of a hex digest of each length. Other digests are not verified.
+DIGEST_ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256"}
+
+
+def checksum_from_product(product):
+    """
+    Finds a checksum for a product in its catalogue properties, if the provider gave one.
+    The algorithm is told by the length of the hex digest, whatever the property is called.
 
-    download_records_dir = os.path.join(raw_data_path, ".downloaded")
+    Returns
+    -------
+    tuple of (str, str) or None
+        The hashlib algorithm name and the hex digest, or None if no checksum was found
+    """
+    properties = getattr(product, "properties", {}) or {}
+    for key in ("sha256", "md5", "checksum"):
+        value = properties.get(key)
+        if isinstance(value, str) and re.fullmatch("[0-9a-fA-F]+", value):
+            algorithm = DIGEST_ALGORITHMS.get(len(value))
+            if algorithm is not None:
+                return algorithm, value.lower()
+    return None
+
+
+class PrefixHasher:
+    """
+    Hashes a file as its leading bytes are completed, so the hash is ready when the download is.
+
+    Segments of a ranged download finish out of order. After each one finishes, `advance` hashes
+    any newly contiguous bytes from the start of the file. They were written moments before,
+    so they are read back from the page cache rather than the disk.
+    """
+
+    def __init__(self, fd, algorithm="md5"):
+        self.fd = fd
+        self.hash = hashlib.new(algorithm)
+        self.position = 0
+
+    def advance(self, upto, block_size=1024 * 1024):
+        """Hashes the file from the current position up to byte `upto`"""
+        while self.position < upto:
+            data = os.pread(self.fd, min(block_size, upto - self.position), self.position)
+            if not data:
+                break
+            self.hash.update(data)
+            self.position += len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def check_checksum(fs_path, expected, digest):
+    """Raises CorruptDownloadError if a digest does not match the expected (algorithm, digest)"""
+    if expected is None:
+        return
+    if digest != expected[1]:
+        raise CorruptDownloadError(
+            f"{expected[0]} checksum mismatch for {fs_path}: expected {expected[1]}, got {digest}"
+        )
+    log.info(f"{expected[0]} checksum verified for {fs_path}")
+    return
+
+
+def is_partial_zip(fs_path):
+    """Whether a zip was downloaded with only some of its polarisations (see remote_zip)"""
     try:
-        os.makedirs(download_records_dir)
-    except OSError as exc:
+        with zipfile.ZipFile(fs_path) as zf:
+            return is_partial(zf)
+    except (zipfile.BadZipFile, OSError):
+        return False
 
-        if exc.errno != errno.EEXIST:  # Skip error if dir exists
 
-            log.warning(
-                f"Unable to create records directory. Got:\n{tb.format_exc()}",
-            )
-    eodag_url = product.remote_location
-    url_hash = hashlib.md5(eodag_url.encode("utf-8")).hexdigest()
-    record_filename = os.path.join(download_records_dir, url_hash)
+def verify_safe_zip(fs_path, polarisations=None, bursts=None):
+    """
+    Quick structural check of a Sentinel-1 SAFE zip, without decompressing anything.
+
+    Reads the zip central directory and the (small) manifest.safe, and checks that the
+    manifest is present, that it lists at least one measurement TIFF, and that every file
+    it lists is in the zip with the size the manifest gives.
+    A zip downloaded with only some polarisations (see remote_zip) may leave out the
+    measurement TIFFs of the others, as long as it holds the `polarisations` needed.
+    A zip trimmed to some bursts (see insar_processing's burst_utils) must hold exactly `bursts`.
+
+    Parameters
+    ----------
+    fs_path : str
+        The path to the zip
+    polarisations : list of str, optional
+        The polarisations a zip downloaded with only some must hold (e.g. the
+        `thredds_polarisations` in the config). Such a zip is rejected if not given.
+    bursts : str, optional
+        The bursts a trimmed zip must hold, as its comment records them
+        (see remote_zip.zip_bursts). A trimmed zip is rejected if not given.
+
+    Raises
+    ------
+    CorruptDownloadError
+        If the zip is unreadable or incomplete
+    """
     try:
-        with open(record_filename, "w") as f:
-            f.writelines(eodag_url)
-    except OSError as e:
-        log.exception(
-            f"Unable to create file indicating download for {record_filename}. exception:"
+        with zipfile.ZipFile(fs_path) as zf:
+            members = {info.filename: info for info in zf.infolist()}
+            manifests = [name for name in members if name.endswith(".SAFE/manifest.safe")]
+            if len(manifests) != 1:
+                raise CorruptDownloadError(f"No single manifest.safe found in {fs_path}")
+            safe_dir = manifests[0][: -len("manifest.safe")]
+            manifest = ElementTree.fromstring(zf.read(manifests[0]))
+            held_polarisations = zip_polarisations(zf)
+            held_bursts = zip_bursts(zf)
+    except (zipfile.BadZipFile, ElementTree.ParseError, OSError, EOFError) as exc:
+        raise CorruptDownloadError(f"Unable to read {fs_path}: {exc}") from exc
+    if held_bursts is not None and held_bursts != bursts:
+        raise CorruptDownloadError(
+            f"{fs_path} only holds bursts {held_bursts}, {bursts or 'all bursts'} are needed"
         )
+    if held_polarisations is not None:
+        needed = [pol.upper() for pol in polarisations or []]
+        if not needed or not set(needed) <= set(held_polarisations):
+            raise CorruptDownloadError(
+                f"{fs_path} only holds polarisations {held_polarisations}, "
+                f"{needed or 'all polarisations'} are needed"
+            )
+
+    measurements = 0
+    for byte_stream in manifest.iter():
+        # Match on the local name, whatever namespace the manifest puts it in
+        if not byte_stream.tag.endswith("byteStream"):
+            continue
+        location = next((e for e in byte_stream if e.tag.endswith("fileLocation")), None)
+        if location is None:
+            continue
+        name = safe_dir + os.path.normpath(location.get("href", ""))
+        if held_polarisations is not None and measurement_polarisation(name) not in (
+            None,
+            *held_polarisations,
+        ):
+            # Left out of a partial download
+            continue
+        if name not in members:
+            raise CorruptDownloadError(f"{name} is listed in the manifest but not in {fs_path}")
+        size = byte_stream.get("size")
+        if size is not None and int(size) != members[name].file_size:
+            raise CorruptDownloadError(
+                f"{name} in {fs_path} is {members[name].file_size} bytes, manifest says {size}"
+            )
+        if "/measurement/" in name and name.endswith(".tiff"):
+            measurements += 1
+    if not measurements:
+        raise CorruptDownloadError(f"No measurement TIFFs found in {fs_path}")
+    return
+
+
+def remove_download(product, raw_data_path, fs_path=None):
+    """
+    Removes a downloaded product and its download record, so it will be downloaded again
+
+    Parameters
+    ----------
+    product : eodag.api.product.EOProduct
+        an EODAG product object
+    raw_data_path : str
+        The directory where the raw data is stored
+    fs_path : str, optional
+        The path of the downloaded file, if it differs from get_fpath(product, raw_data_path)
+
+    Returns
+    -------
+    None
+    """
+    get_state_db(raw_data_path).forget_download(
+        product.properties["title"], url=product.remote_location
+    )
+    fs_path = fs_path or get_fpath(product, raw_data_path)
+    try:
+        os.remove(fs_path)
+    except FileNotFoundError:
+        pass
+    return
+
+
+def link_from_mirror(product, fs_path, mirror_roots, verify_checksum=True, polarisations=None):
+    """
+    Looks for a product in local mirrors, and links a match to fs_path
+    (see product_store.link_file) so it does not need downloading.
+
+    A mirror copy is only used if its size matches the product's (when known), its checksum
+    matches the provider's (when given and `verify_checksum`) and it passes verify_safe_zip.
+
+    Parameters
+    ----------
+    product : eodag.api.product.EOProduct
+        an EODAG product object
+    fs_path : str
+        Where to link the product
+    mirror_roots : list of str
+        Directories searched (recursively) for the product's zip
+    verify_checksum : bool, optional
+        Hash the mirror copy to check it against the provider's checksum. Default is True.
+    polarisations : list of str, optional
+        Passed on to verify_safe_zip, so a mirror copy with only some polarisations is used
+        if it holds these
+
+    Returns
+    -------
+    bool
+        Whether a usable mirror copy was found and linked
+    """
+    title = product.properties["title"]
+    # The name this project would give it, and the names EODAG gives it
+    names = [os.path.basename(fs_path), f"{title}.zip", f"{sanitize(title)}.zip"]
+    size = product.properties.get("size")
+    size = size if isinstance(size, int) else None
+    src = find_in_mirrors(list(dict.fromkeys(names)), mirror_roots, expected_size=size)
+    if src is None:
+        return False
+
+    expected = checksum_from_product(product) if verify_checksum else None
+    if expected is not None:
+        file_hash = hashlib.new(expected[0])
+        with open(src, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        try:
+            check_checksum(src, expected, file_hash.hexdigest())
+        except CorruptDownloadError as exc:
+            log.warning(f"Not using mirror copy: {exc}")
+            return False
+
+    method = link_file(src, fs_path)
+    try:
+        verify_safe_zip(fs_path, polarisations=polarisations)
+    except CorruptDownloadError as exc:
+        log.warning(f"Not using mirror copy: {exc}")
+        os.remove(fs_path)
+        return False
+    log.info(f"Found {title} in a mirror, linked {src} to {fs_path} ({method})")
     return True
 
 
-def download_product_thredds(product, raw_data_path):
+def fetch_from_mirror(product, raw_data_path, mirror_roots, verify_checksum=True):
+    """
+    Links a product from local mirrors into raw_data_path, if one has a usable copy
+    (see link_from_mirror), and declares it downloaded
+
+    Parameters
+    ----------
+    product : eodag.api.product.EOProduct
+        an EODAG product object
+    raw_data_path : str
+        The directory where the raw data is stored
+    mirror_roots : list of str
+        Directories searched (recursively) for the product's zip
+    verify_checksum : bool, optional
+        Hash the mirror copy to check it against the provider's checksum. Default is True.
+
+    Returns
+    -------
+    str or None
+        The path of the linked product, or None if no usable mirror copy was found
+    """
+    if not mirror_roots or product_downloaded(product, raw_data_path):
+        return None
+    fs_path = get_fpath(product, raw_data_path)
+    if not link_from_mirror(
+        product, fs_path, mirror_roots, verify_checksum, polarisations=thredds_polarisations
+    ):
+        return None
+    declare_downloaded(product, raw_data_path)
+    return fs_path
+
+
+def split_ranges(total, segment_size, done=()):
+    """
+    Splits the bytes [0, total) that are not already in `done` into [start, end) ranges
+    of at most `segment_size` bytes
+
+    Parameters
+    ----------
+    total : int
+        The total number of bytes
+    segment_size : int
+        The maximum size of each range
+    done : list of [start, end), optional
+        Ranges which are already complete and should be skipped
+
+    Returns
+    -------
+    list of tuple
+        The [start, end) ranges still to fetch
+    """
+    segment_size = max(1, int(segment_size))
+    ranges = []
+    position = 0
+    for done_start, done_end in merge_ranges(done) + [(total, total)]:
+        for start in range(position, min(done_start, total), segment_size):
+            ranges.append((start, min(start + segment_size, done_start, total)))
+        position = max(position, done_end)
+    return ranges
+
+
+def merge_ranges(ranges):
+    """Sorts a list of [start, end) ranges and merges any that touch or overlap"""
+    merged = []
+    for start, end in sorted(tuple(r) for r in ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def checkpoint_path(part_path):
+    """The sidecar file recording which byte ranges of a .part file are complete"""
+    return f"{part_path}.json"
+
+
+def load_checkpoint(part_path, url, total):
+    """
+    Loads the completed byte ranges of a partial download
+
+    Parameters
+    ----------
+    part_path : str
+        The path of the .part file
+    url : str
+        The url being downloaded. A checkpoint for a different url is ignored.
+    total : int
+        The total size of the file. A checkpoint for a different size is ignored.
+
+    Returns
+    -------
+    list of tuple
+        The completed [start, end) ranges, empty if there is nothing to resume from
+    """
+    sidecar = checkpoint_path(part_path)
+    if not (os.path.isfile(part_path) and os.path.isfile(sidecar)):
+        return []
+    try:
+        with open(sidecar, "r") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        log.warning(f"Unreadable download checkpoint {sidecar}, starting again")
+        return []
+    if checkpoint.get("url") != url or checkpoint.get("total") != total:
+        log.info(f"Download checkpoint {sidecar} is for a different file, starting again")
+        return []
+    if os.path.getsize(part_path) != total:
+        return []
+    return merge_ranges(checkpoint.get("done", []))
+
+
+def save_checkpoint(part_path, url, total, done):
+    """Atomically records the completed byte ranges of a partial download in its sidecar"""
+    sidecar = checkpoint_path(part_path)
+    tmp_sidecar = f"{sidecar}.tmp"
+    with open(tmp_sidecar, "w") as f:
+        json.dump({"url": url, "total": total, "done": merge_ranges(done)}, f)
+    os.replace(tmp_sidecar, sidecar)
+    return
+
+
+def finalise_download(part_path, fs_path):
+    """Flushes a completed .part file to disk, renames it into place and removes its checkpoint"""
+    fd = os.open(part_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(part_path, fs_path)
+    try:
+        os.remove(checkpoint_path(part_path))
+    except FileNotFoundError:
+        pass
+    return
+
+
+def fetch_range(url, start, end, fd, progress_callback=None, progress_lock=None):
+    """
+    Fetches bytes [start, end) of a url, and writes them at the same offset of an open file
+
+    Parameters
+    ----------
+    url : str
+        The url to fetch from
+    start, end : int
+        The byte range to fetch, end is exclusive
+    fd : int
+        An os level file descriptor, opened for writing, to write the bytes into
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Updated with the number of bytes written
+    progress_lock : threading.Lock, optional
+        Lock to hold while updating the progress callback from several threads
+
+    Returns
+    -------
+    None
+    """
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    with http_transport.stream(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server did not honour range request {headers['Range']} for {url}")
+        offset = start
+        for chunk in http_transport.iter_content(response, chunk_size=64 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            if progress_callback is not None:
+                with progress_lock:
+                    progress_callback.update(len(chunk))
+    if offset != end:
+        raise IOError(f"Range {start}-{end - 1} of {url} ended early, at byte {offset}")
+    return
+
+
+def download_url_single_stream(url, fs_path, progress_callback=None, checksum=None):
+    """
+    Downloads a url over a single connection. Used when the server does not support ranges,
+    so the download cannot be resumed and starts from zero every time.
+    The bytes are hashed as they arrive, and checked against `checksum` or the response headers.
+    """
+    part_path = f"{fs_path}.part"
+    with http_transport.stream(url) as stream, open(part_path, "wb") as fhandle:
+        stream.raise_for_status()
+        total = int(stream.headers.get("content-length", 0))
+        expected = checksum or checksum_from_headers(stream.headers)
+        file_hash = hashlib.new(expected[0] if expected else "md5")
+        if progress_callback is not None:
+            progress_callback.reset(total=total)
+        for chunk in http_transport.iter_content(stream, chunk_size=64 * 1024):
+            size = fhandle.write(chunk)
+            file_hash.update(chunk)
+            if progress_callback is not None:
+                progress_callback.update(size)
+    if total and os.path.getsize(part_path) != total:
+        raise IOError(
+            f"Download of {url} ended early, got {os.path.getsize(part_path)}/{total} bytes"
+        )
+    try:
+        check_checksum(fs_path, expected, file_hash.hexdigest())
+    except CorruptDownloadError:
+        os.remove(part_path)
+        raise
+    finalise_download(part_path, fs_path)
+    return file_hash.name, file_hash.hexdigest()
+
+
+def download_url(
+    url,
+    fs_path,
+    num_connections=4,
+    segment_size=64 * 1024 * 1024,
+    progress_callback=None,
+    checksum=None,
+):
+    """
+    Downloads a url into fs_path over several connections at once, resuming any earlier attempt.
+
+    The file is split into byte ranges of `segment_size`, which are fetched by `num_connections`
+    threads and written at their offsets into a preallocated `<fs_path>.part` file.
+    Completed ranges are recorded in a `<fs_path>.part.json` sidecar, so a rerun only fetches
+    what is missing. Once every range is complete the .part file is renamed to fs_path,
+    so fs_path never holds a truncated file.
+    Falls back to a single, non-resumable, stream when the server ignores `Range` requests.
+
+    The file is hashed while it downloads, and checked against `checksum` if given, or else
+    against any checksum in the server's response headers. On a mismatch the partial download
+    is removed and CorruptDownloadError is raised.
+
+    Parameters
+    ----------
+    url : str
+        The url to download
+    fs_path : str
+        The path to save the file to
+    num_connections : int, optional
+        The number of connections to download over at once. Default is 4.
+    segment_size : int, optional
+        The size in bytes of each range request. Default is 64 MiB.
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Progress bar to update as bytes arrive
+    checksum : tuple of (str, str), optional
+        The expected (hashlib algorithm, hex digest) of the file, e.g. from the catalogue
+
+    Returns
+    -------
+    tuple of (str, str)
+        The algorithm and hex digest of the downloaded file
+    """
+    total, accepts_ranges, headers = probe_range_support(url)
+    if not (accepts_ranges and total):
+        log.info(f"Server does not support range requests for {url}, using a single stream")
+        return download_url_single_stream(
+            url, fs_path, progress_callback=progress_callback, checksum=checksum
+        )
+    return download_ranges(
+        url,
+        total,
+        lambda start, end, fd, callback, lock: fetch_range(url, start, end, fd, callback, lock),
+        fs_path,
+        num_connections=num_connections,
+        segment_size=segment_size,
+        progress_callback=progress_callback,
+        checksum=checksum or checksum_from_headers(headers),
+    )
+
+
+def download_ranges(
+    source,
+    total,
+    fetch,
+    fs_path,
+    num_connections=4,
+    segment_size=64 * 1024 * 1024,
+    progress_callback=None,
+    checksum=None,
+):
+    """
+    Downloads a file of known size as byte ranges fetched in parallel, resuming any earlier
+    attempt (see download_url). Shared by the HTTP and S3 downloads.
+
+    Parameters
+    ----------
+    source : str
+        The url (or s3:// uri) of the file, recorded in the checkpoint
+    total : int
+        The size of the file in bytes
+    fetch : callable
+        fetch(start, end, fd, progress_callback, progress_lock) writes the bytes [start, end)
+        of the file at the same offset of the open file descriptor fd
+    fs_path : str
+        The path to save the file to
+    num_connections : int, optional
+        The number of ranges fetched at once. Default is 4.
+    segment_size : int, optional
+        The size in bytes of each range. Default is 64 MiB.
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Progress bar to update as bytes arrive
+    checksum : tuple of (str, str), optional
+        The expected (hashlib algorithm, hex digest) of the file
+
+    Returns
+    -------
+    tuple of (str, str)
+        The algorithm and hex digest of the downloaded file
+    """
+    part_path = f"{fs_path}.part"
+    done = load_checkpoint(part_path, source, total)
+    ranges = split_ranges(total, segment_size, done=done)
+    done_bytes = sum(end - start for start, end in done)
+    if done_bytes:
+        log.info(f"Resuming download of {source} with {done_bytes}/{total} bytes already complete")
+    log.info(f"Downloading {source} as {len(ranges)} segments over {num_connections} connections")
+    if progress_callback is not None:
+        progress_callback.reset(total=total)
+        progress_callback.update(done_bytes)
+    progress_lock = threading.Lock()
+
+    flags = os.O_WRONLY | os.O_CREAT | (0 if done else os.O_TRUNC)
+    fd = os.open(part_path, flags, 0o644)
+    try:
+        # Preallocate so each segment can be written at its offset
+        os.ftruncate(fd, total)
+        save_checkpoint(part_path, source, total, done)
+        hasher = PrefixHasher(fd, checksum[0] if checksum else "md5")
+        merged = merge_ranges(done)
+        hasher.advance(merged[0][1] if merged and merged[0][0] == 0 else 0)
+        with ThreadPoolExecutor(max_workers=max(1, num_connections)) as executor:
+            futures = {
+                executor.submit(
+                    fetch, start, end, fd, progress_callback, progress_lock
+                ): (start, end)
+                for start, end in ranges
+            }
+            try:
+                for future in as_completed(futures):
+                    # Re-raises the first failed segment
+                    future.result()
+                    # The segment is on disk before it is recorded as done
+                    os.fdatasync(fd)
+                    done.append(futures[future])
+                    save_checkpoint(part_path, source, total, done)
+                    merged = merge_ranges(done)
+                    if merged[0][0] == 0:
+                        hasher.advance(merged[0][1])
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        hasher.advance(total)
+    finally:
+        os.close(fd)
+
+    try:
+        check_checksum(fs_path, checksum, hasher.hexdigest())
+    except CorruptDownloadError:
+        os.remove(part_path)
+        os.remove(checkpoint_path(part_path))
+        raise
+    finalise_download(part_path, fs_path)
+    return hasher.hash.name, hasher.hexdigest()
+
+
+def download_thredds_polarisations(url, fs_path, progress_callback=None):
+    """
+    Downloads only the `thredds_polarisations` of a THREDDS zip, with range requests
+    (see remote_zip.download_polarisations)
+
+    Returns
+    -------
+    bool
+        True if the zip was downloaded, False if it should be downloaded whole: the server
+        does not support ranges, or the product has no other polarisations to leave out
+    """
+    total, accepts_ranges, _ = probe_range_support(url)
+    if not (accepts_ranges and total):
+        return False
+    size = download_polarisations(
+        url,
+        fs_path,
+        total,
+        thredds_polarisations,
+        num_connections=thredds_download_connections,
+        progress_callback=progress_callback,
+    )
+    return size is not None
+
+
+def thredds_url(product):
+    """The url of a product's zip on NCI's THREDDS server"""
+    # Products from the THREDDS index know their url, otherwise it is made from the quicklook
+    url = product.properties.get("thredds_url")
+    if url:
+        return url
+    thredds_base_url = "https://dapds00.nci.org.au/thredds/fileServer/fj7/Copernicus/"
+    return (
+        "/".join([thredds_base_url, *product.properties["quicklook"].split("/")[4:]])[:-4]
+        + ".zip"
+    )
+
+
+def download_product_thredds(product, raw_data_path, progress_callback=None):
     """
-    A custom downloader for when download_from_thredds=True. Will check if a file has already been downloaded
+    A custom downloader for when download_from_thredds=True. Will check if a file has already been downloaded.
+    The download is checked against any checksum the provider gives, and its zip structure is
+    checked, before it is declared downloaded. Raises CorruptDownloadError if either check fails.
 
     Parameters
     ----------
@@ -133,6 +1032,8 @@ def download_product_thredds(product, raw_data_path):
         an EODAG product object
     raw_data_path : str
         The path to the directory where the downloaded product will be saved.
+    progress_callback : ProgressCallback, optional
+        The progress bar to update. By default a new bar is made for the product.
 
     Returns
     -------
@@ -143,21 +1044,94 @@ def download_product_thredds(product, raw_data_path):
     if product_downloaded(product, raw_data_path):
         log.info(f"Product already downloaded: {fs_path}")
         return fs_path
+    if fetch_from_store(product, raw_data_path):
+        return fs_path
 
-    thredds_base_url = "https://dapds00.nci.org.au/thredds/fileServer/fj7/Copernicus/"
-    threds_url = (
-        "/".join([thredds_base_url, *product.properties["quicklook"].split("/")[4:]])[:-4] + ".zip"
+    threds_url = thredds_url(product)
+    if progress_callback is None:
+        progress_callback = ProgressCallback(mininterval=0.1)
+        progress_callback.desc = str(product.properties.get("id", ""))
+    if thredds_polarisations and download_thredds_polarisations(
+        threds_url, fs_path, progress_callback
+    ):
+        # Only some members were fetched, so there is no checksum to check the zip against
+        try:
+            verify_safe_zip(fs_path, polarisations=thredds_polarisations)
+        except CorruptDownloadError:
+            remove_download(product, raw_data_path, fs_path)
+            raise
+        declare_downloaded(product, raw_data_path, fs_path)
+        return fs_path
+    digest = download_url(
+        threds_url,
+        fs_path,
+        num_connections=thredds_download_connections,
+        segment_size=int(thredds_segment_size_mb * 1024 * 1024),
+        progress_callback=progress_callback,
+        checksum=checksum_from_product(product),
     )
-    progress_callback = ProgressCallback(mininterval=0.1)
-    progress_callback.desc = str(product.properties.get("id", ""))
-    stream = requests.get(threds_url, stream=True)
-    total = int(stream.headers["content-length"])
-    progress_callback.reset(total=total)
-    with open(fs_path, "wb") as fhandle:
-        for chunk in stream.iter_content(chunk_size=64 * 1024):
-            size = fhandle.write(chunk)
-            progress_callback.update(size)
-    declare_downloaded(product, raw_data_path)
+    # Only declare the product downloaded once it is known to be whole
+    try:
+        verify_safe_zip(fs_path, polarisations=thredds_polarisations)
+    except CorruptDownloadError:
+        remove_download(product, raw_data_path, fs_path)
+        raise
+    declare_downloaded(product, raw_data_path, fs_path, key="-".join(digest) if digest else None)
+    return fs_path
+
+
+def download_product_s3(product, raw_data_path, progress_callback=None):
+    """
+    Downloads a product from the S3 archive configured by `s3_archive`, as ranged GETs of
+    `part_size_mb` fetched `max_concurrency` at a time. Resumes an earlier attempt, checks the
+    download like download_product_thredds, and records it with declare_downloaded.
+
+    Parameters
+    ----------
+    product : eodag.api.product.EOProduct
+        an EODAG product object
+    raw_data_path : str
+        The path to the directory where the downloaded product will be saved.
+    progress_callback : ProgressCallback, optional
+        The progress bar to update.
+
+    Returns
+    -------
+    str or None
+        The path of the downloaded product, or None if it is not in the archive
+    """
+    fs_path = get_fpath(product, raw_data_path)
+    if product_downloaded(product, raw_data_path):
+        log.info(f"Product already downloaded: {fs_path}")
+        return fs_path
+    if fetch_from_store(product, raw_data_path):
+        return fs_path
+
+    archive = get_s3_archive()
+    key = archive.key(product)
+    head = archive.head(key)
+    if head is None:
+        log.info(f"{product.properties['title']} is not in {archive.uri(key)}")
+        return None
+    total, etag_checksum = head
+    digest = download_ranges(
+        archive.uri(key),
+        total,
+        lambda start, end, fd, callback, lock: archive.fetch_range(
+            key, start, end, fd, callback, lock
+        ),
+        fs_path,
+        num_connections=archive.max_concurrency,
+        segment_size=archive.part_size,
+        progress_callback=progress_callback,
+        checksum=checksum_from_product(product) or etag_checksum,
+    )
+    try:
+        verify_safe_zip(fs_path, polarisations=thredds_polarisations)
+    except CorruptDownloadError:
+        remove_download(product, raw_data_path, fs_path)
+        raise
+    declare_downloaded(product, raw_data_path, fs_path, key="-".join(digest))
     return fs_path
 
 
@@ -178,9 +1152,11 @@ def product_downloaded(product, raw_data_path):
         Whether or not the product has already been downloaded
     """
 
-    eodag_url = product.remote_location
-    url_hash = hashlib.md5(eodag_url.encode("utf-8")).hexdigest()
-    return os.path.isfile(join(raw_data_path, ".downloaded", url_hash))
+    record_exists = get_state_db(raw_data_path).is_downloaded(
+        product.properties["title"], url=product.remote_location
+    )
+    # Downloads are renamed into place once complete, so the file existing means it is whole
+    return record_exists and os.path.isfile(get_fpath(product, raw_data_path))
 
 
 if __name__ == "__main__":
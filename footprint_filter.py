@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Description: Drops search results which only clip the area of interest (AOI), before they
+             are downloaded. The search itself is by bounding box, so it also returns products
+             overlapping the AOI's box by a sliver, which would cost a full download and SNAP
+             run only to be rejected in the container.
+             Each product's catalogue footprint is intersected with the real AOI polygon
+             (a shapely prepared geometry), and the overlap is recorded in its properties.
+"""
+import json
+import logging
+import math
+from pathlib import Path
+
+from shapely import wkt
+from shapely.geometry import Polygon, box, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+log = logging.getLogger(__name__)
+
+# km per degree of latitude
+KM_PER_DEGREE = 111.32
+
+
+def load_aoi(aoi):
+    """
+    Makes a shapely geometry for an AOI given as any of:
+    a list of [lon, lat] coordinates, a WKT string, or the path of a GeoJSON or other vector
+    file (read with GDAL's ogr). Returns None if aoi is None.
+    """
+    if aoi is None:
+        return None
+    if isinstance(aoi, (list, tuple)):
+        return Polygon(aoi)
+    aoi = str(aoi)
+    path = Path(aoi).expanduser()
+    if not path.is_file():
+        return wkt.loads(aoi)
+    if path.suffix.lower() in (".geojson", ".json"):
+        with open(path, "r") as f:
+            data = json.load(f)
+        features = data.get("features", [data])
+        return unary_union([shape(feature.get("geometry", feature)) for feature in features])
+
+    from osgeo import ogr
+
+    data_source = ogr.Open(path.as_posix())
+    if data_source is None:
+        raise ValueError(f"Unable to read the AOI file {path}")
+    layer = data_source.GetLayer()
+    geometries = [wkt.loads(feature.GetGeometryRef().ExportToWkt()) for feature in layer]
+    data_source = None
+    return unary_union(geometries)
+
+
+def area_km2(geometry):
+    """Approximate area in km2 of a lon/lat geometry, scaled at its centroid's latitude"""
+    if geometry.is_empty:
+        return 0.0
+    scale = KM_PER_DEGREE**2 * math.cos(math.radians(geometry.centroid.y))
+    return geometry.area * scale
+
+
+def product_footprint(product):
+    """
+    The footprint of a search result: its EODAG geometry, or the [lonmin, latmin, lonmax,
+    latmax] "footprint" property of products from the THREDDS index. None if it has neither.
+    """
+    geometry = getattr(product, "geometry", None)
+    if geometry is not None:
+        return geometry
+    footprint = product.properties.get("footprint")
+    if footprint is not None:
+        return box(*footprint)
+    return None
+
+
+class FootprintFilter:
+    """
+    Records the overlap of products with an AOI, and drops those overlapping too little.
+
+    Parameters
+    ----------
+    aoi : shapely geometry
+        The area of interest, in lon/lat
+    min_overlap_fraction : float, optional
+        The smallest fraction of the AOI a product must cover to be kept. Default is 0.
+    min_overlap_km2 : float, optional
+        The smallest area (km2) of AOI a product must cover to be kept. Default is 0.
+    """
+
+    def __init__(self, aoi, min_overlap_fraction=0.0, min_overlap_km2=0.0):
+        self.aoi = aoi
+        self.prepared_aoi = prep(aoi)
+        self.aoi_area_km2 = area_km2(aoi)
+        self.min_overlap_fraction = min_overlap_fraction or 0.0
+        self.min_overlap_km2 = min_overlap_km2 or 0.0
+        self.kept = 0
+        self.dropped = 0
+
+    def overlap(self, footprint):
+        """The (fraction of the AOI, km2) covered by a footprint"""
+        if not self.prepared_aoi.intersects(footprint):
+            return 0.0, 0.0
+        if self.prepared_aoi.within(footprint):
+            return 1.0, self.aoi_area_km2
+        overlap_km2 = area_km2(self.aoi.intersection(footprint))
+        fraction = overlap_km2 / self.aoi_area_km2 if self.aoi_area_km2 else 0.0
+        return fraction, overlap_km2
+
+    def annotate(self, product):
+        """Records the product's overlap with the AOI in its properties, and returns it"""
+        footprint = product_footprint(product)
+        if footprint is None:
+            return product
+        fraction, overlap_km2 = self.overlap(footprint)
+        product.properties["aoi_overlap_fraction"] = round(fraction, 6)
+        product.properties["aoi_overlap_km2"] = round(overlap_km2, 3)
+        return product
+
+    def keep(self, product):
+        """Whether an annotated product overlaps the AOI enough to be downloaded"""
+        fraction = product.properties.get("aoi_overlap_fraction")
+        if fraction is None:
+            # No footprint, so there is nothing to judge it by
+            self.kept += 1
+            return True
+        overlap_km2 = product.properties.get("aoi_overlap_km2", 0.0)
+        if fraction <= 0 or fraction < self.min_overlap_fraction or (
+            overlap_km2 < self.min_overlap_km2
+        ):
+            self.dropped += 1
+            log.info(
+                f"Skipping {product.properties['title']}, it covers {fraction:.1%} "
+                f"({overlap_km2:.1f} km2) of the AOI"
+            )
+            return False
+        self.kept += 1
+        return True
+
+    def filter(self, products):
+        """Yields the (annotated) products overlapping the AOI enough"""
+        for product in products:
+            if self.keep(product):
+                yield product
+        log.info(
+            f"Footprint prefilter kept {self.kept} products and skipped {self.dropped} "
+            f"overlapping the AOI too little"
+        )
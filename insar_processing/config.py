@@ -65,7 +65,8 @@ processing = "ELEVATION"
 
 # SNAPHU Parameters
 init_method = "MCF"
-num_processors = 8
+# None uses the CPUs available, within any cgroup limit (see snappy_processing/resource_tuner.py)
+num_processors = None
 row_overlap = 200
 col_overlap = 200
 
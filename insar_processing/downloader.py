@@ -14,6 +14,8 @@ import logging
 import os
 import re
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import getpass
@@ -23,7 +25,24 @@ from eodag.utils.exceptions import AuthenticationError
 
 from config import log_fname, work_dir, search_criteria
 from src.downloader_config import download_from_thredds, del_intermediate
-from src.downloader_utils import download_product_thredds
+from src.downloader_config import num_download_workers, max_downloads_per_provider
+from src.downloader_config import thredds_download_connections
+from src.downloader_config import http_timeout, http_max_retries
+from src.downloader_config import http_backoff_seconds, http_backoff_max_seconds
+from src.downloader_config import http_host_limits, http_default_limits
+from src.downloader_utils import download_product_thredds, fetch_from_mirror, fetch_from_store
+from src.downloader_utils import declare_downloaded, get_state_db
+from src.downloader_utils import AggregateProgress, ProductProgressCallback, ProviderLimits
+from src.downloader_utils import http_transport, state_db
+from src.downloader_config import search_cache_dir, search_cache_ttl_hours, search_sharding
+from src.downloader_config import thredds_index_options
+from src.downloader_config import local_mirror_roots, verify_mirror_checksums
+from src.downloader_config import aoi, min_aoi_overlap_fraction, min_aoi_overlap_km2
+from src.downloader_config import deduplication
+from dedup import Deduplicator
+from footprint_filter import FootprintFilter, load_aoi
+from search_cache import cached_search
+from thredds_index import search_index
 
 Path(log_fname).parent.mkdir(exist_ok=True)
 
@@ -103,7 +122,7 @@ def check_file_processed(
     fname, final_data_path="./data/data_processed/", zip_file_given=False
 ):
     """
-    Check if a file has already been processed.
+    Check if a file has already been processed, from the project's state database.
 
     Parameters
     ----------
@@ -125,18 +144,19 @@ def check_file_processed(
     fname = Path(fname).name
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = Path(final_data_path, ".processed")
-    file_suffix = ".done"
-    meta_file_exists = Path(meta_dir, fname + file_suffix).is_file()
-    og_file_exists = Path(final_data_path, fname).is_file()
-    return bool(meta_file_exists and og_file_exists)
+    state = get_state_db(final_data_path)
+    if fname.endswith("_cog.tif"):
+        output_path = state.cog_path(state_db.product_title(fname))
+    else:
+        output_path = state.processed_path(state_db.product_title(fname))
+    return output_path is not None and Path(output_path).is_file()
 
 
 def create_proc_metadata(
     fname, final_data_path="./data/data_processed/", zip_file_given=False
 ):
     """
-    Creates metadata that the file has been processed for future use in '.processed'.
+    Records in the project's state database that the file has been processed, for future use.
 
     Parameters
     ----------
@@ -157,13 +177,24 @@ def create_proc_metadata(
     fname = Path(fname).name
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = Path(final_data_path, ".processed")
-    Path(meta_dir, f"{fname}.done").touch()
+    state = get_state_db(final_data_path)
+    output_path = str(Path(final_data_path, fname))
+    if fname.endswith("_cog.tif"):
+        state.mark_cog(state_db.product_title(fname), output_path)
+    else:
+        state.mark_processed(state_db.product_title(fname), output_path)
     return
 
 
 def download_and_process_product(
-    product, data_directory, del_intermediate=True, download_from_thredds=False
+    product,
+    data_directory,
+    del_intermediate=True,
+    download_from_thredds=False,
+    provider_limits=None,
+    progress=None,
+    mirror_roots=None,
+    verify_mirror_checksums=True,
 ):
     """
     Downloads and processes a Sentinel-1 product from an EODAG product
@@ -178,11 +209,21 @@ def download_and_process_product(
         Whether to delete intermediate files after processing. Default is True.
     download_from_thredds : bool
         Whether to download the product from THREDDS instead of from EODAG. Default is False.
+    provider_limits : src.downloader_utils.ProviderLimits, optional
+        Shared limits on concurrent downloads per provider
+    progress : src.downloader_utils.AggregateProgress, optional
+        Shared progress of all downloads
+    mirror_roots : list of str, optional
+        Local directories to look for the product in before downloading it
+    verify_mirror_checksums : bool
+        Whether a mirror copy is checked against the provider's checksum. Default is True.
 
     Returns
     -------
     None
     """
+    provider_limits = provider_limits or ProviderLimits({})
+    progress = progress or AggregateProgress()
     raw_data_path = Path(data_directory, 'data_raw')
     final_data_path = Path(data_directory, "data_processed")
     # --------------------------------
@@ -192,10 +233,40 @@ def download_and_process_product(
     # NCI's THREDDS dataserver is a publicly accessible data repository
     # It does not need authentication. The top-level repo is here:
     # https://dapds00.nci.org.au/thredds/catalog.html
-    if download_from_thredds:
-        fname = download_product_thredds(product, raw_data_path)
-    else:
-        fname = product.download(extract=False)
+    # A copy in the shared product store or a local mirror saves the download altogether
+    fname = fetch_from_store(product, raw_data_path) or fetch_from_mirror(
+        product, raw_data_path, mirror_roots, verify_mirror_checksums
+    )
+    if fname is None:
+        provider = "thredds" if download_from_thredds else getattr(product, "provider", "unknown")
+        with provider_limits.slot(provider):
+            progress.started()
+            # EODAG makes its own requests, so it is governed by the host of its download link
+            eodag_url = None if download_from_thredds else product.properties.get("downloadLink")
+            # Individual bars are hidden when several downloads share the terminal
+            progress_callback = ProductProgressCallback(
+                progress, mininterval=0.1, disable=progress.quiet_bars, throttle_url=eodag_url
+            )
+            progress_callback.desc = str(product.properties.get("id", ""))
+            try:
+                if download_from_thredds:
+                    fname = download_product_thredds(
+                        product, raw_data_path, progress_callback=progress_callback
+                    )
+                elif not eodag_url:
+                    fname = product.download(extract=False, progress_callback=progress_callback)
+                else:
+                    with http_transport.connection(eodag_url):
+                        http_transport.before_request(eodag_url)
+                        fname = product.download(
+                            extract=False, progress_callback=progress_callback
+                        )
+                if not download_from_thredds:
+                    # Records the download, and moves it into the product store if there is one
+                    declare_downloaded(product, raw_data_path, fname)
+            finally:
+                progress_callback.close()
+                progress.stopped()
 
     fpath_proc = Path(final_data_path, f'{(Path(fname).name)[:-4]}"_processed.tif')
     cog_fname = re.sub("(.tif)$", "_cog.tif", str(fpath_proc))
@@ -206,7 +277,24 @@ def download_and_process_product(
     return
 
 
-def run_all(download_from_thredds, data_directory, search_criteria, del_intermediate):
+def run_all(
+    download_from_thredds,
+    data_directory,
+    search_criteria,
+    del_intermediate,
+    num_download_workers=1,
+    max_downloads_per_provider=None,
+    search_cache_dir=".search_cache",
+    search_cache_ttl_hours=24,
+    search_sharding=None,
+    thredds_index_options=None,
+    local_mirror_roots=None,
+    verify_mirror_checksums=True,
+    aoi=None,
+    min_aoi_overlap_fraction=0,
+    min_aoi_overlap_km2=0,
+    deduplication=None,
+):
     """
     Function to be called from main.
     It retrieves products from EODAG with given search criteria and bounds,
@@ -224,6 +312,35 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
         dictionary of key-value pairs for filtering the search results
     del_intermediate (bool)
         flag to delete intermediate files (eg the raw output of snappy when computed the cog)
+    num_download_workers (int)
+        number of products downloaded at once
+    max_downloads_per_provider (Dict)
+        maximum concurrent downloads from each provider, e.g. {"sara": 2, "thredds": 4}
+    search_cache_dir (str)
+        directory (relative to data_directory) where search results are cached
+    search_cache_ttl_hours (float)
+        how long cached search results are reused for, 0 to always search again
+    search_sharding (Dict)
+        options for splitting the search into parallel date windows (see search_cache),
+        or None to search page by page
+    thredds_index_options (Dict)
+        options for finding products in the THREDDS index (see thredds_index.search_index)
+        when downloading from THREDDS, or None to search with EODAG
+    local_mirror_roots (List)
+        local directories searched for a product before it is downloaded
+    verify_mirror_checksums (bool)
+        check mirror copies against the provider's checksum (when there is one)
+    aoi (List or str)
+        the area of interest (see footprint_filter.load_aoi). Products overlapping it less than
+        min_aoi_overlap_fraction (of the aoi) or min_aoi_overlap_km2 are not downloaded.
+        None downloads every product found.
+    min_aoi_overlap_fraction (float)
+        smallest fraction of the aoi a product must cover
+    min_aoi_overlap_km2 (float)
+        smallest area of the aoi (km2) a product must cover
+    deduplication (Dict)
+        options for keeping one product per acquisition (see dedup.Deduplicator),
+        or None to download every version found
 
     Returns:
     ----------
@@ -231,6 +348,10 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
     """
     raw_data_path = Path(data_directory, 'data_raw')
     raw_data_path.mkdir(exist_ok=True)
+    # Marker files left by earlier versions are imported into the state database, once
+    get_state_db(raw_data_path).import_markers(
+        raw_data_path, Path(data_directory, "data_processed")
+    )
 
     os.environ["EODAG__SARA__DOWNLOAD__OUTPUTS_PREFIX"] = str(raw_data_path)
 
@@ -244,24 +365,52 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
 
     setup_logging(verbose=2)
 
-    dag = EODataAccessGateway()
+    footprint_filter = None
+    if aoi is not None:
+        footprint_filter = FootprintFilter(
+            load_aoi(aoi),
+            min_overlap_fraction=min_aoi_overlap_fraction,
+            min_overlap_km2=min_aoi_overlap_km2,
+        )
 
-    dag.set_preferred_provider("sara")
+    if download_from_thredds and thredds_index_options is not None:
+        # The THREDDS index knows each product's url, so EODAG is not needed at all
+        index_options = dict(thredds_index_options)
+        index_dir = index_options.pop("index_dir", ".thredds_index")
+        search_products = search_index(
+            search_criteria, index_dir=Path(data_directory, index_dir), **index_options
+        )
+        if footprint_filter is not None:
+            search_products = map(footprint_filter.annotate, search_products)
+    else:
+        dag = EODataAccessGateway()
+
+        dag.set_preferred_provider("sara")
+
+        # Products are streamed from the search (or its cache) as each page arrives
+        search_products = cached_search(
+            dag,
+            search_criteria,
+            cache_dir=Path(data_directory, search_cache_dir),
+            ttl_hours=search_cache_ttl_hours,
+            annotate=footprint_filter.annotate if footprint_filter is not None else None,
+            **(search_sharding or {}),
+        )
+    if footprint_filter is not None:
+        # Products only clipping the AOI are dropped before anything is downloaded
+        search_products = footprint_filter.filter(search_products)
+    if deduplication is not None:
+        # Reprocessed versions of an acquisition, or copies at other providers, are skipped
+        search_products = Deduplicator(**deduplication).filter(search_products)
 
-    search_products = dag.search_all(
-        **search_criteria
-    )  # This should log the number of search products
+    provider_limits = ProviderLimits(max_downloads_per_provider)
+    progress = AggregateProgress(quiet_bars=num_download_workers > 1)
 
-    for product in search_products:
+    def handle_result(product, future):
         log.info("=" * 60)
         log.info(f"Now processing file {product.properties['title']}")
         try:
-            download_and_process_product(
-                product,
-                data_directory=data_directory,
-                del_intermediate=del_intermediate,
-                download_from_thredds=download_from_thredds,
-            )
+            future.result()
         except AuthenticationError as e:
             log.error("=" * 60)
             log.error("***AUTHENTICATION ERROR***")
@@ -282,6 +431,30 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
             log.error("=" * 60)
             log.error("Continuing...")
 
+    # Downloads run K at a time, but their results are handled in search order.
+    # Only a couple of products per worker are queued ahead, so memory stays flat.
+    num_download_workers = max(1, int(num_download_workers))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_download_workers) as executor:
+        for product in search_products:
+            future = executor.submit(
+                download_and_process_product,
+                product,
+                data_directory=data_directory,
+                del_intermediate=del_intermediate,
+                download_from_thredds=download_from_thredds,
+                provider_limits=provider_limits,
+                progress=progress,
+                mirror_roots=local_mirror_roots,
+                verify_mirror_checksums=verify_mirror_checksums,
+            )
+            pending.append((product, future))
+            if len(pending) > 2 * num_download_workers:
+                handle_result(*pending.popleft())
+        while pending:
+            handle_result(*pending.popleft())
+    progress.log()
+
 
 def main():
     log.info(
@@ -290,12 +463,35 @@ def main():
     )
     log.info("New program run:")
     log.info("=" * 60)
+    # Enough pooled connections for every ranged THREDDS download at once
+    http_transport.configure(
+        timeout=http_timeout,
+        max_retries=http_max_retries,
+        backoff_base=http_backoff_seconds,
+        backoff_max=http_backoff_max_seconds,
+        pool_size=max(16, num_download_workers * thredds_download_connections),
+        host_limits=http_host_limits,
+        default_limits=http_default_limits,
+    )
     run_all(
         download_from_thredds=download_from_thredds,
         data_directory=work_dir,
         search_criteria=search_criteria,
         del_intermediate=del_intermediate,
+        num_download_workers=num_download_workers,
+        max_downloads_per_provider=max_downloads_per_provider,
+        search_cache_dir=search_cache_dir,
+        search_cache_ttl_hours=search_cache_ttl_hours,
+        search_sharding=search_sharding,
+        thredds_index_options=thredds_index_options,
+        local_mirror_roots=local_mirror_roots,
+        verify_mirror_checksums=verify_mirror_checksums,
+        aoi=aoi,
+        min_aoi_overlap_fraction=min_aoi_overlap_fraction,
+        min_aoi_overlap_km2=min_aoi_overlap_km2,
+        deduplication=deduplication,
     )
+    http_transport.log_stats()
 
 
 if __name__ == "__main__":
@@ -5,11 +5,22 @@ User Configurable parameters can be found in config.py
 Author: Calvin Pang (calvin.pang@curtin.edu.au)
 """
 
+import os
 from pathlib import Path
 import subprocess
 import sys
 
 import config as cfg
+
+# The repository root, for the modules shared with the host scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from snappy_processing.resource_tuner import SnapSettings
+
+# The JVM snappy starts on import reads its heap, tile cache and parallelism from here
+snap_settings = SnapSettings.for_this_process()
+os.environ.setdefault("JAVA_TOOL_OPTIONS", snap_settings.java_options())
+print(f"JVM and SNAP settings: {snap_settings}")
+
 import src.processing_utils as snap
 
 
@@ -191,9 +202,10 @@ def insar_processing(
                 targetfolder=temp_dir,
                 statcostmode=statcostmethod[cfg.processing],
                 initmethod=cfg.init_method,
-                numprocessors=cfg.num_processors,
+                numprocessors=cfg.num_processors or snap_settings.parallelism,
                 rowoverlap=cfg.row_overlap,
                 coloverlap=cfg.col_overlap,
+                gpt_options=snap_settings.gpt_options(),
             )
 
             # =============================================================================
@@ -0,0 +1,267 @@
+#!/bin/env python
+"""
+Description: Downloads only the bursts of an IW SLC covering the area of interest.
+
+             The annotation XML of each subswath is read from the remote zip, and the bursts
+             whose footprint (from the geolocation grid) intersects the AOI are picked. Each
+             burst's byteOffset in the annotation gives its bytes in the measurement TIFF, so
+             only those (and the TIFF's header and tags) are fetched. The rest of each TIFF is
+             left as a sparse hole of zeros, so the SAFE keeps its structure and sizes, and
+             get_subswath_burst and TOPSAR-Split read it as usual.
+             The zip's comment records the bursts it holds, so a trimmed zip is only reused
+             while it holds the bursts the AOI needs (see burst_selection).
+"""
+import logging
+import re
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from xml.etree import ElementTree
+
+from shapely.geometry import MultiPoint, box
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from remote_zip import BURSTS_COMMENT, download_members, member_ranges
+from remote_zip import read_central_directory, read_member
+
+log = logging.getLogger(__name__)
+
+ANNOTATION_PATTERN = re.compile(
+    r"/annotation/s1[a-d]-(iw[1-3])-slc-(hh|hv|vh|vv)-[^/]*\.xml$"
+)
+MEASUREMENT_PATTERN = re.compile(
+    r"/measurement/s1[a-d]-(iw[1-3])-slc-(hh|hv|vh|vv)-[^/]*\.tiff$"
+)
+
+# Bytes per sample of an SLC measurement (complex int16)
+BYTES_PER_SAMPLE = 4
+
+
+def parse_bursts(annotation):
+    """
+    Reads the bursts of a subswath from its annotation XML
+
+    Parameters
+    ----------
+    annotation : bytes
+        The annotation XML
+
+    Returns
+    -------
+    list of dict
+        One per burst, with its "byte_range" [start, end) in the measurement TIFF and
+        its "footprint", a shapely polygon from the geolocation grid
+    """
+    root = ElementTree.fromstring(annotation)
+    lines_per_burst = int(root.findtext("swathTiming/linesPerBurst"))
+    samples_per_burst = int(root.findtext("swathTiming/samplesPerBurst"))
+    burst_size = lines_per_burst * samples_per_burst * BYTES_PER_SAMPLE
+
+    grid = {}
+    for point in root.iter("geolocationGridPoint"):
+        line = int(point.findtext("line"))
+        lon_lat = (float(point.findtext("longitude")), float(point.findtext("latitude")))
+        grid.setdefault(line, []).append(lon_lat)
+    grid_lines = sorted(grid)
+
+    bursts = []
+    for num, burst in enumerate(root.iter("burst")):
+        byte_offset = int(burst.findtext("byteOffset"))
+        first_line = num * lines_per_burst
+        last_line = first_line + lines_per_burst - 1
+        # The grid rows bracketing the burst's lines
+        start_row = max([line for line in grid_lines if line <= first_line] or grid_lines[:1])
+        end_row = min([line for line in grid_lines if line >= last_line] or grid_lines[-1:])
+        points = [
+            lon_lat
+            for line in grid_lines
+            if start_row <= line <= end_row
+            for lon_lat in grid[line]
+        ]
+        bursts.append(
+            {
+                "byte_range": (byte_offset, byte_offset + burst_size),
+                "footprint": MultiPoint(points).convex_hull,
+            }
+        )
+    return bursts
+
+
+def select_bursts(bursts, aoi, margin=1):
+    """
+    The indexes of the bursts intersecting an AOI, with `margin` more bursts on each side
+
+    Parameters
+    ----------
+    bursts : list of dict
+        From parse_bursts
+    aoi : list
+        [minlon, minlat, maxlon, maxlat], in either order
+    margin : int, optional
+        Extra bursts kept before and after those intersecting the AOI. Default is 1.
+
+    Returns
+    -------
+    list of int
+    """
+    lonmin, lonmax = sorted([aoi[0], aoi[2]])
+    latmin, latmax = sorted([aoi[1], aoi[3]])
+    aoi_box = box(lonmin, latmin, lonmax, latmax)
+    hits = [num for num, burst in enumerate(bursts) if burst["footprint"].intersects(aoi_box)]
+    if not hits:
+        return []
+    first = max(0, hits[0] - margin)
+    last = min(len(bursts) - 1, hits[-1] + margin)
+    return list(range(first, last + 1))
+
+
+def tiff_ranges(size, bursts, selected):
+    """
+    The byte ranges of a measurement TIFF to fetch: everything outside the bursts
+    (the TIFF header, tags and strip offsets) and the selected bursts
+    """
+    ranges = []
+    position = 0
+    for num, burst in enumerate(bursts):
+        start, end = burst["byte_range"]
+        if start > position:
+            ranges.append((position, start))
+        if num in selected:
+            ranges.append((start, end))
+        position = max(position, end)
+    if position < size:
+        ranges.append((position, size))
+    return ranges
+
+
+def measurement_name(annotation_name):
+    """The measurement TIFF of a subswath, from the name of its annotation XML"""
+    return annotation_name.replace("/annotation/", "/measurement/")[: -len(".xml")] + ".tiff"
+
+
+def swath_selection(annotation_name, bursts, aoi, polarisations, margin=1):
+    """
+    The bursts of one subswath kept for an AOI
+
+    Returns
+    -------
+    (list of int, str or None)
+        The indexes of the bursts kept, and their label (e.g. "IW1-VV:3-5"), or None if
+        none are kept
+    """
+    swath, pol = ANNOTATION_PATTERN.search(annotation_name).groups()
+    if pol.upper() not in polarisations:
+        return [], None
+    selected = select_bursts(bursts, aoi, margin)
+    if not selected:
+        return [], None
+    return selected, f"{swath.upper()}-{pol.upper()}:{selected[0] + 1}-{selected[-1] + 1}"
+
+
+def burst_selection(fs_path, aoi, polarisations=("VV",), margin=1):
+    """
+    The bursts download_bursts keeps of a product for an AOI, read from the annotations of
+    a local zip of it (whole or trimmed), in the form of the comment of a trimmed zip
+    (see remote_zip.zip_bursts), e.g. "IW1-VV:3-5,IW2-VV:2-4"
+
+    Returns
+    -------
+    str or None
+        The selection, or None if no burst covers the AOI
+    """
+    polarisations = [pol.upper() for pol in polarisations]
+    with zipfile.ZipFile(fs_path) as zf:
+        names = set(zf.namelist())
+        kept = []
+        for name in sorted(names):
+            if not ANNOTATION_PATTERN.search(name) or measurement_name(name) not in names:
+                continue
+            bursts = parse_bursts(zf.read(name))
+            _, label = swath_selection(name, bursts, aoi, polarisations, margin)
+            if label:
+                kept.append(label)
+    return ",".join(sorted(kept)) or None
+
+
+def download_bursts(
+    url,
+    fs_path,
+    total,
+    aoi,
+    polarisations=("VV",),
+    margin=1,
+    num_connections=4,
+    progress_callback=None,
+):
+    """
+    Downloads an IW SLC zip with only the bursts covering the AOI
+
+    Parameters
+    ----------
+    url : str
+        The url of the zip, on a server supporting range requests
+    fs_path : str
+        The zip to write
+    total : int
+        The size of the remote zip in bytes
+    aoi : list
+        [minlon, minlat, maxlon, maxlat]
+    polarisations : list of str, optional
+        The polarisations whose bursts are fetched. Default is ["VV"].
+    margin : int, optional
+        Extra bursts kept before and after those intersecting the AOI. Default is 1.
+    num_connections : int, optional
+        Number of ranges fetched at once. Default is 4.
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Progress bar to update as bytes arrive
+
+    Returns
+    -------
+    int or None
+        The number of bytes downloaded, or None (with nothing downloaded) if the zip should
+        be downloaded whole: its measurements are compressed, or no burst covers the AOI
+    """
+    polarisations = [pol.upper() for pol in polarisations]
+    members, central_directory_offset = read_central_directory(url, total)
+    measurements = {
+        info.filename: info for info in members if MEASUREMENT_PATTERN.search(info.filename)
+    }
+    if any(info.compress_type != zipfile.ZIP_STORED for info in measurements.values()):
+        log.warning(f"Measurements of {url} are compressed, bursts cannot be read alone")
+        return None
+    annotations = [info for info in members if ANNOTATION_PATTERN.search(info.filename)]
+
+    def read_bursts(info):
+        return info, parse_bursts(read_member(url, info))
+
+    sparse = {}
+    kept = []
+    with ThreadPoolExecutor(max_workers=max(1, num_connections)) as executor:
+        for info, bursts in executor.map(read_bursts, annotations):
+            tiff_name = measurement_name(info.filename)
+            if tiff_name not in measurements:
+                continue
+            selected, label = swath_selection(info.filename, bursts, aoi, polarisations, margin)
+            if label:
+                kept.append(label)
+            sparse[tiff_name] = tiff_ranges(measurements[tiff_name].file_size, bursts, selected)
+    if not kept:
+        log.warning(f"No bursts of {url} cover the AOI {aoi}")
+        return None
+
+    size = download_members(
+        url,
+        fs_path,
+        members,
+        member_ranges(members, central_directory_offset),
+        comment=(BURSTS_COMMENT + ",".join(sorted(kept))).encode("utf-8"),
+        num_connections=num_connections,
+        progress_callback=progress_callback,
+        sparse=sparse,
+    )
+    log.info(
+        f"Downloaded bursts {', '.join(sorted(kept))} of {url}: "
+        f"{size / 1e6:.0f} of {total / 1e6:.0f} MB"
+    )
+    return size
@@ -10,6 +10,108 @@ del_intermediate = True
 # Whether or not to download files from THREDDS
 download_from_thredds = True
 
+# Search results are cached here (relative to work_dir), and reused by later runs
+# with the same search criteria for search_cache_ttl_hours. Set it to 0 to always search again.
+search_cache_dir = ".search_cache"
+search_cache_ttl_hours = 24
+# Long searches are split into date windows (and, with tile_degrees, the search box into tiles)
+# which are searched in parallel. Windows start shard_days long, then adapt so each returns
+# about target_shard_size products. Set search_sharding to None to search page by page.
+search_sharding = {
+    "shard_days": 30,
+    "search_workers": 4,
+    "tile_degrees": None,
+    "target_shard_size": 200,
+}
+
+# The search is by the bounds box in config.py, so it also returns products only clipping the
+# area of interest. Each product's footprint is intersected with aoi (a list of [lon, lat]
+# coordinates, a WKT string, or the path of a GeoJSON/shapefile) and products covering less than
+# min_aoi_overlap_fraction of it, or less than min_aoi_overlap_km2, are not downloaded.
+# The overlap is recorded in the search cache. Set aoi to None to download every product found.
+# The snappy and InSAR tools share these defaults. The fraction is kept low, as an AOI across
+# two frames is covered by each only in part, and a higher one would drop both.
+aoi = None
+min_aoi_overlap_fraction = 0.05
+min_aoi_overlap_km2 = 0
+
+# Catalogues can hold several versions of an acquisition (reprocessed, with a different last
+# _XXXX in the title), or the same scene from more than one provider. Only one product of each
+# acquisition (mission, mode, type, start/stop time and orbit) is downloaded, picked by policy:
+# "newest" (processing baseline, then publication date) or "preferred_provider" (the first of
+# preferred_providers, then newest). Versions are grouped within `window` search results, so
+# a product is only downloaded once that many more have been found (or the search has ended):
+# keep it small, the versions of an acquisition are found together.
+# Set to None to download every version.
+deduplication = {"policy": "newest", "preferred_providers": ["thredds", "sara"], "window": 50}
+
+# Number of products downloaded at once
+num_download_workers = 1
+# Maximum number of products downloaded at once from each provider.
+# Providers not listed are only limited by num_download_workers.
+max_downloads_per_provider = {"sara": 2, "thredds": 4}
+
+# THREDDS downloads are split into byte ranges of this size (in MB),
+# which are fetched over several connections at once.
+# Set the number of connections to 1 to download over a single stream.
+thredds_download_connections = 4
+thredds_segment_size_mb = 64
+
+# Download only the bursts of each SLC covering the bounds in config.py (plus burst_margin bursts
+# either side), in burst_polarisations, instead of the whole 4-8 GB zip. The rest of each
+# measurement TIFF is left as a sparse hole of zeros, so the zip keeps its structure for
+# get_subswath_burst and TOPSAR-Split. Trimmed zips are kept out of the shared product store,
+# and one trimmed for other bounds (or burst settings) is downloaded again.
+# Needs a server supporting range requests (THREDDS does), else the whole zip is downloaded.
+download_bursts_only = False
+burst_polarisations = ["VV"]
+burst_margin = 1
+
+# Local directories (e.g. the data_raw of earlier projects) searched for a product's zip before
+# it is downloaded. A match is hardlinked (or reflinked, or symlinked across filesystems) into
+# data_raw instead of being downloaded. Mirror copies are checked against the provider's checksum,
+# when there is one, if verify_mirror_checksums is True.
+local_mirror_roots = []
+verify_mirror_checksums = True
+
+# A directory shared by several projects, holding one copy of each raw product zip.
+# Each project's data_raw then links to it, and a reference count records which projects
+# still use each product. Products no project links to any more are deleted by running
+# `python snappy_processing/product_store.py <product_store_dir>`.
+# Set product_store_dir to None to keep each project's raw products in its own data_raw.
+product_store_dir = None
+
+# The state of every product (searched, downloaded, processed and COG'd) is kept in this SQLite
+# database, beside data_raw and data_processed, in place of '.downloaded' and '.processed' marker
+# files. Markers left by earlier runs are imported the first time it is used.
+state_db_fname = ".state.sqlite"
+
+# In THREDDS mode, products are found in a local index of NCI's THREDDS catalog instead of
+# with an EODAG search. The index is kept in index_dir (relative to work_dir), one file
+# per month, and recent months are crawled again after ttl_hours. catalog_root can be a local
+# directory of catalog.xml files (None is NCI's catalog). Set to None to search with EODAG.
+thredds_index_options = {"index_dir": ".thredds_index", "catalog_root": None, "ttl_hours": 24}
+
+# All HTTP traffic shares pooled connections per host. Requests time out after
+# http_timeout seconds ([connect, read]), and connection errors, timeouts and 429/5xx
+# responses are retried up to http_max_retries times with a growing, random, backoff.
+http_timeout = [10, 120]
+http_max_retries = 5
+http_backoff_seconds = 1
+http_backoff_max_seconds = 60
+
+# Limits for each host, shared by every download and query running at once:
+# "connections" open at once, "requests_per_second" and "mb_per_second".
+# Leave a limit out (or None) for no limit. A host answering 429 (too many requests)
+# is slowed down automatically, and sped back up once it stops complaining.
+http_host_limits = {
+    "step.esa.int": {"connections": 4, "requests_per_second": 5},
+    "catalogue.dataspace.copernicus.eu": {"connections": 2, "requests_per_second": 2},
+    "dapds00.nci.org.au": {"connections": 32},
+}
+# Limits for hosts not listed above
+http_default_limits = {}
+
 ### Below are relative directories for the docker container.           ####
 ### Please DO NOT change these paths without knowing what you're doing ####
 ### These paths are relative for the docker container to use, and      ####
@@ -1,6 +1,8 @@
 #!/bin/env python# -*- coding: utf-8 -*-
 #
 # Functions for downloading products without EODAG (ie to do so from THREDDS)
+# The download itself (ranged, resumable and checked) is shared with the host scripts'
+# download_utils, this module adds the bursts-only download and this project's config.
 #
 # ===========================================================
 #
@@ -19,19 +21,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import errno
-import hashlib
 import logging
 import sys
-import traceback as tb
+import threading
+import zipfile
 from pathlib import Path
-import requests
+from xml.etree import ElementTree
 
-from eodag.utils import sanitize, ProgressCallback
+from eodag.utils import ProgressCallback
 
-sys.path.append('..')
-from config import log_fname
+from config import log_fname, bounds
+from src.downloader_config import thredds_download_connections, thredds_segment_size_mb
+from src.downloader_config import product_store_dir, state_db_fname
+from src.downloader_config import download_bursts_only, burst_polarisations, burst_margin
 
+# Set up before download_utils is imported, so the shared helpers log here too
 Path(log_fname).parent.mkdir(exist_ok=True, parents=True)
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -41,46 +45,97 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# The repository root, for the modules shared with the host scripts
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from download_utils import AggregateProgress, ProductProgressCallback, ProviderLimits
+from download_utils import CorruptDownloadError, checksum_from_product, download_url
+from download_utils import get_fpath, is_partial_zip, link_from_mirror, probe_range_support
+from download_utils import thredds_url, verify_safe_zip
+from snappy_processing import http_transport
+from snappy_processing.product_store import ProductStore
+from snappy_processing import state_db
+from remote_zip import zip_bursts
+from src.burst_utils import burst_selection, download_bursts
 
-def get_fpath(product, raw_data_path):
+
+_product_store = None
+_product_store_lock = threading.Lock()
+
+
+def get_product_store():
+    """The shared raw product store set by `product_store_dir` in the config, or None"""
+    global _product_store
+    if not product_store_dir:
+        return None
+    with _product_store_lock:
+        if _product_store is None:
+            _product_store = ProductStore(product_store_dir)
+        return _product_store
+
+
+def get_state_db(data_path):
+    """The state database of the project holding data_path (its data_raw or data_processed)"""
+    return state_db.for_data_path(data_path, state_db_fname)
+
+
+def fetch_from_store(product, raw_data_path):
+    """
+    Links a product from the shared product store into raw_data_path, if the store has it
+
+    Returns
+    -------
+    str or None
+        The path of the linked product, or None if it is not in the store
+    """
+    store = get_product_store()
+    if store is None or product_downloaded(product, raw_data_path):
+        return None
+    fs_path = get_fpath(product, raw_data_path)
+    if not store.fetch(product.properties["title"], fs_path):
+        return None
+    declare_downloaded(product, raw_data_path, fs_path)
+    return fs_path
+
+
+def declare_downloaded(product, raw_data_path, fs_path=None, key=None):
     """
-    Given an eodag product object, returns the filepath of the file to be downloaded, mimics the naming of the file from EODAG
+    Declares a product as downloaded by recording it in the project's state database,
+    with the original download link (as EODAG names its downloads by the link's hash),
+    the file's size and its checksum.
+    With a product store configured, the file is moved into the store and linked back,
+    unless it only holds some bursts (so it cannot stand in for the product).
 
     Parameters
     ----------
     product : eodag.api.product.EOProduct
-        EODAG product object
+        an EODAG product object
     raw_data_path : str
-        The filepath to the directory where the raw data is stored
+        The directory where the raw data is stored
+    fs_path : str, optional
+        The downloaded file, if it differs from get_fpath(product, raw_data_path)
+    key : str, optional
+        "<algorithm>-<hexdigest>" of the file, if known, for the product store
 
     Returns
     -------
-    str
-        The filepath of the raw product
-    """
-    # Create fname
-    outputs_extension = ".zip"
-    sanitized_title = sanitize(product.properties["title"])
-    if sanitized_title == product.properties["title"]:
-        collision_avoidance_suffix = ""
-    else:
-        collision_avoidance_suffix = "-" + sanitize(product.properties["id"])
-    fs_path = Path(
-        raw_data_path,
-        f"{sanitize(product.properties['title'])}{collision_avoidance_suffix}{outputs_extension}",
-    )
-    fs_path = Path(
-        raw_data_path,
-        f"{sanitize(product.properties['title'])}{collision_avoidance_suffix}{outputs_extension}",
+    None
+    """
+    store = get_product_store()
+    fs_path = fs_path or get_fpath(product, raw_data_path)
+    if store is not None and not is_partial_zip(fs_path):
+        key = store.adopt(product.properties["title"], fs_path, key)
+    get_state_db(raw_data_path).mark_downloaded(
+        product.properties["title"],
+        url=product.remote_location,
+        raw_path=str(fs_path),
+        checksum=key,
     )
-    return fs_path
+    return True
 
 
-def declare_downloaded(product, raw_data_path):
+def remove_download(product, raw_data_path, fs_path=None):
     """
-    Declares a product as downloaded by creating a .done file in the raw data path directory.
-    The file name is the product's name + '.done', in the folder '.downloaded' relative to the original file
-    Will mimic EODAGs syntax, by using the hash of the original download link (which will be re-created)
+    Removes a downloaded product and its download record, so it will be downloaded again
 
     Parameters
     ----------
@@ -88,35 +143,88 @@ def declare_downloaded(product, raw_data_path):
         an EODAG product object
     raw_data_path : str
         The directory where the raw data is stored
+    fs_path : str, optional
+        The path of the downloaded file, if it differs from get_fpath(product, raw_data_path)
 
     Returns
     -------
     None
     """
-    download_records_dir = Path(raw_data_path, ".downloaded")
-    try:
-        download_records_dir.mkdir(exist_ok=True, parents=True)
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:  # Skip error if dir exists
-            log.warning(
-                f"Unable to create records directory. Got:\n{tb.format_exc()}",
-            )
-    eodag_url = product.remote_location
-    url_hash = hashlib.md5(eodag_url.encode("utf-8")).hexdigest()
-    record_filename = Path(download_records_dir, url_hash)
+    get_state_db(raw_data_path).forget_download(
+        product.properties["title"], url=product.remote_location
+    )
+    fs_path = Path(fs_path or get_fpath(product, raw_data_path))
+    if fs_path.is_file():
+        fs_path.unlink()
+    return
+
+
+def fetch_from_mirror(product, raw_data_path, mirror_roots, verify_checksum=True):
+    """
+    Links a product from local mirrors into raw_data_path, if one has a usable copy
+    (see download_utils.link_from_mirror), and declares it downloaded.
+    Mirror copies with only some bursts or polarisations are not used.
+
+    Returns
+    -------
+    str or None
+        The path of the linked product, or None if no usable mirror copy was found
+    """
+    if not mirror_roots or product_downloaded(product, raw_data_path):
+        return None
+    fs_path = get_fpath(product, raw_data_path)
+    if not link_from_mirror(product, fs_path, mirror_roots, verify_checksum):
+        return None
+    declare_downloaded(product, raw_data_path)
+    return fs_path
+
+
+def wanted_bursts(fs_path):
+    """
+    The bursts a zip of a product should hold for the bounds in config.py (as its comment
+    records them, see burst_utils.burst_selection), or None if the whole product is needed
+    """
+    if not download_bursts_only:
+        return None
     try:
-        with open(record_filename, "w", encoding="UTF-8") as f:
-            f.writelines(eodag_url)
-    except OSError as e:
-        log.exception(
-            f"Unable to create file indicating download for {record_fname}. exception:"
+        return burst_selection(
+            fs_path, bounds, polarisations=burst_polarisations, margin=burst_margin
         )
-    return True
+    except (zipfile.BadZipFile, ElementTree.ParseError, OSError):
+        return None
+
+
+def download_thredds_bursts(url, fs_path, progress_callback=None):
+    """
+    Downloads only the bursts of a THREDDS SLC zip covering the bounds in config.py
+    (see burst_utils.download_bursts)
+
+    Returns
+    -------
+    bool
+        True if the zip was downloaded, False if it should be downloaded whole
+    """
+    total, accepts_ranges, _ = probe_range_support(url)
+    if not (accepts_ranges and total):
+        return False
+    size = download_bursts(
+        url,
+        fs_path,
+        total,
+        bounds,
+        polarisations=burst_polarisations,
+        margin=burst_margin,
+        num_connections=thredds_download_connections,
+        progress_callback=progress_callback,
+    )
+    return size is not None
 
 
-def download_product_thredds(product, raw_data_path):
+def download_product_thredds(product, raw_data_path, progress_callback=None):
     """
-    A custom downloader for when download_from_thredds=True. Will check if a file has already been downloaded
+    A custom downloader for when download_from_thredds=True. Will check if a file has already been downloaded.
+    The download is checked against any checksum the provider gives, and its zip structure is
+    checked, before it is declared downloaded. Raises CorruptDownloadError if either check fails.
 
     Parameters
     ----------
@@ -124,6 +232,9 @@ def download_product_thredds(product, raw_data_path):
         an EODAG product object
     raw_data_path : str
         The path to the directory where the downloaded product will be saved.
+    progress_callback : ProgressCallback, optional
+        Progress bar for the download, e.g. a ProductProgressCallback feeding an
+        AggregateProgress. A new bar is made if not given.
 
     Returns
     -------
@@ -133,24 +244,37 @@ def download_product_thredds(product, raw_data_path):
     if product_downloaded(product, raw_data_path):
         log.info(f"Product already downloaded: {fs_path}")
         return fs_path
+    if fetch_from_store(product, raw_data_path):
+        return fs_path
 
-    thredds_base_url = "https://dapds00.nci.org.au/thredds/fileServer/fj7/Copernicus/"
-    threds_url = (
-        "/".join([thredds_base_url, *product.properties["quicklook"].split("/")[4:]])[
-            :-4
-        ]
-        + ".zip"
+    threds_url = thredds_url(product)
+    if progress_callback is None:
+        progress_callback = ProgressCallback(mininterval=0.1)
+        progress_callback.desc = str(product.properties.get("id", ""))
+    if download_bursts_only and download_thredds_bursts(threds_url, fs_path, progress_callback):
+        # Only some bytes were fetched, so there is no checksum to check the zip against
+        try:
+            verify_safe_zip(fs_path, bursts=wanted_bursts(fs_path))
+        except CorruptDownloadError:
+            remove_download(product, raw_data_path, fs_path)
+            raise
+        declare_downloaded(product, raw_data_path, fs_path)
+        return fs_path
+    digest = download_url(
+        threds_url,
+        fs_path,
+        num_connections=thredds_download_connections,
+        segment_size=int(thredds_segment_size_mb * 1024 * 1024),
+        progress_callback=progress_callback,
+        checksum=checksum_from_product(product),
     )
-    progress_callback = ProgressCallback(mininterval=0.1)
-    progress_callback.desc = str(product.properties.get("id", ""))
-    stream = requests.get(threds_url, stream=True)
-    total = int(stream.headers["content-length"])
-    progress_callback.reset(total=total)
-    with open(fs_path, "wb") as fhandle:
-        for chunk in stream.iter_content(chunk_size=64 * 1024):
-            size = fhandle.write(chunk)
-            progress_callback.update(size)
-    declare_downloaded(product, raw_data_path)
+    # Only declare the product downloaded once it is known to be whole
+    try:
+        verify_safe_zip(fs_path)
+    except CorruptDownloadError:
+        remove_download(product, raw_data_path, fs_path)
+        raise
+    declare_downloaded(product, raw_data_path, fs_path, key="-".join(digest) if digest else None)
     return fs_path
 
 
@@ -170,9 +294,24 @@ def product_downloaded(product, raw_data_path):
     bool
         Whether or not the product has already been downloaded
     """
-    eodag_url = product.remote_location
-    url_hash = hashlib.md5(eodag_url.encode("utf-8")).hexdigest()
-    return Path(raw_data_path, ".downloaded", url_hash).is_file()
+    record_exists = get_state_db(raw_data_path).is_downloaded(
+        product.properties["title"], url=product.remote_location
+    )
+    fs_path = Path(get_fpath(product, raw_data_path))
+    # Downloads are renamed into place once complete, so the file existing means it is whole
+    if not (record_exists and fs_path.is_file()):
+        return False
+    try:
+        with zipfile.ZipFile(fs_path) as zf:
+            bursts = zip_bursts(zf)
+    except (zipfile.BadZipFile, OSError):
+        return False
+    # A zip trimmed to the bursts of other bounds (or when the whole product is now wanted)
+    # is downloaded again
+    if bursts is not None and bursts != wanted_bursts(fs_path):
+        log.info(f"{fs_path.name} holds bursts {bursts}, not those needed now")
+        return False
+    return True
 
 
 if __name__ == "__main__":
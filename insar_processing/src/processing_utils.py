@@ -341,6 +341,7 @@ def snaphu_export_gpt(
     numprocessors: int = 8,
     rowoverlap: int = 200,
     coloverlap: int = 200,
+    gpt_options: list = None,
 ):
     """
     Converts the interferogram (as the wrapped phase) into a format
@@ -351,11 +352,13 @@ def snaphu_export_gpt(
         statcostmode (str): Select 'TOPO' for Digital Elevation Model or 'DEFO' for Displacement.
         initmethod (str): Select 'MCF' or 'MST'. Defaults to 'MCF"
         numprocessors (int): Defaults to 8 processors
+        gpt_options (list): gpt's own options, e.g. from resource_tuner.SnapSettings.gpt_options()
     """
     return subprocess.run(
         [
             "gpt",
             "SnaphuExport",
+            *(gpt_options or []),
             f"-Ssource={str(filepath)}",
             f"-PstatCostMode={statcostmode}",
             f"-PinitMethod={initmethod}",
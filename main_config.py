@@ -25,6 +25,67 @@ search_criteria = {
     "geom": geo,
 }
 
+# Search results are cached here (relative to data_directory), and reused by later runs
+# with the same search criteria for search_cache_ttl_hours. Set it to 0 to always search again.
+search_cache_dir = ".search_cache"
+search_cache_ttl_hours = 24
+# Long searches are split into date windows (and, with tile_degrees, the search box into tiles)
+# which are searched in parallel. Windows start shard_days long, then adapt so each returns
+# about target_shard_size products. Set search_sharding to None to search page by page.
+search_sharding = {
+    "shard_days": 30,
+    "search_workers": 4,
+    "tile_degrees": None,
+    "target_shard_size": 200,
+}
+
+# The search is by the bounds box above, so it also returns products only clipping the area of
+# interest. Each product's footprint is intersected with aoi (a list of [lon, lat] coordinates,
+# a WKT string, or the path of a GeoJSON/shapefile) and products covering less than
+# min_aoi_overlap_fraction of it, or less than min_aoi_overlap_km2, are not downloaded.
+# The overlap is recorded in the search cache. Set aoi to None to download every product found.
+# The snappy and InSAR tools share these defaults. The fraction is kept low, as an AOI across
+# two frames is covered by each only in part, and a higher one would drop both.
+aoi = None
+min_aoi_overlap_fraction = 0.05
+min_aoi_overlap_km2 = 0
+
+# Batch mode, for many small AOIs (e.g. mine sites) in one run. The AOIs are read from aoi_file
+# (a GeoPackage or GeoJSON in lon/lat), named by its id_field attribute (or their position),
+# and one search covers all of them in place of the bounds above. Each product is downloaded and
+# processed once, and with clip_outputs its COG is clipped to every AOI it overlaps, as
+# data_processed/aois/<aoi id>/. Set aoi_batch to None to process the bounds above alone.
+aoi_batch = None
+# aoi_batch = {"aoi_file": "~/data/aois.gpkg", "id_field": "name", "clip_outputs": True}
+
+# Catalogues can hold several versions of an acquisition (reprocessed, with a different last
+# _XXXX in the title), or the same scene from more than one provider. Only one product of each
+# acquisition (mission, mode, type, start/stop time and orbit) is downloaded, picked by policy:
+# "newest" (processing baseline, then publication date) or "preferred_provider" (the first of
+# preferred_providers, then newest). Versions are grouped within `window` search results, so
+# a product is only downloaded once that many more have been found (or the search has ended):
+# keep it small, the versions of an acquisition are found together.
+# Set to None to download every version.
+deduplication = {"policy": "newest", "preferred_providers": ["thredds", "sara"], "window": 50}
+
+
+# An S3-compatible archive (AWS, a provider's bucket, our own archive or a local MinIO) tried
+# before THREDDS/EODAG. Each product's zip is looked up at key_template (formatted with title,
+# id, mission, mode, product_type, year, month and day) and downloaded as ranged GETs of
+# part_size_mb, max_concurrency at a time. Products not in the bucket are downloaded as usual.
+# Credentials come from the environment (AWS_ACCESS_KEY_ID, ...) or profile_name, or set
+# anonymous for a public bucket. Needs boto3. Set to None to not use S3.
+s3_archive = None
+# s3_archive = {
+#     "bucket": "sentinel-1",
+#     "key_template": "{product_type}/{year}/{month}/{title}.zip",
+#     "endpoint_url": "http://localhost:9000",  # e.g. a local MinIO
+#     "path_style": True,
+#     "max_concurrency": 8,
+#     "part_size_mb": 64,
+#     "verify_etag": False,  # only if the bucket's ETags are md5s (unencrypted objects)
+# }
+
 
 # The std_out will be logged here. (relative to data_directory)
 log_fname = "debug.log"
@@ -35,6 +96,116 @@ del_intermediate = True
 # Whether or not to download files from THREDDS
 download_from_thredds = True
 
+# Downloading, snappy processing and COG conversion run as separate stages,
+# so the next product can download while the current one is being processed.
+# Number of workers (threads) for each stage:
+num_download_workers = 1
+# Each processing worker runs a container, with its own share of the host's CPUs and memory
+# (docker --cpuset-cpus, --cpus and --memory), a JVM heap to fit and SNAP parallelism to match.
+# None runs as many containers as the host has room for (see container_sizing below).
+num_processing_workers = None
+num_cog_workers = 1
+# Maximum number of downloads running at once from each provider.
+# Providers not listed are only limited by num_download_workers.
+max_downloads_per_provider = {"sara": 2, "thredds": 4}
+# Maximum number of products waiting between two stages.
+# Keeps the downloader from filling the disk far ahead of the processing.
+pipeline_queue_size = 2
+# Long-lived SNAP worker containers, started once per run. Each keeps snappy and its JVM warm
+# and takes products from a spool in data_directory, rather than a container being started
+# (and its JVM booted) for every product. Set to 0 to run a container per product.
+num_snap_workers = 0
+# Without SNAP workers, products are sent to the container in batches of up to this many,
+# so a container (and its JVM) is started once per batch rather than once per product.
+# A batch is started short once its first product has waited processing_batch_wait seconds.
+# 1 starts a container for every product.
+processing_batch_size = 1
+processing_batch_wait = 300
+# python's garbage collection does not free what SNAP keeps in the JVM (e.g. its tile cache),
+# so the JVM is restarted after jvm_recycle_every products of a batch (0 for never), or once
+# more than jvm_max_heap_fraction of its heap is still in use after a product (None for never).
+# SNAP workers are restarted on the heap threshold too.
+jvm_recycle_every = 10
+jvm_max_heap_fraction = 0.8
+# How the host (or the cgroup it runs in) is split between the containers running at once
+# (see partition_host in docker_processing.py). Without num_processing_workers, each container
+# is given at least min_cpus CPUs and min_memory_gb of memory, or more if the products need a
+# larger heap (estimated from the size in their SAFE annotation).
+# heap_fraction of a container's memory is given to its JVM heap, and tile_cache_fraction of the
+# heap to SNAP's tile cache (snap.jai.tileCacheSize). The tile size and snap.parallelism follow
+# from those and the container's CPUs (see snappy_processing/resource_tuner.py), and are logged
+# with each container run. reserve_memory_gb is left for the host (downloads, COG conversion).
+container_sizing = {
+    "min_cpus": 4,
+    "min_memory_gb": 16,
+    "heap_fraction": 0.75,
+    "tile_cache_fraction": 0.5,
+    "reserve_memory_gb": 4,
+}
+
+# THREDDS downloads are split into byte ranges of this size (in MB),
+# which are fetched over several connections at once.
+# Set the number of connections to 1 to download over a single stream.
+thredds_download_connections = 4
+thredds_segment_size_mb = 64
+# Polarisations to download from THREDDS, e.g. ["VV"] when the operators below only use
+# Sigma0_VV. Only those measurement TIFFs (and every metadata file) are fetched from the zip,
+# about halving a dual-pol download. Such zips are kept out of the shared product store.
+# Set to None to download whole zips.
+thredds_polarisations = None
+
+# In THREDDS mode, products are found in a local index of NCI's THREDDS catalog instead of
+# with an EODAG search. The index is kept in index_dir (relative to data_directory), one file
+# per month, and recent months are crawled again after ttl_hours. catalog_root can be a local
+# directory of catalog.xml files (None is NCI's catalog). Set to None to search with EODAG.
+thredds_index_options = {"index_dir": ".thredds_index", "catalog_root": None, "ttl_hours": 24}
+
+# All HTTP traffic (orbit files, catalogue queries and THREDDS downloads) shares pooled
+# connections per host. Requests time out after http_timeout seconds ([connect, read]),
+# and connection errors, timeouts and 429/5xx responses are retried up to
+# http_max_retries times, backing off from http_backoff_seconds up to http_backoff_max_seconds.
+http_timeout = [10, 120]
+http_max_retries = 5
+http_backoff_seconds = 1
+http_backoff_max_seconds = 60
+
+# Limits for each host, shared by every download and query running at once:
+# "connections" open at once, "requests_per_second" and "mb_per_second".
+# Leave a limit out (or None) for no limit. A host answering 429 (too many requests)
+# is slowed down automatically, and sped back up once it stops complaining.
+http_host_limits = {
+    "step.esa.int": {"connections": 4, "requests_per_second": 5},
+    "catalogue.dataspace.copernicus.eu": {"connections": 2, "requests_per_second": 2},
+    "dapds00.nci.org.au": {"connections": 32},
+}
+# Limits for hosts not listed above
+http_default_limits = {}
+
+# Downloads are checked (checksum & zip contents) before processing.
+# A corrupt download is deleted and downloaded again up to this many times.
+max_download_attempts = 3
+
+# Local directories (e.g. the data_raw of earlier projects) searched for a product's zip before
+# it is downloaded. A match is hardlinked (or reflinked, or symlinked across filesystems) into
+# data_raw instead of being downloaded. Mirrors are mounted read-only into the docker container
+# so symlinks still resolve there. Mirror copies are checked against the provider's checksum,
+# when there is one, if verify_mirror_checksums is True.
+local_mirror_roots = []
+verify_mirror_checksums = True
+
+# A directory shared by several projects, holding one copy of each raw product zip.
+# Each project's data_raw then links to it, and a reference count records which projects
+# still use each product. With product_store_gc, products no project links to any more are
+# deleted at the end of a run. The store is mounted into the docker container at the same path.
+# Set product_store_dir to None to keep each project's raw products in its own data_raw.
+product_store_dir = None
+product_store_gc = False
+
+# The state of every product (searched, downloaded, processed and COG'd) is kept in this SQLite
+# database, beside data_raw and data_processed, in place of '.downloaded' and '.processed' marker
+# files. Markers left by earlier runs are imported the first time it is used.
+state_db_fname = ".state.sqlite"
+
 
 ### Below are the pre-processing config options          ####
 ### Feel free to change them as you want to,             ####
@@ -186,6 +357,9 @@ shapefile_subdirectory = "./data/Polygons"
 
 # Docker image name to use
 docker_image_name = "s1_preproc"
+# The docker daemon's socket, None to use DOCKER_HOST (unix://...) or the default
+# /var/run/docker.sock (see docker_api.py)
+docker_socket = None
 
 # =======================================================================
 # -------------------End of config file---------------------------------
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Description: Looks for Sentinel-1 zips in local mirrors (e.g. the data_raw directories of
+             earlier projects on shared NFS) before anything is downloaded, and links a match
+             into this project's data_raw instead of copying it.
+             A match is linked in with snappy_processing.product_store.link_file.
+"""
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+_index_lock = threading.Lock()
+_indexes = {}
+
+
+def mirror_index(root):
+    """
+    A {file name: path} index of the zips under a mirror root, built once per process
+    so large (NFS) mirrors are only walked once per run
+    """
+    root = os.path.abspath(os.path.expanduser(root))
+    with _index_lock:
+        index = _indexes.get(root)
+        if index is not None:
+            return index
+        index = {}
+        if not os.path.isdir(root):
+            log.warning(f"Mirror {root} is not a directory, skipping it")
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(".zip"):
+                    # Keep the first copy found
+                    index.setdefault(filename, os.path.join(dirpath, filename))
+        log.info(f"Indexed {len(index)} zips in mirror {root}")
+        _indexes[root] = index
+        return index
+
+
+def find_in_mirrors(names, mirror_roots, expected_size=None):
+    """
+    Finds a file in the mirrors by name, and by size when it is known
+
+    Parameters
+    ----------
+    names : list of str
+        File names the product may have, e.g. "<title>.zip"
+    mirror_roots : list of str
+        Directories to search (recursively)
+    expected_size : int, optional
+        The product's size in bytes. Files of any other size are ignored.
+
+    Returns
+    -------
+    str or None
+        The path of the first match
+    """
+    for root in mirror_roots or []:
+        index = mirror_index(root)
+        for name in names:
+            path = index.get(name)
+            if path is None or not os.path.isfile(path):
+                continue
+            if expected_size and os.path.getsize(path) != expected_size:
+                log.info(f"Mirror copy {path} is the wrong size, ignoring it")
+                continue
+            return path
+    return None
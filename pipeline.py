@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Description: A small staged pipeline built from worker threads joined by bounded queues.
+             Used to overlap downloading, snappy processing and COG conversion, so the
+             network is not idle while a product is in the container (and vice versa).
+"""
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Sentinel placed on a queue to tell a worker there is no more work
+_STOP = object()
+
+
+class Stage:
+    """
+    A single stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, used for logging and thread names.
+    func : callable
+        Called with each item. Whatever it returns is passed to the next stage.
+        Returning None drops the item from the pipeline.
+    workers : int, optional
+        Number of threads running `func` concurrently. Default is 1.
+    ordered : bool, optional
+        If True, results are handed to the next stage in the order items arrived,
+        even when several workers finish out of order. Default is False.
+    batch_size : int, optional
+        With more than 1, each worker gathers up to batch_size items and calls `func` once with
+        the list of them. `func` then returns a list with a result (or None) for each item.
+        Default is 1.
+    batch_wait : float, optional
+        Seconds a worker waits for a batch to fill after its first item, before running it
+        with fewer items. Default is 0.
+    """
+
+    def __init__(self, name, func, workers=1, ordered=False, batch_size=1, batch_wait=0):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.ordered = ordered
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = batch_wait
+
+
+class _Output:
+    """
+    Passes a stage's results to the next queue, numbering them in the order they are released.
+    Ordered stages hold results back until every earlier item has finished (or been dropped).
+    Their workers only take an item while fewer than `window` taken items are unreleased,
+    so the results held back behind a slow item are bounded.
+    """
+
+    def __init__(self, out_queue, ordered, window=1):
+        self.out_queue = out_queue
+        self.ordered = ordered
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_in = 0
+        self.next_out = 0
+        self.window = threading.Semaphore(max(1, window)) if ordered else None
+
+    def reserve(self, blocking=True):
+        """Takes a place in the window for an item about to be taken from the stage's queue"""
+        return self.window is None or self.window.acquire(blocking=blocking)
+
+    def unreserve(self):
+        """Gives back a place taken by reserve when no item was taken after all"""
+        if self.window is not None:
+            self.window.release()
+
+    def put(self, seq, result):
+        """Records the result (None if dropped) of the item numbered `seq` at the stage's input"""
+        with self.lock:
+            if not self.ordered:
+                self._release(result)
+                return
+            self.pending[seq] = result
+            while self.next_in in self.pending:
+                self._release(self.pending.pop(self.next_in))
+                self.next_in += 1
+                self.window.release()
+
+    def _release(self, result):
+        if result is None or self.out_queue is None:
+            return
+        self.out_queue.put((self.next_out, result))
+        self.next_out += 1
+
+
+def run_pipeline(items, stages, queue_size=2, on_error=None):
+    """
+    Pushes items through a list of stages, each stage running in its own worker threads.
+
+    Stages are joined by bounded queues, so at most `queue_size` items wait between two
+    stages and a fast stage (e.g. downloading) can only run ahead of a slow one
+    (e.g. processing) by that many items. `items` is consumed lazily, so it can be a generator.
+    Stages created with ordered=True pass their results on in the order of `items`. While one
+    item is slow, such a stage goes on with at most workers * batch_size + queue_size items
+    after it, so the results it holds back stay bounded too.
+
+    Parameters
+    ----------
+    items : iterable
+        The items to feed into the first stage.
+    stages : list of Stage
+        The stages to run, in order.
+    queue_size : int, optional
+        The maximum number of items waiting between two stages. Default is 2.
+    on_error : callable, optional
+        Called as on_error(stage_name, item, exception) when a stage raises.
+        The item is dropped from the pipeline either way. If None, the exception is logged.
+
+    Returns
+    -------
+    None
+    """
+    if not stages:
+        return
+
+    # queues[i] feeds stages[i]. The last stage's output is discarded.
+    queues = [queue.Queue(maxsize=max(1, int(queue_size))) for _ in stages]
+    remaining = [stage.workers for stage in stages]
+    remaining_lock = threading.Lock()
+
+    outputs = [
+        _Output(
+            queues[i + 1] if i + 1 < len(stages) else None,
+            stage.ordered,
+            window=stage.workers * stage.batch_size + queue_size,
+        )
+        for i, stage in enumerate(stages)
+    ]
+
+    def report(stage, item, exc):
+        if on_error is not None:
+            on_error(stage.name, item, exc)
+        else:
+            log.exception(f"Stage '{stage.name}' failed for item {item}")
+
+    def next_batch(stage, in_queue, output):
+        """The entries of the next batch, and whether the stage has been told to stop"""
+        output.reserve()
+        entry = in_queue.get()
+        if entry is _STOP:
+            output.unreserve()
+            return [], True
+        batch = [entry]
+        deadline = time.monotonic() + stage.batch_wait
+        while len(batch) < stage.batch_size:
+            # Never wait for the window while holding items, the window may be waiting on them
+            if not output.reserve(blocking=False):
+                break
+            try:
+                entry = in_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                output.unreserve()
+                break
+            if entry is _STOP:
+                output.unreserve()
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def worker(i):
+        stage = stages[i]
+        in_queue = queues[i]
+        stopped = False
+        while not stopped:
+            if stage.batch_size > 1:
+                batch, stopped = next_batch(stage, in_queue, outputs[i])
+                if not batch:
+                    break
+                items = [item for _, item in batch]
+                results = [None] * len(batch)
+                try:
+                    batch_results = list(stage.func(items))
+                    if len(batch_results) != len(batch):
+                        raise ValueError(
+                            f"Stage '{stage.name}' returned {len(batch_results)} results "
+                            f"for a batch of {len(batch)}"
+                        )
+                    results = batch_results
+                except Exception as exc:
+                    for item in items:
+                        report(stage, item, exc)
+                # Every item is put, so an ordered stage is never left waiting for one
+                for (seq, _), result in zip(batch, results):
+                    outputs[i].put(seq, result)
+                continue
+            outputs[i].reserve()
+            entry = in_queue.get()
+            if entry is _STOP:
+                outputs[i].unreserve()
+                break
+            seq, item = entry
+            result = None
+            try:
+                result = stage.func(item)
+            except Exception as exc:
+                report(stage, item, exc)
+            outputs[i].put(seq, result)
+
+        # The last worker of a stage to finish tells the next stage to stop
+        with remaining_lock:
+            remaining[i] -= 1
+            last_worker = remaining[i] == 0
+        if last_worker and i + 1 < len(stages):
+            for _ in range(stages[i + 1].workers):
+                queues[i + 1].put(_STOP)
+
+    threads = []
+    for i, stage in enumerate(stages):
+        for j in range(stage.workers):
+            thread = threading.Thread(
+                target=worker, args=(i,), name=f"{stage.name}-{j}", daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    for seq, item in enumerate(items):
+        queues[0].put((seq, item))
+    for _ in range(stages[0].workers):
+        queues[0].put(_STOP)
+
+    for thread in threads:
+        thread.join()
+    return
@@ -19,6 +19,7 @@ import getpass
 from subprocess import Popen, PIPE, STDOUT
 import shutil
 import json
+import functools
 
 from osgeo import ogr
 from osgeo import osr
@@ -28,6 +29,7 @@ from eodag.utils.exceptions import AuthenticationError
 from osgeo import gdal
 
 from main_config import log_fname, data_directory
+from main_config import thredds_polarisations
 
 log_fname = os.path.join(data_directory, log_fname)
 log_fname = Path(log_fname).expanduser().resolve().as_posix()
@@ -40,8 +42,22 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
-from download_utils import download_product_thredds
-from docker_processing import run_docker_container
+from download_utils import download_product_thredds, verify_safe_zip, remove_download
+from download_utils import CorruptDownloadError, fetch_from_mirror, fetch_from_store
+from download_utils import declare_downloaded, get_fpath, get_product_store, get_state_db
+from download_utils import download_product_s3, get_s3_archive
+from download_utils import AggregateProgress, ProductProgressCallback, ProviderLimits
+from docker_processing import ContainerSlots, WorkerPool, partition_host
+from docker_processing import run_docker_container, run_parallel_containers
+from footprint_filter import FootprintFilter, load_aoi
+from dedup import Deduplicator
+from aoi_batch import AoiMatcher, load_aois, union_search_geom, write_cutlines
+from pipeline import Stage, run_pipeline
+from work_planner import WorkPlanner, host_path
+from search_cache import cached_search
+from thredds_index import search_index
+from snappy_processing import http_transport
+from snappy_processing.state_db import product_title
 
 
 def write_shapefile(polygon, fpath="data/search_polygon.shp", crs_num=4326):
@@ -109,7 +125,7 @@ def write_shapefile(polygon, fpath="data/search_polygon.shp", crs_num=4326):
 
 def check_file_processed(fname, final_data_path="./data/data_processed/", zip_file_given=False):
     """
-    Check if a file has already been processed.
+    Check if a file has already been processed, from the project's state database.
 
     Parameters
     ----------
@@ -131,18 +147,17 @@ def check_file_processed(fname, final_data_path="./data/data_processed/", zip_fi
     fname = basename(fname)
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = join(final_data_path, ".processed")
-    file_suffix = ".done"
-    meta_file_exists = isfile(join(meta_dir, fname + file_suffix))
-    og_file_exists = isfile(join(final_data_path, fname))
-    if meta_file_exists and og_file_exists:
-        return True
-    return False
+    state = get_state_db(final_data_path)
+    if fname.endswith("_cog.tif"):
+        output_path = state.cog_path(product_title(fname))
+    else:
+        output_path = state.processed_path(product_title(fname))
+    return output_path is not None and isfile(output_path)
 
 
 def create_proc_metadata(fname, final_data_path="./data/data_processed/", zip_file_given=False):
     """
-    Creates metadata that the file has been processed for future use in '.processed'.
+    Records in the project's state database that the file has been processed, for future use.
 
     Parameters
     ----------
@@ -164,8 +179,11 @@ def create_proc_metadata(fname, final_data_path="./data/data_processed/", zip_fi
     fname = basename(fname)
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = join(final_data_path, ".processed")
-    Path(join(meta_dir, fname + ".done")).touch()
+    state = get_state_db(final_data_path)
+    if fname.endswith("_cog.tif"):
+        state.mark_cog(product_title(fname), join(final_data_path, fname))
+    else:
+        state.mark_processed(product_title(fname), join(final_data_path, fname))
     return
 
 
@@ -206,11 +224,46 @@ def reformat_geotif(input_fname, output_fname=None):
     return output_fname
 
 
-def download_and_process_product(
-    product, data_directory, del_intermediate=True, download_from_thredds=False
-):
+def clip_to_aois(cog_fname, aoi_ids, cutlines, final_data_path):
     """
-    Downloads and processes a Sentinel-1 product from an EODAG product
+    Clips a COG to each AOI it serves in a batch run, as data_processed/aois/<aoi id>/<name>.
+
+    Parameters
+    ----------
+    cog_fname : str
+        The path of the COG to clip.
+    aoi_ids : list of str
+        The AOIs the product serves.
+    cutlines : dict
+        {aoi id: path of a vector file holding the AOI}, from aoi_batch.write_cutlines.
+    final_data_path : str
+        The directory of the processed data.
+
+    Returns
+    -------
+    list of str
+        The paths of the clipped COGs.
+    """
+    outputs = []
+    for aoi_id in aoi_ids:
+        output_fname = join(final_data_path, "aois", aoi_id, basename(cog_fname))
+        os.makedirs(os.path.dirname(output_fname), exist_ok=True)
+        options = gdal.WarpOptions(
+            format="COG",
+            cutlineDSName=cutlines[aoi_id],
+            cropToCutline=True,
+            dstNodata=0,
+            creationOptions=["COMPRESS=LZW", "PREDICTOR=2", "NUM_THREADS=ALL_CPUS"],
+        )
+        d = gdal.Warp(output_fname, cog_fname, options=options)
+        d = None
+        outputs.append(output_fname)
+    return outputs
+
+
+class ProductJob:
+    """
+    The state of a single product as it moves through the download, processing and COG stages.
 
     Parameters
     ----------
@@ -222,71 +275,430 @@ def download_and_process_product(
         Whether to delete intermediate files after processing. Default is True.
     download_from_thredds : bool
         Whether to download the product from THREDDS instead of from EODAG. Default is False.
+    max_download_attempts : int
+        The most times to try downloading the product if downloads are corrupt. Default is 3.
+    provider_limits : download_utils.ProviderLimits, optional
+        Shared limits on concurrent downloads per provider
+    progress : download_utils.AggregateProgress, optional
+        Shared progress of all downloads
+    mirror_roots : list of str, optional
+        Local directories to look for the product in before downloading it
+    verify_mirror_checksums : bool
+        Whether a mirror copy is checked against the provider's checksum. Default is True.
+    aoi_cutlines : dict, optional
+        In a batch run, {aoi id: cutline file} of the AOIs. The COG is clipped to each
+        AOI the product serves (its "aoi_ids" property).
+    planned : str, optional
+        The work planner's group for the product (see work_planner.GROUPS). With "cog", only
+        the COG is left, so the product is neither downloaded nor run through the container.
+    worker_pool : docker_processing.WorkerPool, optional
+        Long-lived SNAP workers to process the product on, rather than a container of its own
+    """
+
+    def __init__(
+        self,
+        product,
+        data_directory,
+        del_intermediate=True,
+        download_from_thredds=False,
+        max_download_attempts=3,
+        provider_limits=None,
+        progress=None,
+        mirror_roots=None,
+        verify_mirror_checksums=True,
+        aoi_cutlines=None,
+        planned=None,
+        worker_pool=None,
+    ):
+        self.product = product
+        self.data_directory = data_directory
+        self.del_intermediate = del_intermediate
+        self.download_from_thredds = download_from_thredds
+        self.max_download_attempts = max(1, int(max_download_attempts))
+        self.provider_limits = provider_limits or ProviderLimits({})
+        self.progress = progress or AggregateProgress()
+        self.mirror_roots = mirror_roots or []
+        self.verify_mirror_checksums = verify_mirror_checksums
+        self.aoi_cutlines = aoi_cutlines
+        self.planned = planned
+        self.worker_pool = worker_pool
+        self.raw_data_path = os.path.join(data_directory, "data_raw")
+        self.final_data_path = os.path.join(data_directory, "data_processed")
+        # Set once the product has been downloaded
+        self.fname = None
+
+    @property
+    def title(self):
+        return self.product.properties["title"]
+
+    @property
+    def provider(self):
+        """The provider the product is downloaded from"""
+        if self.download_from_thredds:
+            return "thredds"
+        return getattr(self.product, "provider", None) or "unknown"
+
+    @property
+    def aoi_ids(self):
+        """The AOIs of a batch run this product serves"""
+        return self.product.properties.get("aoi_ids") or []
+
+    @property
+    def fpath_proc(self):
+        """Path of the raw snappy output for this product"""
+        return join(self.final_data_path, os.path.basename(self.fname))[:-4] + "_processed.tif"
+
+    @property
+    def cog_fname(self):
+        """Path of the final COG for this product"""
+        return re.sub("(.tif)$", "_cog.tif", self.fpath_proc)
+
+    def __str__(self):
+        return self.title
+
+
+def _download(job):
+    """Downloads a job's product while it holds a provider slot, feeding the shared progress"""
+    job.progress.started()
+    # EODAG makes its own requests, so it is governed by the host of its download link
+    eodag_url = None if job.download_from_thredds else job.product.properties.get("downloadLink")
+    # Individual bars are hidden when several downloads share the terminal
+    progress_callback = ProductProgressCallback(
+        job.progress, mininterval=0.1, disable=job.progress.quiet_bars, throttle_url=eodag_url
+    )
+    progress_callback.desc = str(job.product.properties.get("id", ""))
+    try:
+        if get_s3_archive() is not None:
+            # Products missing from the archive are downloaded as usual
+            fname = download_product_s3(
+                job.product, job.raw_data_path, progress_callback=progress_callback
+            )
+            if fname is not None:
+                return fname
+        # NCI's THREDDS dataserver is a publicly accessible data repository
+        # It does not need authentication. The top-level repo is here:
+        # https://dapds00.nci.org.au/thredds/catalog.html
+        if job.download_from_thredds:
+            return download_product_thredds(
+                job.product, job.raw_data_path, progress_callback=progress_callback
+            )
+        if not eodag_url:
+            return job.product.download(extract=False, progress_callback=progress_callback)
+        with http_transport.connection(eodag_url):
+            http_transport.before_request(eodag_url)
+            return job.product.download(extract=False, progress_callback=progress_callback)
+    finally:
+        progress_callback.close()
+        job.progress.stopped()
+
+
+def download_stage(job):
+    """
+    Downloads the product of a ProductJob. First stage of the pipeline.
+
+    Parameters
+    ----------
+    job : ProductJob
+        The job to download the product for.
 
     Returns
     -------
-    None
+    ProductJob or None
+        The job, or None if the product has already been processed and needs no more work.
     """
-
-    raw_data_path = os.path.join(data_directory, "data_raw")
-    final_data_path = os.path.join(data_directory, "data_processed")
-    # --------------------------------
-    # Download file
     log.info("-" * 40)
-    log.info(f"Starting download for product {product.properties['title']}")
-    # NCI's THREDDS dataserver is a publicly accessible data repository
-    # It does not need authentication. The top-level repo is here:
-    # https://dapds00.nci.org.au/thredds/catalog.html
-    if download_from_thredds:
-        fname = download_product_thredds(product, raw_data_path)
+    log.info(f"Starting download for product {job.title}")
+    get_state_db(job.raw_data_path).mark_searched(
+        job.title, url=job.product.remote_location, provider=job.provider
+    )
+    if job.planned == "cog":
+        # The snappy output is already there, only its name is needed from the zip
+        job.fname = get_fpath(job.product, job.raw_data_path)
+        log.info(f"Only the COG of {job.title} is left, skipping its download")
+        return job
+    # A copy in the shared product store or a local mirror saves the download altogether
+    job.fname = fetch_from_store(job.product, job.raw_data_path) or fetch_from_mirror(
+        job.product, job.raw_data_path, job.mirror_roots, job.verify_mirror_checksums
+    )
+    for attempt in range(1, job.max_download_attempts + 1):
+        if job.fname is not None:
+            break
+        try:
+            with job.provider_limits.slot(job.provider):
+                job.fname = _download(job)
+            # Catch corrupt zips here, rather than after paying for a container and JVM start up
+            verify_safe_zip(job.fname, polarisations=thredds_polarisations)
+            if not job.download_from_thredds:
+                # Records the download, and moves it into the product store if there is one
+                declare_downloaded(job.product, job.raw_data_path, job.fname)
+            break
+        except CorruptDownloadError as exc:
+            log.error(
+                f"Download {attempt}/{job.max_download_attempts} of {job.title} is corrupt: {exc}"
+            )
+            remove_download(job.product, job.raw_data_path, job.fname)
+            job.fname = None
     else:
-        fname = product.download(extract=False)
+        raise CorruptDownloadError(
+            f"Giving up on {job.title} after {job.max_download_attempts} corrupt downloads"
+        )
 
-    fpath_proc = join(final_data_path, os.path.basename(fname))[:-4] + "_processed.tif"
-    cog_fname = re.sub("(.tif)$", "_cog.tif", fpath_proc)
+    if check_file_processed(job.cog_fname, job.final_data_path, zip_file_given=False):
+        log.info(f"Skipping processing {job.cog_fname} as it already exists.")
+        return None
+    return job
 
-    if check_file_processed(cog_fname, final_data_path, zip_file_given=False):
-        log.info(f"Skipping processing {cog_fname} as it already exists.")
-        return
 
-    # --------------------------------
-    # Pre-process file
+def process_stage(job, slots=None):
+    """
+    Runs the snappy docker container over a downloaded product. Second stage of the pipeline.
+
+    Parameters
+    ----------
+    job : ProductJob
+        A job whose product has been downloaded.
+    slots : docker_processing.ContainerSlots, optional
+        The shares of the host the containers run within
+
+    Returns
+    -------
+    ProductJob or None
+        The job, or None if the container did not produce an output.
+    """
     log.info("-" * 40)
-    log.info(f"   Starting snappy processing for product {product.properties['title']}")
-    run_docker_container(fname, data_directory=data_directory)
+    if job.planned == "cog":
+        return job
+    log.info(f"   Starting snappy processing for product {job.title}")
+    if job.worker_pool is not None:
+        status = job.worker_pool.process(basename(job.fname))
+        log.info(
+            f"   {job.title} {status['state']} on SNAP worker {status.get('worker')} "
+            f"in {status.get('seconds', 0):.0f}s"
+        )
+    else:
+        run_docker_container(job.fname, data_directory=job.data_directory, slots=slots)
+
+    if not os.path.isfile(job.fpath_proc):
+        log.error(f" File {job.fpath_proc} does not exist.")
+        return None
+    return job
+
+
+def process_batch_stage(jobs, recycle_every=0, max_heap_fraction=None, slots=None):
+    """
+    Runs the snappy docker container once over a batch of downloaded products, in place of
+    process_stage when products are batched (see processing_batch_size in main_config.py).
 
-    # --------------------------------
-    # reformat file
+    Parameters
+    ----------
+    jobs : list of ProductJob
+        Jobs whose products have been downloaded.
+    recycle_every : int, optional
+        The container's JVM is restarted after this many products
+    max_heap_fraction : float, optional
+        The container's JVM is restarted once more than this fraction of its heap is in use
+    slots : docker_processing.ContainerSlots, optional
+        The shares of the host the containers run within
+
+    Returns
+    -------
+    list of ProductJob or None
+        Each job, or None if the container did not produce its output.
+    """
     log.info("-" * 40)
-    log.info(f"   Starting cog reformatting for product {product.properties['title']}")
-    if not os.path.isfile(fpath_proc):
-        log.error(f" File {fpath_proc} does not exist.")
-        return
+    to_process = [job for job in jobs if job.planned != "cog"]
+    if to_process:
+        log.info(f"   Starting snappy processing for a batch of {len(to_process)} products")
+        run_docker_container(
+            file_list=[basename(job.fname) for job in to_process],
+            data_directory=to_process[0].data_directory,
+            recycle_every=recycle_every,
+            max_heap_fraction=max_heap_fraction,
+            slots=slots,
+        )
+    results = []
+    for job in jobs:
+        if os.path.isfile(job.fpath_proc):
+            results.append(job)
+        else:
+            log.error(f" File {job.fpath_proc} does not exist.")
+            results.append(None)
+    return results
+
+
+def make_cog(fpath_proc, final_data_path, del_intermediate=True, aoi_ids=None, aoi_cutlines=None):
+    """
+    Reformats a snappy output into a COG, records it and cleans up
+
+    Parameters
+    ----------
+    fpath_proc : str
+        The snappy output, <title>_processed.tif
+    final_data_path : str
+        The directory where processed files are stored
+    del_intermediate : bool, optional
+        Whether to delete the snappy output once the COG is made. Default is True.
+    aoi_ids : list of str, optional
+        The AOIs of a batch run the product serves, to clip the COG to
+    aoi_cutlines : dict, optional
+        {aoi id: cutline file} of the AOIs of a batch run
 
+    Returns
+    -------
+    str
+        The COG
+    """
+    cog_fname = re.sub("(.tif)$", "_cog.tif", fpath_proc)
     reformat_geotif(fpath_proc)
+    if aoi_cutlines and aoi_ids:
+        log.info(f"   Clipping {basename(cog_fname)} to AOIs {aoi_ids}")
+        clip_to_aois(cog_fname, aoi_ids, aoi_cutlines, final_data_path)
     create_proc_metadata(cog_fname, final_data_path, zip_file_given=False)
     # Clean up
     if del_intermediate:
         try:
             os.remove(fpath_proc)
-            os.remove(
-                join(data_directory, "data_processed", ".processed", basename(fpath_proc) + ".done")
-            )
-        except ValueError:
+        except (ValueError, OSError):
             log.error("@" * 10)
             log.error("Process likely failed at an earlier step, continuing")
             log.error("@" * 10)
+    return cog_fname
 
-    log.info(f"All done for {product.properties['title']}")
+
+def cog_stage(job):
+    """
+    Reformats the snappy output of a product into a COG and cleans up. Last stage of the pipeline.
+
+    Parameters
+    ----------
+    job : ProductJob
+        A job whose product has been processed by snappy.
+
+    Returns
+    -------
+    ProductJob
+        The finished job.
+    """
+    log.info("-" * 40)
+    log.info(f"   Starting cog reformatting for product {job.title}")
+    make_cog(
+        job.fpath_proc,
+        job.final_data_path,
+        job.del_intermediate,
+        aoi_ids=job.aoi_ids,
+        aoi_cutlines=job.aoi_cutlines,
+    )
+    log.info(f"All done for {job.title}")
     log.info("-" * 20)
+    return job
+
+
+def download_and_process_product(
+    product, data_directory, del_intermediate=True, download_from_thredds=False
+):
+    """
+    Downloads and processes a Sentinel-1 product from an EODAG product, one stage after another.
+
+    Parameters
+    ----------
+    product : eodag.api.product.EOProduct
+        A queried Sentinel-1 product object from EODAG.
+    data_directory : str
+        The directory where the product should be downloaded and processed.
+    del_intermediate : bool
+        Whether to delete intermediate files after processing. Default is True.
+    download_from_thredds : bool
+        Whether to download the product from THREDDS instead of from EODAG. Default is False.
+
+    Returns
+    -------
+    None
+
+    See Also
+    --------
+    run_all : runs the same stages as an overlapped pipeline
+    """
+    job = ProductJob(product, data_directory, del_intermediate, download_from_thredds)
+    for stage in (download_stage, process_stage, cog_stage):
+        job = stage(job)
+        if job is None:
+            return
     return
 
 
-def run_all(download_from_thredds, data_directory, search_criteria, del_intermediate):
+def log_product_error(stage_name, job, exc):
+    """
+    Logs an exception raised while a product was in one of the pipeline stages.
+    Processing continues with the other products.
+    """
+    if isinstance(exc, AuthenticationError):
+        log.error("=" * 60)
+        log.error("***AUTHENTICATION ERROR***")
+        log.error("Authentication provided likely is not correct.")
+        log.error("Processing will attempt to continue just")
+        log.error("in case files are already present.")
+        log.error("If this isnt wanted, CTRL + C out.")
+        log.error("The exception is: ", exc_info=exc)
+        log.error("End of exception")
+        log.error("=" * 60)
+    else:
+        log.error("=" * 60)
+        log.error(
+            f"Non exit exception caught in {stage_name} stage for {job}. "
+            "Program will try again in case it was a timeout."
+        )
+        log.error("Exception is:", exc_info=exc)
+        log.error("End of exception")
+        log.error("=" * 60)
+        log.error("Continuing...")
+
+
+def annotate_product(product, *annotators):
+    """Records the overlaps of a search result with the AOIs, for each annotator given"""
+    for annotator in annotators:
+        if annotator is not None:
+            product = annotator.annotate(product)
+    return product
+
+
+def run_all(
+    download_from_thredds,
+    data_directory,
+    search_criteria,
+    del_intermediate,
+    num_download_workers=1,
+    num_processing_workers=None,
+    num_cog_workers=1,
+    pipeline_queue_size=2,
+    num_snap_workers=0,
+    processing_batch_size=1,
+    processing_batch_wait=300,
+    jvm_recycle_every=0,
+    jvm_max_heap_fraction=None,
+    container_sizing=None,
+    max_download_attempts=3,
+    max_downloads_per_provider=None,
+    search_cache_dir=".search_cache",
+    search_cache_ttl_hours=24,
+    search_sharding=None,
+    thredds_index_options=None,
+    local_mirror_roots=None,
+    verify_mirror_checksums=True,
+    product_store_gc=False,
+    aoi=None,
+    min_aoi_overlap_fraction=0,
+    min_aoi_overlap_km2=0,
+    aoi_batch=None,
+    deduplication=None,
+    archive_data_dir=None,
+    dry_run=False,
+):
     """
     Function to be called from main.
     It retrieves products from EODAG with given search criteria and bounds,
     downloads and processes the products using eodag API and other helper functions.
+    Downloading, snappy processing and COG conversion run as separate pipeline stages,
+    so the next product downloads while the current one is in the container.
 
     Parameters
     ----------
@@ -294,28 +706,92 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
         flag to download the products from thredds or not.
     data_directory (str)
         path to the directory where the downloaded products will be saved
-    bounds (Tuple)
-        tuple of (min_lon,min_lat,max_lon,max_lat) for spatial search
     search_criteria (Dict)
         dictionary of key-value pairs for filtering the search results
     del_intermediate (bool)
         flag to delete intermediate files (eg the raw output of snappy when computed the cog)
+    num_download_workers (int)
+        number of products downloaded at the same time
+    num_processing_workers (int)
+        number of docker containers run at the same time, each with its own share of the host's
+        CPUs and memory. None works it out from the host (see docker_processing.partition_host)
+    num_cog_workers (int)
+        number of COG conversions run at the same time
+    pipeline_queue_size (int)
+        maximum number of products waiting between two stages
+    num_snap_workers (int)
+        number of long-lived SNAP worker containers the products are processed on,
+        0 to start a container for every product
+    processing_batch_size (int)
+        without SNAP workers, most products processed by one container run
+    processing_batch_wait (float)
+        seconds a product waits for its batch to fill before the batch is started short
+    jvm_recycle_every (int)
+        products a container's JVM processes before it is restarted, 0 for no limit
+    jvm_max_heap_fraction (float)
+        fraction of the heap in use after a product at which a container's JVM is restarted
+    container_sizing (Dict)
+        options for splitting the host between containers: "min_cpus", "min_memory_gb" and
+        "heap_fraction" (see docker_processing.partition_host)
+    max_download_attempts (int)
+        how many times a corrupt download is downloaded again before giving up on it
+    max_downloads_per_provider (Dict)
+        maximum concurrent downloads from each provider, e.g. {"sara": 2, "thredds": 4}
+    search_cache_dir (str)
+        directory (relative to data_directory) where search results are cached
+    search_cache_ttl_hours (float)
+        how long cached search results are reused for, 0 to always search again
+    search_sharding (Dict)
+        options for splitting the search into parallel date windows (see search_cache),
+        or None to search page by page
+    thredds_index_options (Dict)
+        options for finding products in the THREDDS index (see thredds_index.search_index)
+        when downloading from THREDDS, or None to search with EODAG
+    local_mirror_roots (List)
+        local directories searched for a product before it is downloaded
+    verify_mirror_checksums (bool)
+        check mirror copies against the provider's checksum (when there is one)
+    product_store_gc (bool)
+        delete the products in the shared product store no project links to any more
+    aoi (List or str)
+        the area of interest (see footprint_filter.load_aoi). Products overlapping it less than
+        min_aoi_overlap_fraction (of the aoi) or min_aoi_overlap_km2 are not downloaded.
+        None downloads every product found.
+    min_aoi_overlap_fraction (float)
+        smallest fraction of the aoi a product must cover
+    min_aoi_overlap_km2 (float)
+        smallest area of the aoi (km2) a product must cover
+    aoi_batch (Dict)
+        options for a batch run over many AOIs: "aoi_file", "id_field" and "clip_outputs".
+        One search covers every AOI, and each product is processed once for all the AOIs it
+        serves. None runs over the search criteria's geometry alone.
+    deduplication (Dict)
+        options for keeping one product per acquisition (see dedup.Deduplicator),
+        or None to download every version found
+    archive_data_dir (str)
+        where the container archives raw zips after processing them, on the host
+    dry_run (bool)
+        only log the work plan of the products found (see work_planner), without downloading
+        or processing anything
 
     Returns:
     ----------
-    None
+    work_planner.WorkPlan or None
+        The work plan, on a dry run
     """
 
     raw_data_path = os.path.join(data_directory, "data_raw")
     final_data_path = os.path.join(data_directory, "data_processed")
+    container_sizing = container_sizing or {}
 
-    # raw_data_path = os.path.join(data_directory, 'data_raw')
-    # final_data_path = os.path.join(data_directory, 'data_processed')
     os.makedirs(raw_data_path, exist_ok=True)
+    # Marker files left by earlier versions are imported into the state database, once
+    get_state_db(raw_data_path).import_markers(raw_data_path, final_data_path)
 
     os.environ["EODAG__SARA__DOWNLOAD__OUTPUTS_PREFIX"] = os.path.abspath(raw_data_path)
 
-    if not download_from_thredds:
+    # Searching needs no credentials, so a dry run does not ask for them
+    if not download_from_thredds and not dry_run:
         os.environ["EODAG__SARA__AUTH__CREDENTIALS__USERNAME"] = input(
             "Please enter your SARA username, then press ENTER (not SHIFT+ENTER)"
         )
@@ -325,43 +801,224 @@ def run_all(download_from_thredds, data_directory, search_criteria, del_intermed
 
     setup_logging(verbose=2)
 
-    dag = EODataAccessGateway()
-
-    dag.set_preferred_provider("sara")
-
-    search_products = dag.search_all(
-        **search_criteria
-    )  # This should log the number of search products
+    aoi_matcher = None
+    aoi_cutlines = None
+    if aoi_batch is not None:
+        aois = load_aois(aoi_batch["aoi_file"], id_field=aoi_batch.get("id_field"))
+        aoi_matcher = AoiMatcher(aois)
+        # A single search over the box around all of the AOIs
+        search_criteria = dict(search_criteria, geom=union_search_geom(aois))
+        if aoi_batch.get("clip_outputs", True):
+            aoi_cutlines = write_cutlines(aois, os.path.join(final_data_path, "aois", ".cutlines"))
+
+    footprint_filter = None
+    if aoi is not None:
+        footprint_filter = FootprintFilter(
+            load_aoi(aoi),
+            min_overlap_fraction=min_aoi_overlap_fraction,
+            min_overlap_km2=min_aoi_overlap_km2,
+        )
 
-    for product in search_products:
-        log.info("=" * 60)
-        log.info(f"Now processing file {product.properties['title']}")
-        try:
-            download_and_process_product(
+    if download_from_thredds and thredds_index_options is not None:
+        # The THREDDS index knows each product's url, so EODAG is not needed at all
+        index_options = dict(thredds_index_options)
+        index_dir = index_options.pop("index_dir", ".thredds_index")
+        search_products = search_index(
+            search_criteria, index_dir=os.path.join(data_directory, index_dir), **index_options
+        )
+        if footprint_filter is not None:
+            search_products = map(footprint_filter.annotate, search_products)
+        if aoi_matcher is not None:
+            search_products = map(aoi_matcher.annotate, search_products)
+    else:
+        dag = EODataAccessGateway()
+
+        dag.set_preferred_provider("sara")
+
+        # Products are streamed from the search (or its cache) as each page arrives
+        search_products = cached_search(
+            dag,
+            search_criteria,
+            cache_dir=os.path.join(data_directory, search_cache_dir),
+            ttl_hours=search_cache_ttl_hours,
+            annotate=lambda product: annotate_product(product, footprint_filter, aoi_matcher),
+            **(search_sharding or {}),
+        )
+    if footprint_filter is not None:
+        # Products only clipping the AOI are dropped before anything is downloaded
+        search_products = footprint_filter.filter(search_products)
+    if aoi_matcher is not None:
+        # Products serving none of the AOIs are dropped, the others are downloaded once
+        search_products = aoi_matcher.filter(search_products)
+    if deduplication is not None:
+        # Reprocessed versions of an acquisition, or copies at other providers, are skipped
+        search_products = Deduplicator(**deduplication).filter(search_products)
+
+    # Products already processed are dropped before they cost a download or a container
+    planner = WorkPlanner(
+        data_directory,
+        get_state_db(raw_data_path),
+        archive_dir=archive_data_dir,
+        store=get_product_store(),
+    )
+    if dry_run:
+        plan = planner.plan(product.properties["title"] for product in search_products)
+        plan.log(verbose=True)
+        return plan
+
+    provider_limits = ProviderLimits(max_downloads_per_provider)
+    progress = AggregateProgress(quiet_bars=num_download_workers > 1)
+
+    def new_jobs():
+        for product, planned in planner.pending(search_products):
+            log.info("=" * 60)
+            log.info(f"Now processing file {product.properties['title']}")
+            yield ProductJob(
                 product,
                 data_directory=data_directory,
                 del_intermediate=del_intermediate,
                 download_from_thredds=download_from_thredds,
+                max_download_attempts=max_download_attempts,
+                provider_limits=provider_limits,
+                progress=progress,
+                mirror_roots=local_mirror_roots,
+                verify_mirror_checksums=verify_mirror_checksums,
+                aoi_cutlines=aoi_cutlines,
+                planned=planned,
+                worker_pool=worker_pool,
             )
-        except AuthenticationError as e:
-            log.error("=" * 60)
-            log.error("***AUTHENTICATION ERROR***")
-            log.error("Authentication provided likely is not correct.")
-            log.error("Processing will attempt to continue just")
-            log.error("in case files are already present.")
-            log.error("If this isnt wanted, CTRL + C out.")
-            log.exception("The exception is: ")
-            log.error("End of exception")
-            log.error("=" * 60)
-        except Exception:
-            log.error("=" * 60)
-            log.exception(
-                f"Non exit exception caught. Program will try again in case it was a timeout."
+
+    worker_pool = None
+    slots = None
+    if num_snap_workers:
+        # Each worker has its own share of the host's CPUs and memory. The workers are only
+        # started by the first product to process, so a rerun with nothing left starts none.
+        worker_pool = WorkerPool(
+            data_directory, num_workers=num_snap_workers, sizing=container_sizing
+        )
+        # Enough processing threads to keep every worker busy
+        num_processing_workers = max(num_processing_workers or 1, num_snap_workers)
+    else:
+        # As many containers run at once as the host is split between
+        slots = ContainerSlots(partition_host(num_processing_workers, **container_sizing))
+        num_processing_workers = len(slots)
+
+    stages = [
+        # Products are handed to processing in search order, however the downloads finish
+        Stage("download", download_stage, workers=num_download_workers, ordered=True),
+        process_stage_of(
+            num_processing_workers,
+            None if worker_pool is not None else processing_batch_size,
+            processing_batch_wait,
+            jvm_recycle_every,
+            jvm_max_heap_fraction,
+            slots,
+        ),
+        Stage("cog", cog_stage, workers=num_cog_workers),
+    ]
+    try:
+        run_pipeline(
+            new_jobs(), stages, queue_size=pipeline_queue_size, on_error=log_product_error
+        )
+    finally:
+        if worker_pool is not None:
+            worker_pool.stop()
+    progress.log()
+    if get_product_store() is not None and product_store_gc:
+        get_product_store().gc()
+
+
+def process_stage_of(
+    workers, batch_size=None, batch_wait=0, recycle_every=0, max_heap_fraction=None, slots=None
+):
+    """The processing stage of the pipeline, batched when batch_size is more than 1"""
+    if not batch_size or batch_size <= 1:
+        return Stage("processing", functools.partial(process_stage, slots=slots), workers=workers)
+    return Stage(
+        "processing",
+        functools.partial(
+            process_batch_stage,
+            recycle_every=recycle_every,
+            max_heap_fraction=max_heap_fraction,
+            slots=slots,
+        ),
+        workers=workers,
+        batch_size=batch_size,
+        batch_wait=batch_wait,
+    )
+
+
+def process_downloaded(
+    data_directory,
+    del_intermediate=True,
+    archive_data_dir=None,
+    dry_run=False,
+    recycle_every=0,
+    max_heap_fraction=None,
+    num_containers=None,
+    container_sizing=None,
+):
+    """
+    Processes the zips already in data_raw, without searching or downloading.
+    The zips left to process are split between containers run at once (see
+    docker_processing.run_parallel_containers), and the COGs of their outputs (and of any
+    snappy outputs left by earlier runs) are made after.
+
+    Parameters
+    ----------
+    data_directory : str
+        The project's data directory
+    del_intermediate : bool, optional
+        Whether to delete the snappy outputs once their COGs are made. Default is True.
+    archive_data_dir : str, optional
+        Where the container archives raw zips after processing them, on the host
+    dry_run : bool, optional
+        Only log the work plan. Default is False.
+    recycle_every : int, optional
+        The container's JVM is restarted after this many products
+    max_heap_fraction : float, optional
+        The container's JVM is restarted once more than this fraction of its heap is in use
+    num_containers : int, optional
+        The number of containers run at once. By default it is worked out from the host.
+    container_sizing : dict, optional
+        Options for splitting the host between containers (see docker_processing.partition_host)
+
+    Returns
+    -------
+    work_planner.WorkPlan
+    """
+    raw_data_path = os.path.join(data_directory, "data_raw")
+    final_data_path = os.path.join(data_directory, "data_processed")
+    state = get_state_db(raw_data_path)
+    state.import_markers(raw_data_path, final_data_path)
+    planner = WorkPlanner(data_directory, state, archive_dir=archive_data_dir)
+    plan = planner.plan(planner.raw)
+    plan.log(verbose=dry_run)
+    if dry_run:
+        return plan
+    if plan["process"]:
+        # The heap each container needs is read from the zips themselves
+        slots = ContainerSlots(
+            partition_host(
+                num_containers,
+                product_paths=[join(raw_data_path, f"{title}.zip") for title in plan["process"]],
+                **(container_sizing or {}),
             )
-            log.exception("Exception is:")
-            log.error("End of exception")
-            log.error("=" * 60)
-            log.error("Continuing...")
+        )
+        run_parallel_containers(
+            [f"{title}.zip" for title in plan["process"]],
+            data_directory=data_directory,
+            slots=slots,
+            recycle_every=recycle_every,
+            max_heap_fraction=max_heap_fraction,
+        )
+    for title in plan["process"] + plan["cog"]:
+        fpath_proc = join(final_data_path, f"{title}_processed.tif")
+        if not isfile(fpath_proc):
+            log.error(f" File {fpath_proc} does not exist.")
+            continue
+        make_cog(fpath_proc, final_data_path, del_intermediate)
+    return plan
 
 
 def main():
@@ -369,18 +1026,93 @@ def main():
     from main_config import data_directory
     from main_config import search_criteria
     from main_config import del_intermediate
+    from main_config import num_download_workers
+    from main_config import num_processing_workers
+    from main_config import num_cog_workers
+    from main_config import pipeline_queue_size
+    from main_config import num_snap_workers
+    from main_config import processing_batch_size, processing_batch_wait
+    from main_config import jvm_recycle_every, jvm_max_heap_fraction
+    from main_config import container_sizing
+    from main_config import max_download_attempts
+    from main_config import max_downloads_per_provider
+    from main_config import thredds_download_connections
+    from main_config import http_timeout, http_max_retries
+    from main_config import http_backoff_seconds, http_backoff_max_seconds
+    from main_config import http_host_limits, http_default_limits
+    from main_config import search_cache_dir, search_cache_ttl_hours, search_sharding
+    from main_config import thredds_index_options
+    from main_config import local_mirror_roots, verify_mirror_checksums
+    from main_config import product_store_gc
+    from main_config import aoi, min_aoi_overlap_fraction, min_aoi_overlap_km2
+    from main_config import aoi_batch, deduplication
+    from main_config import archive_data_path
+
+    # Enough pooled connections for every ranged THREDDS download at once
+    http_transport.configure(
+        timeout=http_timeout,
+        max_retries=http_max_retries,
+        backoff_base=http_backoff_seconds,
+        backoff_max=http_backoff_max_seconds,
+        pool_size=max(16, num_download_workers * thredds_download_connections),
+        host_limits=http_host_limits,
+        default_limits=http_default_limits,
+    )
 
     log.info("Beggining log for new program run, inserting lines for visual clarity" + "\n" * 6)
     log.info("New program run:")
     log.info("=" * 60)
     data_directory = Path(data_directory).expanduser().as_posix()
     log.info(f"Data directory is {data_directory}")
+    archive_data_dir = host_path(archive_data_path, data_directory)
+    # e.g. python process_and_download.py --dry-run
+    dry_run = "--dry-run" in sys.argv[1:]
+    if "--process-downloaded" in sys.argv[1:]:
+        process_downloaded(
+            data_directory,
+            del_intermediate,
+            archive_data_dir,
+            dry_run=dry_run,
+            recycle_every=jvm_recycle_every,
+            max_heap_fraction=jvm_max_heap_fraction,
+            num_containers=num_processing_workers,
+            container_sizing=container_sizing,
+        )
+        http_transport.log_stats()
+        return
     run_all(
         download_from_thredds=download_from_thredds,
         data_directory=data_directory,
         search_criteria=search_criteria,
         del_intermediate=del_intermediate,
+        num_download_workers=num_download_workers,
+        num_processing_workers=num_processing_workers,
+        num_cog_workers=num_cog_workers,
+        pipeline_queue_size=pipeline_queue_size,
+        num_snap_workers=num_snap_workers,
+        processing_batch_size=processing_batch_size,
+        processing_batch_wait=processing_batch_wait,
+        jvm_recycle_every=jvm_recycle_every,
+        jvm_max_heap_fraction=jvm_max_heap_fraction,
+        container_sizing=container_sizing,
+        max_download_attempts=max_download_attempts,
+        max_downloads_per_provider=max_downloads_per_provider,
+        search_cache_dir=search_cache_dir,
+        search_cache_ttl_hours=search_cache_ttl_hours,
+        search_sharding=search_sharding,
+        thredds_index_options=thredds_index_options,
+        local_mirror_roots=local_mirror_roots,
+        verify_mirror_checksums=verify_mirror_checksums,
+        product_store_gc=product_store_gc,
+        aoi=aoi,
+        min_aoi_overlap_fraction=min_aoi_overlap_fraction,
+        min_aoi_overlap_km2=min_aoi_overlap_km2,
+        aoi_batch=aoi_batch,
+        deduplication=deduplication,
+        archive_data_dir=archive_data_dir,
+        dry_run=dry_run,
     )
+    http_transport.log_stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""
+Description: Downloads part of a remote zip with HTTP range requests. The zip's central
+             directory is read from the end of the file, then only the wanted members are
+             fetched, and written with a new central directory into a valid local zip.
+             Used to download a single polarisation of a dual-pol Sentinel-1 SAFE zip,
+             which skips about half of its bytes, or only some bursts of an SLC.
+
+             Members are copied as they are stored remotely (local header, compressed data and
+             any data descriptor), so nothing is decompressed or recompressed. Of a stored
+             member, only some byte ranges can be fetched, leaving the rest as a sparse hole.
+"""
+import io
+import logging
+import os
+import re
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from snappy_processing import http_transport
+
+log = logging.getLogger(__name__)
+
+# Sentinel-1 measurement TIFFs are named like s1a-iw-grd-vh-20230131t...-001.tiff
+MEASUREMENT_PATTERN = re.compile(r"/measurement/s1[a-d]-[^/]*?-(hh|hv|vh|vv)-[^/]*\.tiff$")
+
+# The zip comment of a partial SAFE zip, recording which polarisations or bursts it holds
+POLARISATION_COMMENT = "polarisations="
+BURSTS_COMMENT = "bursts="
+
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+
+class _TailFile(io.RawIOBase):
+    """
+    A read only file of `total` bytes of which only the last bytes are known,
+    enough for zipfile to read the central directory of a remote zip
+    """
+
+    def __init__(self, tail, total):
+        self.tail = tail
+        self.total = total
+        self.tail_start = total - len(tail)
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.total
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if self.position < self.tail_start:
+            raise zipfile.BadZipFile("Central directory is before the fetched tail")
+        start = self.position - self.tail_start
+        end = len(self.tail) if size is None or size < 0 else start + size
+        data = self.tail[start:end]
+        self.position += len(data)
+        return data
+
+
+def read_range(url, start, end):
+    """The bytes [start, end) of a url"""
+    response = http_transport.get(url, headers={"Range": f"bytes={start}-{end - 1}"})
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise IOError(f"Server did not honour a range request for {url}")
+    return response.content
+
+
+def read_central_directory(url, total, tail_size=1024 * 1024):
+    """
+    Reads the members of a remote zip from its central directory
+
+    Parameters
+    ----------
+    url : str
+        The url of the zip, on a server supporting range requests
+    total : int
+        The size of the zip in bytes
+    tail_size : int, optional
+        Bytes fetched from the end of the zip at first. Doubled until the central directory
+        is inside it. Default is 1 MiB.
+
+    Returns
+    -------
+    (list of zipfile.ZipInfo, int)
+        The members, with their offsets in the remote zip, and the offset of the central
+        directory (where the last member ends)
+    """
+    while True:
+        tail_size = min(tail_size, total)
+        tail = read_range(url, total - tail_size, total)
+        try:
+            with zipfile.ZipFile(_TailFile(tail, total)) as zf:
+                return zf.infolist(), zf.start_dir
+        except zipfile.BadZipFile:
+            if tail_size >= total:
+                raise
+            tail_size *= 2
+
+
+def member_ranges(members, central_directory_offset):
+    """
+    The [start, end) range of each member's whole record (local header, data and any data
+    descriptor) in the remote zip, each ending where the next record starts
+    """
+    ordered = sorted(members, key=lambda info: info.header_offset)
+    ends = [info.header_offset for info in ordered[1:]] + [central_directory_offset]
+    return {info.filename: (info.header_offset, end) for info, end in zip(ordered, ends)}
+
+
+def measurement_polarisation(name):
+    """The polarisation of a SAFE measurement TIFF (e.g. "VV"), or None for other members"""
+    match = MEASUREMENT_PATTERN.search(name)
+    return match.group(1).upper() if match else None
+
+
+def zip_polarisations(zf):
+    """
+    The polarisations a partial SAFE zip was downloaded with, from its comment,
+    or None for a whole zip
+    """
+    comment = zf.comment.decode("utf-8", "replace")
+    if not comment.startswith(POLARISATION_COMMENT):
+        return None
+    return [pol for pol in comment[len(POLARISATION_COMMENT):].split(",") if pol]
+
+
+def local_header_size(url, info):
+    """The size of a remote member's local header, which precedes its data"""
+    header = read_range(url, info.header_offset, info.header_offset + LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename} in {url}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def read_member(url, info):
+    """The (uncompressed) contents of a small member of a remote zip"""
+    start = info.header_offset + local_header_size(url, info)
+    if not info.compress_size:
+        return b""
+    data = read_range(url, start, start + info.compress_size)
+    if info.compress_type == zipfile.ZIP_STORED:
+        return data
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    raise NotImplementedError(f"{info.filename} in {url} uses compression {info.compress_type}")
+
+
+def _rewrite_crc(fd, info, dest):
+    """Sets the CRC of a stored member, written at `dest` of an open file, to its contents"""
+    header = os.pread(fd, LOCAL_HEADER_SIZE, dest)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    data_start = dest + LOCAL_HEADER_SIZE + name_length + extra_length
+    data_end = data_start + info.file_size
+    crc = 0
+    position = data_start
+    while position < data_end:
+        block = os.pread(fd, min(16 * 1024 * 1024, data_end - position), position)
+        crc = zlib.crc32(block, crc)
+        position += len(block)
+    os.pwrite(fd, struct.pack("<I", crc), dest + 14)
+    if info.flag_bits & 0x08:
+        # The data descriptor may or may not start with its signature
+        descriptor = data_start + info.compress_size
+        if os.pread(fd, 4, descriptor) == DATA_DESCRIPTOR_SIGNATURE:
+            descriptor += 4
+        os.pwrite(fd, struct.pack("<I", crc), descriptor)
+    info.CRC = crc
+
+
+def zip_bursts(zf):
+    """The bursts a trimmed SAFE zip was downloaded with, from its comment, or None"""
+    comment = zf.comment.decode("utf-8", "replace")
+    if not comment.startswith(BURSTS_COMMENT):
+        return None
+    return comment[len(BURSTS_COMMENT):]
+
+
+def is_partial(zf):
+    """Whether a SAFE zip was downloaded with only some polarisations or bursts"""
+    return zip_polarisations(zf) is not None or zip_bursts(zf) is not None
+
+
+def _fetch_record(url, start, end, fd, dest_offset, progress_callback, progress_lock):
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    with http_transport.stream(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server did not honour range request {headers['Range']} for {url}")
+        offset = dest_offset
+        for chunk in http_transport.iter_content(response, chunk_size=64 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            if progress_callback is not None:
+                with progress_lock:
+                    progress_callback.update(len(chunk))
+    if offset - dest_offset != end - start:
+        raise IOError(f"Range {start}-{end - 1} of {url} ended early")
+
+
+def download_members(
+    url,
+    fs_path,
+    members,
+    ranges,
+    comment=b"",
+    num_connections=4,
+    progress_callback=None,
+    sparse=None,
+):
+    """
+    Fetches some members of a remote zip into a new local zip
+
+    Parameters
+    ----------
+    url : str
+        The url of the zip
+    fs_path : str
+        The zip to write. It is written as <fs_path>.part and renamed once complete.
+    members : list of zipfile.ZipInfo
+        The members to fetch, from read_central_directory
+    ranges : dict
+        The {name: (start, end)} of every member's record, from member_ranges
+    comment : bytes, optional
+        The comment of the new zip
+    num_connections : int, optional
+        Number of ranges fetched at once. Default is 4.
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Progress bar to update as bytes arrive
+    sparse : dict, optional
+        {name: list of (start, end)} for stored (uncompressed) members of which only some byte
+        ranges are fetched. The rest of the member is left as a hole of zeros in the file,
+        and its CRC is made again to match.
+
+    Returns
+    -------
+    int
+        The number of bytes downloaded
+    """
+    sparse = sparse or {}
+    # Members keep their order, and are packed one after the other
+    members = sorted(members, key=lambda info: info.header_offset)
+    layout = []
+    fetches = []
+    offset = 0
+    for info in members:
+        start, end = ranges[info.filename]
+        layout.append((info, offset))
+        if info.filename in sparse:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Only part of {info.filename} is wanted, but it is compressed")
+            data_start = start + local_header_size(url, info)
+            data_end = data_start + info.compress_size
+            data_dest = offset + data_start - start
+            fetches.append((start, data_start, offset))
+            for range_start, range_end in sparse[info.filename]:
+                fetches.append(
+                    (data_start + range_start, data_start + range_end, data_dest + range_start)
+                )
+            # Any data descriptor after the data
+            fetches.append((data_end, end, offset + data_end - start))
+        else:
+            fetches.append((start, end, offset))
+        offset += end - start
+    total = offset
+    fetches = [(start, end, dest) for start, end, dest in fetches if end > start]
+    downloaded = sum(end - start for start, end, _ in fetches)
+    if progress_callback is not None:
+        progress_callback.reset(total=downloaded)
+    progress_lock = threading.Lock()
+
+    part_path = f"{fs_path}.part"
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Only the fetched ranges are written, so the rest of the file stays sparse
+        os.ftruncate(fd, total)
+        with ThreadPoolExecutor(max_workers=max(1, num_connections)) as executor:
+            futures = [
+                executor.submit(
+                    _fetch_record, url, start, end, fd, dest, progress_callback, progress_lock
+                )
+                for start, end, dest in fetches
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        for info, dest in layout:
+            if info.filename in sparse:
+                _rewrite_crc(fd, info, dest)
+    finally:
+        os.close(fd)
+
+    # Appending to a file that is not yet a zip makes zipfile write its central directory
+    # after the records, so the records are added to it with their new offsets
+    with zipfile.ZipFile(part_path, "a") as zf:
+        for info, dest in layout:
+            info.header_offset = dest
+            zf.filelist.append(info)
+            zf.NameToInfo[info.filename] = info
+        zf.start_dir = total
+        zf.comment = comment
+    os.replace(part_path, fs_path)
+    return downloaded
+
+
+def download_polarisations(
+    url, fs_path, total, polarisations, num_connections=4, progress_callback=None
+):
+    """
+    Downloads a Sentinel-1 SAFE zip without the measurement TIFFs of other polarisations.
+    Every other member (manifest, annotation, calibration, noise, ...) is kept, and the zip
+    comment records the polarisations, so verify_safe_zip knows the TIFFs left out.
+
+    Parameters
+    ----------
+    url : str
+        The url of the zip, on a server supporting range requests
+    fs_path : str
+        The zip to write
+    total : int
+        The size of the remote zip in bytes
+    polarisations : list of str
+        The polarisations to keep, e.g. ["VV"]
+    num_connections : int, optional
+        Number of members fetched at once. Default is 4.
+    progress_callback : eodag.utils.ProgressCallback, optional
+        Progress bar to update as bytes arrive
+
+    Returns
+    -------
+    int or None
+        The number of bytes downloaded, or None (with nothing downloaded) if the zip holds no
+        other polarisations, so it should be downloaded whole
+    """
+    polarisations = [pol.upper() for pol in polarisations]
+    members, central_directory_offset = read_central_directory(url, total)
+    wanted = [
+        info
+        for info in members
+        if measurement_polarisation(info.filename) in (None, *polarisations)
+    ]
+    if len(wanted) == len(members):
+        return None
+    if not any(measurement_polarisation(info.filename) for info in wanted):
+        raise ValueError(f"{url} has no measurements in polarisations {polarisations}")
+    ranges = member_ranges(members, central_directory_offset)
+    comment = (POLARISATION_COMMENT + ",".join(polarisations)).encode("utf-8")
+    size = download_members(
+        url,
+        fs_path,
+        wanted,
+        ranges,
+        comment=comment,
+        num_connections=num_connections,
+        progress_callback=progress_callback,
+    )
+    log.info(
+        f"Downloaded the {'/'.join(polarisations)} members of {url}: "
+        f"{size / 1e6:.0f} of {total / 1e6:.0f} MB"
+    )
+    return size
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Description: Reads Sentinel-1 zips from S3-compatible object storage (AWS, a provider's
+             bucket, our own archive, or a local MinIO for testing) with ranged GETs.
+             One boto3 client is shared by every download, with a connection pool sized for
+             the number of parts fetched at once, so connections are reused between parts.
+             boto3 is optional, and only needed when an S3 archive is configured.
+"""
+import logging
+import os
+import threading
+
+try:
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses S3 uses for a missing object
+MISSING_STATUSES = {"404", "NoSuchKey", "NotFound"}
+
+
+def product_fields(product):
+    """
+    The fields an object key template can use, from a product's title, e.g. for
+    S1A_IW_GRDH_1SDV_20230131T214327_...: title, id, mission (S1A), mode (IW),
+    product_type (GRDH), year, month, day
+    """
+    title = product.properties["title"]
+    parts = title.split("_")
+    start = parts[4] if len(parts) > 4 else ""
+    return {
+        "title": title,
+        "id": product.properties.get("id", title),
+        "mission": parts[0],
+        "mode": parts[1] if len(parts) > 1 else "",
+        "product_type": parts[2] if len(parts) > 2 else "",
+        "year": start[0:4],
+        "month": start[4:6],
+        "day": start[6:8],
+    }
+
+
+class S3Archive:
+    """
+    A bucket of Sentinel-1 zips, with keys made from each product's title.
+
+    Parameters
+    ----------
+    bucket : str
+        The bucket holding the zips
+    key_template : str, optional
+        The key of a product's zip, formatted with the fields of `product_fields`.
+        Default is "{title}.zip".
+    endpoint_url : str, optional
+        The S3 endpoint, e.g. "http://localhost:9000" for a local MinIO. Default is AWS.
+    region_name : str, optional
+        The bucket's region
+    profile_name : str, optional
+        The AWS credentials profile. By default credentials come from the environment
+        (AWS_ACCESS_KEY_ID, ...) or the default profile.
+    anonymous : bool, optional
+        Make unsigned requests, for public buckets. Default is False.
+    path_style : bool, optional
+        Address buckets as <endpoint>/<bucket>, as MinIO expects. Default is False.
+    max_concurrency : int, optional
+        The number of parts fetched at once, and the size of the connection pool. Default is 8.
+    part_size_mb : float, optional
+        The size of each ranged GET in MB. Default is 64.
+    verify_etag : bool, optional
+        Verify downloads against the md5 an object's ETag gives, if the catalogue gives no
+        checksum. Only for buckets whose ETags are md5s. The ETags of encrypted objects are
+        never used. Default is False.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key_template="{title}.zip",
+        endpoint_url=None,
+        region_name=None,
+        profile_name=None,
+        anonymous=False,
+        path_style=False,
+        max_concurrency=8,
+        part_size_mb=64,
+        verify_etag=False,
+    ):
+        if boto3 is None:
+            raise ImportError("boto3 is needed to download from S3, `pip install boto3`")
+        self.bucket = bucket
+        self.key_template = key_template
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.part_size = int(part_size_mb * 1024 * 1024)
+        self.verify_etag = verify_etag
+        config = Config(
+            max_pool_connections=self.max_concurrency,
+            retries={"max_attempts": 5, "mode": "adaptive"},
+            s3={"addressing_style": "path" if path_style else "auto"},
+            signature_version=UNSIGNED if anonymous else None,
+        )
+        session = boto3.session.Session(profile_name=profile_name)
+        self.client = session.client(
+            "s3", endpoint_url=endpoint_url, region_name=region_name, config=config
+        )
+
+    def key(self, product):
+        return self.key_template.format(**product_fields(product))
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    def head(self, key):
+        """
+        The size of an object, and the checksum its ETag gives (see etag_checksum)
+
+        Returns
+        -------
+        (int, tuple of (str, str) or None) or None
+            None if the object is not in the bucket
+        """
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if str(exc.response.get("Error", {}).get("Code")) in MISSING_STATUSES:
+                return None
+            raise
+        return response["ContentLength"], self.etag_checksum(response)
+
+    def etag_checksum(self, response):
+        """
+        The (algorithm, hex digest) the ETag of a HEAD response gives, or None. Only with
+        verify_etag, and only the ETag of an unencrypted object uploaded in one part is its md5:
+        a multipart ETag ends in "-<number of parts>", and server side encryption (e.g. SSE-KMS,
+        SSE-C, or MinIO's SSE) gives other ETags.
+        """
+        if not self.verify_etag:
+            return None
+        if response.get("ServerSideEncryption") or response.get("SSECustomerAlgorithm"):
+            return None
+        etag = response.get("ETag", "").strip('"')
+        if etag and "-" not in etag and len(etag) == 32:
+            return "md5", etag.lower()
+        return None
+
+    def fetch_range(self, key, start, end, fd, progress_callback=None, progress_lock=None):
+        """
+        Fetches bytes [start, end) of an object with a ranged GET,
+        and writes them at the same offset of an open file
+
+        Parameters
+        ----------
+        key : str
+            The object's key
+        start, end : int
+            The byte range to fetch, end is exclusive
+        fd : int
+            An os level file descriptor, opened for writing
+        progress_callback : eodag.utils.ProgressCallback, optional
+            Updated with the number of bytes written
+        progress_lock : threading.Lock, optional
+            Lock to hold while updating the progress callback from several threads
+        """
+        progress_lock = progress_lock or threading.Lock()
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}"
+        )
+        offset = start
+        body = response["Body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size=64 * 1024):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                if progress_callback is not None:
+                    with progress_lock:
+                        progress_callback.update(len(chunk))
+        finally:
+            body.close()
+        if offset != end:
+            raise IOError(f"Range {start}-{end - 1} of {self.uri(key)} ended early, at {offset}")
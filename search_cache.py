@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Description: Caches EODAG search results as a JSONL manifest, keyed by a hash of the search
+             criteria, so later runs with the same criteria skip the catalogue search.
+             Products are yielded page by page as the search runs (or line by line from the
+             manifest), so memory stays flat however many products a search finds.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from eodag import EOProduct
+
+from search_shards import sharded_search
+
+log = logging.getLogger(__name__)
+
+
+def criteria_key(search_criteria):
+    """
+    A stable hash of a set of search criteria, used to name its manifest
+
+    Parameters
+    ----------
+    search_criteria : dict
+        The keyword arguments given to the EODAG search
+
+    Returns
+    -------
+    str
+        Hex sha256 of the criteria, as sorted json
+    """
+    text = json.dumps(search_criteria, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def manifest_path(cache_dir, search_criteria):
+    """The path of the manifest for a set of search criteria"""
+    return Path(cache_dir) / f"search_{criteria_key(search_criteria)[:16]}.jsonl"
+
+
+def manifest_is_fresh(path, ttl_hours):
+    """Whether a finished manifest exists and is younger than `ttl_hours`"""
+    path = Path(path)
+    if ttl_hours is None or ttl_hours <= 0 or not path.is_file():
+        return False
+    return (time.time() - path.stat().st_mtime) < ttl_hours * 3600
+
+
+def register_downloader(dag, product):
+    """
+    Gives a product rebuilt from its geojson the download and auth plugins of its provider,
+    as `EODataAccessGateway.deserialize_and_register` does for a whole file.
+    """
+    if product.downloader is not None:
+        return product
+    plugins = dag._plugins_manager
+    downloader = plugins.get_download_plugin(product)
+    auth = product.downloader_auth
+    if auth is None:
+        try:
+            # eodag >= 3
+            auth = plugins.get_auth_plugin(downloader, product)
+        except TypeError:
+            auth = plugins.get_auth_plugin(product.provider)
+    product.register_downloader(downloader, auth)
+    return product
+
+
+def read_manifest(dag, path):
+    """
+    Yields the products of a manifest, one line at a time
+
+    Parameters
+    ----------
+    dag : eodag.EODataAccessGateway
+        The gateway whose plugins download the products
+    path : str or Path
+        The manifest to read
+
+    Yields
+    ------
+    eodag.api.product.EOProduct
+    """
+    with open(path, "r") as f:
+        header = json.loads(f.readline())
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["created"]))
+        log.info(f"Reusing search results cached at {created} in {path}")
+        for line in f:
+            if line.strip():
+                yield register_downloader(dag, EOProduct.from_geojson(json.loads(line)))
+
+
+def search_pages(dag, search_criteria):
+    """Yields the products of a search a page at a time, as each page arrives"""
+    count = 0
+    for page_num, page in enumerate(dag.search_iter_page(**search_criteria), start=1):
+        for product in page:
+            count += 1
+            yield product
+        log.info(f"Search page {page_num} done, {count} products so far")
+
+
+def search_and_record(products, search_criteria, path):
+    """
+    Yields products from a running search, writing them to the manifest as they pass.
+    The manifest is only put in place once the search has finished,
+    so an interrupted search is never reused.
+
+    Parameters
+    ----------
+    products : iterable of eodag.api.product.EOProduct
+        The products of the search, e.g. from `search_pages` or `sharded_search`
+    search_criteria : dict
+        The criteria of the search, recorded in the manifest's header
+    path : str or Path
+        Where to write the manifest
+
+    Yields
+    ------
+    eodag.api.product.EOProduct
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(path.name + ".part")
+    count = 0
+    with open(part_path, "w") as f:
+        header = {"search_criteria": search_criteria, "created": time.time()}
+        f.write(json.dumps(header, default=str) + "\n")
+        for product in products:
+            f.write(json.dumps(product.as_dict(), default=str, separators=(",", ":")) + "\n")
+            count += 1
+            yield product
+    os.replace(part_path, path)
+    log.info(f"Search found {count} products, cached in {path}")
+
+
+def cached_search(
+    dag,
+    search_criteria,
+    cache_dir,
+    ttl_hours=24,
+    shard_days=None,
+    search_workers=4,
+    tile_degrees=None,
+    target_shard_size=200,
+    annotate=None,
+):
+    """
+    Yields the products for a search, from the manifest of an earlier identical search
+    if it is younger than `ttl_hours`, otherwise by searching (and caching the results).
+    With `shard_days` the search is split into date windows searched in parallel,
+    see search_shards.sharded_search.
+
+    Parameters
+    ----------
+    dag : eodag.EODataAccessGateway
+        The gateway to search with
+    search_criteria : dict
+        Keyword arguments for the EODAG search
+    cache_dir : str or Path
+        Directory holding the manifests
+    ttl_hours : float, optional
+        How long a manifest is reused for. 0 or None always searches again. Default is 24.
+    shard_days : float, optional
+        Length of the first date window of a sharded search. None searches page by page.
+    search_workers : int, optional
+        Number of date windows searched at once. Default is 4.
+    tile_degrees : float, optional
+        Also split the search box into tiles of about this many degrees. Default is None.
+    target_shard_size : int, optional
+        The number of products each date window should return. Default is 200.
+    annotate : callable, optional
+        Called on each product before it is recorded (and again when it is read back, as
+        what it records may depend on settings outside the criteria), e.g.
+        footprint_filter.FootprintFilter.annotate. Returns the product.
+
+    Yields
+    ------
+    eodag.api.product.EOProduct
+    """
+    path = manifest_path(cache_dir, search_criteria)
+    if manifest_is_fresh(path, ttl_hours):
+        products = read_manifest(dag, path)
+        yield from products if annotate is None else map(annotate, products)
+        return
+    if shard_days:
+        products = sharded_search(
+            dag,
+            search_criteria,
+            shard_days=shard_days,
+            max_workers=search_workers,
+            tile_degrees=tile_degrees,
+            target_shard_size=target_shard_size,
+        )
+    else:
+        products = search_pages(dag, search_criteria)
+    if annotate is not None:
+        products = map(annotate, products)
+    yield from search_and_record(products, search_criteria, path)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Description: Splits a long catalogue search into date windows (and optionally AOI tiles),
+             which are searched in parallel. Results are yielded shard by shard in date order,
+             as soon as each shard is done, with duplicates from shard boundaries removed.
+             The window length adapts to how many products the earlier windows returned.
+"""
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+DATE_FMT = "%Y-%m-%dT%H:%M:%S"
+
+
+def parse_date(value):
+    """Parses a search date given as a datetime or an ISO string (with or without a time)"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    value = str(value).rstrip("Z")
+    for fmt in (DATE_FMT + ".%f", DATE_FMT, "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Could not understand the search date {value!r}")
+
+
+def split_geom(geom, tile_degrees):
+    """
+    Splits a {"lonmin", "latmin", "lonmax", "latmax"} search box into tiles of about
+    `tile_degrees` a side. Other geometries (or no tile size) are returned as one tile.
+    """
+    keys = ("lonmin", "latmin", "lonmax", "latmax")
+    if not tile_degrees or not isinstance(geom, dict) or not all(key in geom for key in keys):
+        return [geom]
+    lonmin, lonmax = sorted([geom["lonmin"], geom["lonmax"]])
+    latmin, latmax = sorted([geom["latmin"], geom["latmax"]])
+    num_lon = max(1, int(-(-(lonmax - lonmin) // tile_degrees)))
+    num_lat = max(1, int(-(-(latmax - latmin) // tile_degrees)))
+    step_lon = (lonmax - lonmin) / num_lon
+    step_lat = (latmax - latmin) / num_lat
+    return [
+        {
+            "lonmin": lonmin + i * step_lon,
+            "latmin": latmin + j * step_lat,
+            "lonmax": lonmin + (i + 1) * step_lon,
+            "latmax": latmin + (j + 1) * step_lat,
+        }
+        for i in range(num_lon)
+        for j in range(num_lat)
+    ]
+
+
+class WindowSizer:
+    """
+    Picks the length of the next date window from the products per day seen so far,
+    aiming for `target` products per window.
+    """
+
+    def __init__(self, initial_days, target, min_days=1, max_days=365):
+        self.days = float(initial_days)
+        self.target = target
+        self.min_days = min_days
+        self.max_days = max_days
+        self.products = 0
+        self.searched_days = 0.0
+
+    def record(self, days, num_products):
+        self.searched_days += days
+        self.products += num_products
+        if self.products:
+            per_day = self.products / self.searched_days
+            self.days = min(self.max_days, max(self.min_days, self.target / per_day))
+        else:
+            # Nothing found yet, so try bigger windows
+            self.days = min(self.max_days, self.days * 2)
+
+    def next_days(self):
+        return self.days
+
+
+def sharded_search(
+    dag, search_criteria, shard_days=30, max_workers=4, tile_degrees=None, target_shard_size=200
+):
+    """
+    Yields the products of a search, searching date windows (and AOI tiles) in parallel
+
+    Parameters
+    ----------
+    dag : eodag.EODataAccessGateway
+        The gateway to search with
+    search_criteria : dict
+        Keyword arguments for the EODAG search, with "start" and "end" dates
+    shard_days : float, optional
+        Length of the first date window in days. Later windows adapt. Default is 30.
+    max_workers : int, optional
+        Number of windows searched at once. Default is 4.
+    tile_degrees : float, optional
+        If given, a "geom" search box is also split into tiles of about this many degrees.
+    target_shard_size : int, optional
+        The number of products each window should return. Default is 200.
+
+    Yields
+    ------
+    eodag.api.product.EOProduct
+        In date window order. Products found by two shards are only yielded once.
+    """
+    start = parse_date(search_criteria["start"])
+    end = parse_date(search_criteria["end"])
+    tiles = split_geom(search_criteria.get("geom"), tile_degrees)
+    sizer = WindowSizer(shard_days, target_shard_size)
+    max_workers = max(1, int(max_workers))
+
+    def search_shard(window_start, window_end, geom):
+        criteria = dict(search_criteria)
+        criteria["start"] = window_start.strftime(DATE_FMT)
+        criteria["end"] = window_end.strftime(DATE_FMT)
+        if geom is not None:
+            criteria["geom"] = geom
+        return list(dag.search_all(**criteria))
+
+    def shards():
+        # Windows are made lazily, so each one is sized from the shards finished before it
+        window_start = start
+        while window_start < end:
+            window_end = min(end, window_start + timedelta(days=sizer.next_days()))
+            for geom in tiles:
+                yield window_start, window_end, geom
+            window_start = window_end
+
+    seen = set()
+    num_shards = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search") as executor:
+        shard_iter = shards()
+        while True:
+            # Keep every worker busy, but do not run far ahead of the consumer
+            while len(pending) < max_workers:
+                shard = next(shard_iter, None)
+                if shard is None:
+                    break
+                pending.append((shard, executor.submit(search_shard, *shard)))
+            if not pending:
+                break
+            (window_start, window_end, geom), future = pending.popleft()
+            products = future.result()
+            days = (window_end - window_start).total_seconds() / 86400
+            sizer.record(days / len(tiles), len(products))
+            num_shards += 1
+            new_products = 0
+            for product in products:
+                product_id = product.properties.get("id") or product.properties.get("title")
+                if product_id in seen:
+                    continue
+                seen.add(product_id)
+                new_products += 1
+                yield product
+            log.info(
+                f"Search shard {num_shards} ({window_start:%Y-%m-%d} to {window_end:%Y-%m-%d}) "
+                f"found {len(products)} products, {new_products} new. "
+                f"Next windows are {sizer.next_days():.1f} days"
+            )
+    log.info(f"Sharded search found {len(seen)} products in {num_shards} shards")
@@ -43,6 +43,39 @@ del_intermediate = True
 # Whether or not to download files from THREDDS
 download_from_thredds = True
 
+# All HTTP traffic (orbit files, catalogue queries and THREDDS downloads) shares pooled
+# connections per host. Requests time out after http_timeout seconds ([connect, read]),
+# and connection errors, timeouts and 429/5xx responses are retried up to
+# http_max_retries times, backing off from http_backoff_seconds up to http_backoff_max_seconds.
+http_timeout = [10, 120]
+http_max_retries = 5
+http_backoff_seconds = 1
+http_backoff_max_seconds = 60
+
+# Limits for each host, shared by every download and query running at once:
+# "connections" open at once, "requests_per_second" and "mb_per_second".
+# Leave a limit out (or None) for no limit. A host answering 429 (too many requests)
+# is slowed down automatically, and sped back up once it stops complaining.
+http_host_limits = {
+    "step.esa.int": {"connections": 4, "requests_per_second": 5},
+    "catalogue.dataspace.copernicus.eu": {"connections": 2, "requests_per_second": 2},
+    "dapds00.nci.org.au": {"connections": 32},
+}
+# Limits for hosts not listed above
+http_default_limits = {}
+
+# A directory shared by several projects, holding one copy of each raw product zip.
+# Each project's data_raw then links to it, and a reference count records which projects
+# still use each product. With product_store_gc, products no project links to any more are
+# deleted at the end of a run. The store is mounted into the docker container at the same path.
+# Set product_store_dir to None to keep each project's raw products in its own data_raw.
+product_store_dir = None
+product_store_gc = False
+
+# The state of every product (searched, downloaded, processed and COG'd) is kept in this SQLite
+# database, beside data_raw and data_processed, in place of '.downloaded' and '.processed' marker
+# files. Markers left by earlier runs are imported the first time it is used.
+state_db_fname = ".state.sqlite"
 
 ### Below are the pre-processing config options          ####
 ### Feel free to change them as you want to,             ####
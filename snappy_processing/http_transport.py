@@ -0,0 +1,453 @@
+#!/bin/env/python
+"""
+Description: One place for all the HTTP traffic of the downloaders (orbit files, catalogue
+             queries and THREDDS products). Keeps a connection-pooled session per host,
+             applies timeouts, retries 429/5xx responses with jittered exponential backoff,
+             and keeps per-host latency statistics.
+             A Governor caps the concurrent connections, requests per second and bytes per
+             second for each host, and slows a host down when it answers 429.
+             Used both inside the docker container (python 3.6) and by the host scripts.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+# Responses worth trying again, the rest are returned to the caller as they are
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class HostStats:
+    """
+    Latency statistics for the requests made to one host.
+    Latency is the time until the response headers arrive, so it excludes reading the body.
+    """
+
+    def __init__(self, host, max_samples=1000):
+        self.host = host
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def record(self, elapsed):
+        self.requests += 1
+        self.total_time += elapsed
+        self.samples.append(elapsed)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        mean = self.total_time / self.requests if self.requests else 0.0
+        return (
+            f"{self.host}: {self.requests} requests, {self.retries} retries, "
+            f"{self.errors} failures, latency mean {mean:.3f}s, "
+            f"p50 {self.percentile(0.5):.3f}s, p95 {self.percentile(0.95):.3f}s"
+        )
+
+
+class TokenBucket:
+    """
+    Hands out `rate` tokens a second, with bursts of up to `capacity` tokens.
+    A rate of None means no limit.
+    Takers may run into debt (e.g. a large chunk of bytes), which later takers wait off.
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate, capacity)
+        self.tokens = self.capacity
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate) if rate else None
+            # Allow a one second burst by default
+            self.capacity = float(capacity) if capacity else max(self.rate or 0.0, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1):
+        """Takes `amount` tokens, sleeping until the bucket can afford them"""
+        with self.lock:
+            if self.rate is None:
+                return
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimits:
+    """
+    The limits for one host: concurrent connections, requests per second and bytes per second.
+    The request rate adapts to 429 responses, see Governor.
+    """
+
+    def __init__(
+        self, connections=None, requests_per_second=None, mb_per_second=None, min_rate=0.1
+    ):
+        self.connections = threading.BoundedSemaphore(int(connections)) if connections else None
+        self.max_rate = float(requests_per_second) if requests_per_second else None
+        self.min_rate = min_rate
+        self.requests = TokenBucket(self.max_rate)
+        self.bytes = TokenBucket(mb_per_second * 1e6 if mb_per_second else None)
+        self.lock = threading.Lock()
+        # The request rate in force (None is unlimited),
+        # and the rate the host first throttled us at (None when not throttled)
+        self.rate = self.max_rate
+        self.throttled_rate = None
+        self.last_change = time.monotonic()
+        self.recent = deque(maxlen=100)
+
+
+class Governor:
+    """
+    Limits the concurrent connections, requests per second and bytes per second for each host.
+
+    When a host answers 429 (too many requests), its request rate is halved (starting from
+    the recently measured rate if it was unlimited). After `recovery_seconds` without a 429
+    the rate grows by 10%, up to the configured limit. A host with no configured request
+    limit becomes unlimited again once it takes 4 times the rate it was throttled at.
+
+    Parameters
+    ----------
+    host_limits : dict, optional
+        Limits for each host name, e.g.
+        {"step.esa.int": {"connections": 4, "requests_per_second": 5, "mb_per_second": 50}}.
+        Missing keys (or None) are not limited.
+    default_limits : dict, optional
+        Limits for hosts not in `host_limits`. Default is no limits.
+    recovery_seconds : float, optional
+        Seconds without a 429 before the request rate of a throttled host grows. Default is 30.
+    """
+
+    def __init__(self, host_limits=None, default_limits=None, recovery_seconds=30):
+        self.host_limits = {
+            host.lower(): dict(limits) for host, limits in (host_limits or {}).items()
+        }
+        self.default_limits = dict(default_limits or {})
+        self.recovery_seconds = recovery_seconds
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def limits(self, host):
+        """The HostLimits for `host`, made on first use"""
+        host = host.lower()
+        with self.lock:
+            limits = self.hosts.get(host)
+            if limits is None:
+                limits = HostLimits(**self.host_limits.get(host, self.default_limits))
+                self.hosts[host] = limits
+            return limits
+
+    @contextmanager
+    def connection(self, host):
+        """Holds one of the host's connection slots"""
+        semaphore = self.limits(host).connections
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    def before_request(self, host):
+        """Waits until the host's request rate allows another request"""
+        limits = self.limits(host)
+        limits.requests.take(1)
+        with limits.lock:
+            limits.recent.append(time.monotonic())
+
+    def consume(self, host, size):
+        """Waits until the host's bandwidth allows another `size` bytes"""
+        self.limits(host).bytes.take(size)
+
+    def throttled(self, host):
+        """Slows `host` down after a 429 response"""
+        limits = self.limits(host)
+        with limits.lock:
+            now = time.monotonic()
+            rate = limits.rate
+            if rate is None:
+                # Start from the rate we were actually making requests at
+                window = now - limits.recent[0] if limits.recent else 0
+                rate = len(limits.recent) / max(window, 1.0)
+            rate = max(limits.min_rate, rate / 2)
+            if limits.throttled_rate is None:
+                limits.throttled_rate = rate
+            limits.rate = rate
+            limits.last_change = now
+        limits.requests.set_rate(rate)
+        log.warning(f"{host} is throttling requests, slowing to {rate:.2f} requests/s")
+
+    def succeeded(self, host):
+        """Lets a throttled host speed back up once it has gone a while without a 429"""
+        limits = self.limits(host)
+        with limits.lock:
+            if limits.throttled_rate is None:
+                return
+            now = time.monotonic()
+            if now - limits.last_change < self.recovery_seconds:
+                return
+            rate = limits.rate * 1.1
+            limits.last_change = now
+            if limits.max_rate is not None and rate >= limits.max_rate:
+                rate, limits.throttled_rate = limits.max_rate, None
+            elif limits.max_rate is None and rate >= 4 * limits.throttled_rate:
+                rate, limits.throttled_rate = None, None
+            limits.rate = rate
+        limits.requests.set_rate(rate)
+        log.info(f"{host} has not throttled for a while, allowing {rate or 'unlimited'} requests/s")
+
+
+class Transport:
+    """
+    Makes HTTP requests over one pooled, keep-alive, session per host.
+
+    Parameters
+    ----------
+    timeout : float or (float, float), optional
+        Seconds to wait to connect and between bytes read, as passed to requests.
+        Default is (10, 120).
+    max_retries : int, optional
+        How many times a request is retried after a connection error, timeout or
+        429/5xx response. Default is 5.
+    backoff_base : float, optional
+        Seconds of backoff before the first retry, doubled for each retry after. Default is 1.
+    backoff_max : float, optional
+        The most seconds to back off between two tries. Default is 60.
+    pool_size : int, optional
+        Connections kept open to each host. Should be at least the number of threads
+        downloading from one host at once. Default is 16.
+    governor : Governor, optional
+        Limits for each host. Default is no limits.
+    """
+
+    def __init__(
+        self,
+        timeout=(10, 120),
+        max_retries=5,
+        backoff_base=1,
+        backoff_max=60,
+        pool_size=16,
+        governor=None,
+    ):
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = max(1, int(pool_size))
+        self.governor = governor or Governor()
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.stats = {}
+
+    def session(self, host):
+        """The pooled session for `host`, made on first use"""
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+                self.stats[host] = HostStats(host)
+            return session
+
+    def backoff(self, attempt, response=None):
+        """Seconds to wait before retry number `attempt` (from 1), honouring any Retry-After"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        # Full jitter stops parallel downloads retrying in lock step
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes a request, retrying connection errors, timeouts and 429/5xx responses.
+        Every try waits for the host's request rate. Requests which are not streamed also
+        hold a connection slot, streamed requests should be made inside `connection` or
+        with `stream`, so the slot is held while the body is read.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method, e.g. "GET"
+        url : str
+            The url to request
+        **kwargs
+            Passed on to requests.Session.request. `timeout` defaults to the transport's.
+
+        Returns
+        -------
+        requests.Response
+            The response. After the last retry a 429/5xx response is returned as it is,
+            so callers should still call `raise_for_status`.
+        """
+        host = urlsplit(url).netloc
+        session = self.session(host)
+        stats = self.stats[host]
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            self.governor.before_request(host)
+            start = time.monotonic()
+            try:
+                if kwargs.get("stream"):
+                    response = session.request(method, url, **kwargs)
+                else:
+                    with self.governor.connection(host):
+                        response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                with self.lock:
+                    stats.errors += 1
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                wait = self.backoff(attempt)
+                log.warning(f"{method} {url} failed ({exc}), retry {attempt} in {wait:.1f}s")
+            else:
+                with self.lock:
+                    stats.record(time.monotonic() - start)
+                if response.status_code == 429:
+                    self.governor.throttled(host)
+                else:
+                    self.governor.succeeded(host)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                attempt += 1
+                wait = self.backoff(attempt, response)
+                log.warning(
+                    f"{method} {url} returned {response.status_code}, "
+                    f"retry {attempt} in {wait:.1f}s"
+                )
+                response.close()
+            with self.lock:
+                stats.retries += 1
+            time.sleep(wait)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    @contextmanager
+    def connection(self, url):
+        """Holds a connection slot for the host of `url`, e.g. around a streamed download"""
+        with self.governor.connection(urlsplit(url).netloc):
+            yield
+
+    @contextmanager
+    def stream(self, url, **kwargs):
+        """GETs `url` as a stream, holding a connection slot until the response is closed"""
+        with self.connection(url):
+            response = self.get(url, stream=True, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def iter_content(self, response, chunk_size=64 * 1024):
+        """Iterates over a streamed response's body, at no more than the host's bandwidth"""
+        host = urlsplit(response.url).netloc
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            self.governor.consume(host, len(chunk))
+            yield chunk
+
+    def log_stats(self):
+        """Logs the latency statistics of every host contacted"""
+        with self.lock:
+            summaries = [stats.summary() for stats in self.stats.values() if stats.requests]
+        for summary in summaries:
+            log.info(f"HTTP {summary}")
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+_transport = Transport()
+
+
+def configure(**kwargs):
+    """
+    Replaces the shared transport with one made with `kwargs` (see Transport).
+    `host_limits`, `default_limits` and `recovery_seconds` are given to its Governor.
+    Call it before any requests are made, e.g. at the start of main.
+    """
+    global _transport
+    governor_kwargs = {
+        key: kwargs.pop(key)
+        for key in ("host_limits", "default_limits", "recovery_seconds")
+        if key in kwargs
+    }
+    kwargs.setdefault("governor", Governor(**governor_kwargs))
+    old_transport = _transport
+    _transport = Transport(**kwargs)
+    old_transport.close()
+    return _transport
+
+
+def get_transport():
+    """The transport shared by all downloaders in this process"""
+    return _transport
+
+
+def get(url, **kwargs):
+    """GET `url` through the shared transport, see Transport.request"""
+    return _transport.get(url, **kwargs)
+
+
+def connection(url):
+    """Holds a connection slot of the shared transport, see Transport.connection"""
+    return _transport.connection(url)
+
+
+def stream(url, **kwargs):
+    """GET `url` as a stream through the shared transport, see Transport.stream"""
+    return _transport.stream(url, **kwargs)
+
+
+def iter_content(response, chunk_size=64 * 1024):
+    """Iterates over a streamed response at the host's bandwidth, see Transport.iter_content"""
+    return _transport.iter_content(response, chunk_size=chunk_size)
+
+
+def before_request(url):
+    """Waits until the request rate of `url`'s host allows another request"""
+    _transport.governor.before_request(urlsplit(url).netloc)
+
+
+def consume(url, size):
+    """Waits until the bandwidth limit of `url`'s host allows `size` more bytes"""
+    _transport.governor.consume(urlsplit(url).netloc, size)
+
+
+def log_stats():
+    """Logs the per-host latency statistics of the shared transport"""
+    _transport.log_stats()
@@ -11,17 +11,25 @@ import sys
 # sys.path.append('/root/.snap/snap-python')
 
 import click
+import copy
 import os
 from os.path import join
 import shutil
 import gc
 import logging
-from snappy import ProductIO
+import time
+import traceback
+from snappy import ProductIO, jpy
 import utils
 from pathlib import Path
 
 import data.config as cfg
+import http_transport
 import orbits
+from product_store import ProductStore, container_path_map
+import spool
+import state_db
+from supervisor import RECYCLE_EXIT_CODE
 
 # DEM.srtm3GeoTiffDEM_HTTP = "http://download.esa.int/step/auxdata/dem/SRTM90/tiff/"
 # configure logging
@@ -42,12 +50,69 @@ os.environ["LANG"] = r"C.UTF-8"
 @click.command()
 @click.option("--filename", default=None)
 @click.option("--filelist", default=None)
-def main(filename, filelist):
+@click.option("--worker", is_flag=True, help="Take jobs from the spool until asked to stop")
+@click.option("--worker-id", default="0")
+@click.option("--spool-dir", default="data/.spool")
+@click.option("--progress-file", default=None, help="Append each finished product to this file")
+@click.option(
+    "--max-heap-fraction",
+    default=None,
+    type=float,
+    help=f"Exit with code {RECYCLE_EXIT_CODE} once more of the JVM heap is in use after a product",
+)
+def main(filename, filelist, worker, worker_id, spool_dir, progress_file, max_heap_fraction):
     """Helper function to separate cmdline usage from python importing"""
-    process_file(filename, filelist)
+    http_transport.configure(
+        timeout=cfg.http_timeout,
+        max_retries=cfg.http_max_retries,
+        backoff_base=cfg.http_backoff_seconds,
+        backoff_max=cfg.http_backoff_max_seconds,
+        host_limits=cfg.http_host_limits,
+        default_limits=cfg.http_default_limits,
+    )
+    log_jvm_settings()
+    if worker:
+        exit_code = run_worker(spool_dir, worker_id, max_heap_fraction=max_heap_fraction)
+    else:
+        exit_code = process_file(filename, filelist, progress_file, max_heap_fraction)
+    http_transport.log_stats()
+    if exit_code in (RECYCLE_EXIT_CODE, spool.WORKER_FAILED_EXIT_CODE):
+        # supervisor.py carries on with a fresh JVM, or gives up on a worker that cannot run
+        sys.exit(exit_code)
+
+
+def log_jvm_settings():
+    """Logs the heap, threads and tile cache the JVM runs with, to compare runs by"""
+    runtime = jpy.get_type("java.lang.Runtime").getRuntime()
+    System = jpy.get_type("java.lang.System")
+    log.info(
+        f"JVM: {runtime.maxMemory() / 1024**3:.1f}GB max heap, "
+        f"{runtime.availableProcessors()} processors, "
+        f"snap.parallelism={System.getProperty('snap.parallelism')}, "
+        f"snap.jai.tileCacheSize={System.getProperty('snap.jai.tileCacheSize')}, "
+        f"snap.jai.defaultTileSize={System.getProperty('snap.jai.defaultTileSize')}"
+    )
+
 
+def jvm_heap_fraction():
+    """The fraction of the JVM's maximum heap still in use, once it is cleared out"""
+    # SNAP keeps the tiles of finished products in its tile cache until it is flushed
+    jpy.get_type("javax.media.jai.JAI").getDefaultInstance().getTileCache().flush()
+    jpy.get_type("java.lang.System").gc()
+    runtime = jpy.get_type("java.lang.Runtime").getRuntime()
+    return (runtime.totalMemory() - runtime.freeMemory()) / runtime.maxMemory()
 
-def process_file(filename=None, filelist=None):
+
+def heap_exhausted(max_heap_fraction):
+    """Whether more than max_heap_fraction of the JVM's heap is in use, if one is given"""
+    if not max_heap_fraction:
+        return False
+    heap_fraction = jvm_heap_fraction()
+    log.info(f"JVM heap use is {heap_fraction:.0%} of its maximum")
+    return heap_fraction > max_heap_fraction
+
+
+def process_file(filename=None, filelist=None, progress_file=None, max_heap_fraction=None):
     """
     Process a single file, and update the filelist.
 
@@ -59,12 +124,15 @@ def process_file(filename=None, filelist=None):
     filelist : str, optional
         A text file that lists the filenames that will be used
         One of filename or filelist should be given
-    shapefile_path : str, optional
-        The path to the shapefile to be used
+    progress_file : str, optional
+        A text file each product is appended to once it is finished (or skipped)
+    max_heap_fraction : float, optional
+        Stop early once more than this fraction of the JVM's heap is in use after a product
 
     Returns
     -------
-    None
+    int or None
+        RECYCLE_EXIT_CODE if stopped early for a fresh JVM
 
     """
 
@@ -100,65 +168,192 @@ def process_file(filename=None, filelist=None):
             if os.path.basename(f) == os.path.basename(filename)
         ]
 
-    # Check if files are already processed.
-    processed_check_dir = join(cfg.final_data_path, ".processed")
-    os.makedirs(processed_check_dir, exist_ok=True)
-    processed_files = os.listdir(processed_check_dir)
-    num_files = len(file_list)
-    for fname1 in map(os.path.basename, processed_files):
-        for j, fname2 in enumerate(map(os.path.basename, file_list)):
-            if fname1 == fname2:
-                file_list.pop(num_files - j)
+    # Which files are already processed is recorded in the state database
+    state = state_db.for_data_path(cfg.final_data_path, cfg.state_db_fname)
+    state.import_markers(cfg.raw_data_dir, cfg.final_data_path)
 
     log.info(file_list)
-    for fname in file_list:
-        if utils.check_file_processed(fname, cfg.final_data_path, zip_file_given=True):
-            log.info("File already processed. Skipping.")
+    for num, fname in enumerate(file_list, 1):
+        process_product(fname)
+        if progress_file is not None:
+            with open(progress_file, "a") as f:
+                f.write(f"{fname}\n")
+        if num < len(file_list) and heap_exhausted(max_heap_fraction):
+            log.info(f"Stopping after {num} of {len(file_list)} products, for a fresh JVM")
+            return RECYCLE_EXIT_CODE
+
+
+def process_product(fname, operators=None):
+    """
+    Processes a single raw zip, archives it and records it as processed
+
+    Parameters
+    ----------
+    fname : str
+        The zip, in the raw data directory
+    operators : list of dict, optional
+        The operators to apply. Default is the config's s1tbx_operator_order.
+
+    Returns
+    -------
+    str or None
+        The processed product, or None if it had already been processed
+    """
+    if utils.check_file_processed(
+        fname, cfg.final_data_path, zip_file_given=True, state_db_fname=cfg.state_db_fname
+    ):
+        log.info("File already processed. Skipping.")
+        return None
+    start_time = time.time()
+    # The subset operators are adjusted to each product below, so each gets its own copy
+    all_parameters = copy.deepcopy(operators or cfg.s1tbx_operator_order)
+    settings_hash = state_db.config_hash(all_parameters, cfg.write_file_format)
+    # Hardcoding garbage collection at max (2) to stop memory leaks
+    gc.enable()
+    gc.collect()
+    full_fname = join(cfg.raw_data_dir, fname)
+    log.info("processing {}".format(fname))
+    input_prod = ProductIO.readProduct(join(cfg.raw_data_dir, full_fname))
+    product_name = input_prod.getName()
+
+    # Snap9's api is broken so we need to download orbitfiles seperately. Look to see if one exists
+    # We dont need to pass this in later, we just need to move them to a specific (local) directory
+    orbits.get_orbit_files(input_prod.getName(), aux_path=cfg.aux_location)
+
+    # Adjust subsetting parameters to what's expected
+    for i, operator_config in enumerate(all_parameters):
+        if "shapefilePath" in operator_config:
+            all_parameters[i] = utils.prepare_shapefile_subset(
+                operator_config, input_prod, cfg.polygon_subdirectory
+            )
+        elif "polygon" in operator_config:
+            all_parameters[i] = utils.prepare_polygon_subset(operator_config, input_prod)
+
+    # Apply all other operators
+    for operator_config in all_parameters:
+        log.info(f"Applying operator '{operator_config['operatorName']}'")
+        input_prod = utils.apply_generic_operator(input_prod, operator_config)
+
+    # writing final product
+    processed_product_name = product_name + "_" + "processed"
+
+    output_path = Path(cfg.final_data_path) / processed_product_name
+    output_data_dir = output_path.expanduser().resolve().as_posix()
+
+    ProductIO.writeProduct(input_prod, output_data_dir, cfg.write_file_format)
+    # A worker lives on after this product, so its rasters are released now
+    input_prod.dispose()
+
+    log.info("processed data saved in {}".format(output_data_dir))
+    log.info(f"{fname} processed in {time.time() - start_time:.0f}s")
+
+    if cfg.do_archive_data:
+        archive_data_dir = join(os.getcwd(), cfg.archive_data_path)
+        os.makedirs(archive_data_dir, exist_ok=True)
+        if cfg.product_store_dir:
+            # Move the link to the shared store, rather than the product itself. The references
+            # are recorded by host path, for the host to garbage collect the store by.
+            ProductStore(cfg.product_store_dir, path_map=container_path_map()).relink(
+                join(cfg.raw_data_dir, fname), join(archive_data_dir, fname)
+            )
+        else:
+            shutil.move(join(cfg.raw_data_dir, fname), join(archive_data_dir, fname))
+
+    # Set metadata indicating file has been processed
+    utils.create_proc_metadata(
+        fname,
+        cfg.final_data_path,
+        zip_file_given=True,
+        state_db_fname=cfg.state_db_fname,
+        config_hash=settings_hash,
+        seconds=time.time() - start_time,
+    )
+    return output_data_dir
+
+
+def run_worker(spool_dir, worker_id, poll_seconds=2, max_heap_fraction=None):
+    """
+    Processes jobs from a spool directory (see spool.py) until asked to stop.
+    snappy and the JVM are started once, and stay warm between products.
+
+    Parameters
+    ----------
+    spool_dir : str
+        The spool directory, shared with the host
+    worker_id : str
+        The worker's name, in job statuses and heartbeats
+    poll_seconds : float, optional
+        Seconds to wait between looks at an empty queue. Default is 2.
+    max_heap_fraction : float, optional
+        Stop once more than this fraction of the JVM's heap is in use after a job
+
+    Returns
+    -------
+    int or None
+        RECYCLE_EXIT_CODE if stopped for a fresh JVM, spool.WORKER_FAILED_EXIT_CODE if the
+        worker cannot run
+    """
+    jobs = spool.Spool(spool_dir)
+    pre_check = utils.pre_checks(
+        None,
+        None,
+        cfg.raw_data_path,
+        cfg.s1tbx_operator_order,
+        cfg.final_data_path,
+        cfg.archive_data_path,
+        cfg.do_archive_data,
+        cfg.shapefile_subdirectory,
+        worker=True,
+    )
+    if pre_check != 1:
+        log.error("Pre-Checks failed. Terminating worker")
+        # Left for the host, so the worker is not started again to fail the same way
+        jobs.heartbeat(
+            worker_id, exit_code=spool.WORKER_FAILED_EXIT_CODE, error="Pre-checks failed"
+        )
+        return spool.WORKER_FAILED_EXIT_CODE
+    cfg.raw_data_dir = join(os.getcwd(), cfg.raw_data_path)
+    os.makedirs(cfg.final_data_path, exist_ok=True)
+    state = state_db.for_data_path(cfg.final_data_path, cfg.state_db_fname)
+    state.import_markers(cfg.raw_data_dir, cfg.final_data_path)
+
+    log.info(f"Worker {worker_id} waiting for jobs in {spool_dir}")
+    while True:
+        job = jobs.claim(worker_id)
+        if job is None:
+            if jobs.stop_requested():
+                break
+            jobs.heartbeat(worker_id)
+            time.sleep(poll_seconds)
             continue
-        # Hardcoding garbage collection at max (2) to stop memory leaks
-        gc.enable()
-        gc.collect()
-        full_fname = join(cfg.raw_data_dir, fname)
-        log.info("processing {}".format(fname))
-        input_prod = ProductIO.readProduct(join(cfg.raw_data_dir, full_fname))
-        product_name = input_prod.getName()
-
-        # Snap9's api is broken so we need to download orbitfiles seperately. Look to see if one exists
-        # We dont need to pass this in later, we just need to move them to a specific (local) directory
-        orbits.get_orbit_files(input_prod.getName(), aux_path=cfg.aux_location)
-
-        all_parameters = cfg.s1tbx_operator_order
-
-        # Adjust subsetting parameters to what's expected
-        for i, operator_config in enumerate(all_parameters):
-            if "shapefilePath" in operator_config:
-                all_parameters[i] = utils.prepare_shapefile_subset(
-                    operator_config, input_prod, cfg.polygon_subdirectory
-                )
-            elif "polygon" in operator_config:
-                all_parameters[i] = utils.prepare_polygon_subset(operator_config)
-
-        # Apply all other operators
-        for operator_config in all_parameters:
-            log.info(f"Applying operator '{operator_config['operatorName']}'")
-            input_prod = utils.apply_generic_operator(input_prod, operator_config)
-
-        # writing final product
-        processed_product_name = product_name + "_" + "processed"
-
-        output_path = Path(cfg.final_data_path) / processed_product_name
-        output_data_dir = output_path.expanduser().resolve().as_posix()
-
-        ProductIO.writeProduct(input_prod, output_data_dir, cfg.write_file_format)
-
-        log.info("processed data saved in {}".format(output_data_dir))
-
-        if cfg.do_archive_data:
-            archive_data_dir = join(os.getcwd(), cfg.archive_data_path)
-            shutil.move(cfg.raw_data_dir + "/" + fname, cfg.archive_data_dir + "/" + fname)
-
-        # Set metadata indicating file has been processed
-        utils.create_proc_metadata(fname, cfg.final_data_path, zip_file_given=True)
+        jobs.heartbeat(worker_id, job["id"])
+        log.info(f"Worker {worker_id} took job {job['id']}: {job['filename']}")
+        start_time = time.time()
+        try:
+            output = process_product(job["filename"], job.get("operators"))
+        except Exception as exc:
+            log.exception(f"Job {job['id']} failed")
+            jobs.finish(
+                job,
+                "failed",
+                worker=worker_id,
+                error=repr(exc),
+                traceback=traceback.format_exc(),
+                seconds=time.time() - start_time,
+            )
+        else:
+            jobs.finish(
+                job,
+                "done",
+                worker=worker_id,
+                output=output,
+                skipped=output is None,
+                seconds=time.time() - start_time,
+            )
+        if heap_exhausted(max_heap_fraction):
+            log.info(f"Worker {worker_id} stopping for a fresh JVM")
+            return RECYCLE_EXIT_CODE
+    log.info(f"Worker {worker_id} stopping")
 
 
 if __name__ == "__main__":
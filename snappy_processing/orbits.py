@@ -1,15 +1,21 @@
 #!/bin/env/python
 
 
+import base64
+import binascii
+import hashlib
+import json
 import logging
 import os
 import shutil
+import zipfile
 from datetime import datetime, timedelta
 from pathlib import Path
 from os.path import join, basename, isfile
-import requests
 import re
 
+import http_transport
+
 
 logging.basicConfig(
     format="%(asctime)s %(name)s %(levelname)-8s %(message)s",
@@ -147,7 +153,8 @@ def query_orbit(product_name: str) -> list:
             ]
         )
         query_url = api_url + query_str
-        r = requests.get(query_url)
+        r = http_transport.get(query_url)
+        r.raise_for_status()
         # not going to bother iterating through pages; we should only get 1-2 results, with 20 max per page
         # Currently the 'exactCount' and 'totalResults' responses seems broken, stuck at 0/None, making this more difficult too
         r_data = r.json()
@@ -182,26 +189,151 @@ def query_orbit(product_name: str) -> list:
 
 
 def download_urls(urls: list, out_dir: Path) -> None:
-    """Downloads files from a list of urls if they dont already exist"""
+    """Downloads files from a list of urls if they dont already exist, resuming partial downloads"""
     out_dir = Path(out_dir)
 
     log.info(f"Attempting to download {len(urls)} files...")
     for url in urls:
-        response = requests.get(url, stream=True)
-        new_size = int(response.headers.get("content-length", 0))
-        block_size = 8192
         filepath = out_dir / Path(url).name
         filepath.parent.mkdir(parents=True, exist_ok=True)
-        # Could check hash from headers['content-digest'] in addition to filesize check
-        if filepath.is_file():
-            existing_filesize = os.path.getsize(filepath)
-            if new_size == existing_filesize:
-                log.info(f"File {filepath.as_posix()} exists with same size! skipping")
-                continue
-
-        log.info(f"Downloading url: {url}")
-        log.info(f"Downloading to: {filepath}")
-        with open(filepath, "wb") as file:
-            for data in response.iter_content(block_size):
+        # Hold one of the host's connection slots for the whole download
+        with http_transport.connection(url):
+            download_url_resumable(url, filepath)
+    return
+
+
+def download_url_resumable(url: str, filepath: Path, block_size: int = 8192) -> None:
+    """
+    Downloads a url to filepath through a `.part` file, continuing an earlier partial download.
+
+    Bytes are written to `<filepath>.part`, and the number of bytes safely on disk is recorded in
+    the sidecar `<filepath>.part.json`. A rerun continues from there with a `Range` request.
+    The finished file is renamed into place, so filepath is never a truncated file.
+    """
+    filepath = Path(filepath)
+    part_path = Path(f"{filepath}.part")
+    sidecar_path = Path(f"{part_path}.json")
+
+    response = http_transport.get(url, stream=True)
+    response.raise_for_status()
+    new_size = int(response.headers.get("content-length", 0))
+    expected = checksum_from_headers(response.headers)
+    if filepath.is_file():
+        existing_filesize = os.path.getsize(filepath)
+        if new_size == existing_filesize:
+            log.info(f"File {filepath.as_posix()} exists with same size! skipping")
+            response.close()
+            return
+
+    # See how much of an earlier attempt can be kept
+    done = 0
+    if part_path.is_file() and sidecar_path.is_file():
+        try:
+            with open(sidecar_path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("url") == url and checkpoint.get("total") == new_size:
+                done = min(int(checkpoint.get("done", 0)), os.path.getsize(part_path))
+        except (OSError, ValueError):
+            done = 0
+
+    if done and new_size and done < new_size:
+        response.close()
+        response = http_transport.get(url, stream=True, headers={"Range": f"bytes={done}-"})
+        response.raise_for_status()
+        if response.status_code != 206:
+            log.info(f"Server ignored the range request for {url}, restarting download")
+            done = 0
+        else:
+            log.info(f"Resuming {url} from byte {done}/{new_size}")
+    elif done != new_size:
+        done = 0
+
+    log.info(f"Downloading url: {url}")
+    log.info(f"Downloading to: {filepath}")
+    # Hash the bytes kept from an earlier attempt, then the rest as they arrive
+    file_hash = hashlib.new(expected[0] if expected else "md5")
+    if done:
+        with open(part_path, "rb") as file:
+            remaining = done
+            while remaining:
+                data = file.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                file_hash.update(data)
+                remaining -= len(data)
+    if not (new_size and done == new_size):
+        with open(part_path, "r+b" if done else "wb") as file:
+            file.seek(done)
+            file.truncate()
+            for i, data in enumerate(http_transport.iter_content(response, block_size)):
                 file.write(data)
+                file_hash.update(data)
+                done += len(data)
+                # Checkpoint about every 4MB
+                if i % 512 == 511:
+                    file.flush()
+                    os.fsync(file.fileno())
+                    _write_checkpoint(sidecar_path, url, new_size, done)
+            file.flush()
+            os.fsync(file.fileno())
+    response.close()
+
+    if new_size and done != new_size:
+        _write_checkpoint(sidecar_path, url, new_size, done)
+        raise IOError(f"Download of {url} ended early at {done}/{new_size} bytes")
+
+    # Check the file before it goes where SNAP will look for it
+    problem = None
+    if expected and file_hash.hexdigest() != expected[1]:
+        problem = f"{expected[0]} mismatch, expected {expected[1]} got {file_hash.hexdigest()}"
+    elif part_path.name.endswith(".zip.part"):
+        try:
+            with zipfile.ZipFile(part_path) as zf:
+                bad_member = zf.testzip()
+            if bad_member is not None:
+                problem = f"bad CRC for {bad_member}"
+        except zipfile.BadZipFile as exc:
+            problem = str(exc)
+    if problem is not None:
+        part_path.unlink()
+        if sidecar_path.is_file():
+            sidecar_path.unlink()
+        raise IOError(f"Download of {url} is corrupt ({problem}), removed it")
+    os.replace(part_path, filepath)
+    if sidecar_path.is_file():
+        sidecar_path.unlink()
     return
+
+
+def checksum_from_headers(headers) -> tuple:
+    """
+    Finds a checksum in the `Content-Digest`, `Digest` or `Content-MD5` response headers
+
+    Returns
+    -------
+    (algorithm, hexdigest) for hashlib, or None if the server did not give one
+    """
+    algorithms = {"sha-256": "sha256", "sha-512": "sha512", "md5": "md5"}
+    for header in ("content-digest", "digest"):
+        for value in headers.get(header, "").split(","):
+            name, _, encoded = value.strip().partition("=")
+            name = name.strip().lower()
+            if name in algorithms and encoded:
+                try:
+                    return algorithms[name], base64.b64decode(encoded.strip().strip(":")).hex()
+                except (ValueError, binascii.Error):
+                    continue
+    if headers.get("content-md5"):
+        try:
+            return "md5", base64.b64decode(headers["content-md5"]).hex()
+        except (ValueError, binascii.Error):
+            pass
+    return None
+
+
+def _write_checkpoint(sidecar_path: Path, url: str, total: int, done: int) -> None:
+    """Atomically records how many bytes of a partial download are on disk"""
+    tmp_path = Path(f"{sidecar_path}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"url": url, "total": total, "done": done}, f)
+    os.replace(tmp_path, sidecar_path)
@@ -0,0 +1,324 @@
+#!/bin/env/python
+"""
+Description: A content-addressed store of raw product zips, shared by several projects.
+             Each zip is kept once, as objects/<key[:2]>/<key>.zip (the key is its checksum),
+             and projects' data_raw entries are links to it. Every link is recorded as a
+             reference, and objects no project links to any more are garbage collected.
+             Used both inside the docker container (python 3.6) and by the host scripts.
+
+             Layout of the store root:
+                 objects/<key[:2]>/<key>.zip  the product zips
+                 titles/<title>               the key of the product with that title
+                 refs/<key>/<link hash>       one file per link to the object, holding its path
+
+             A link is a hardlink if possible, a reflink (copy-on-write clone) if the
+             filesystem supports one, and a symlink across filesystems.
+             References always hold host paths, as the host garbage collects the store. Inside
+             the container, the data directory's host path is given in HOST_DATA_DIR_ENV.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# ioctl request to clone a whole file on copy-on-write filesystems (btrfs, XFS), from linux/fs.h
+FICLONE = 0x40049409
+
+# Where the container mounts the project's data directory, and the variable telling it the
+# directory's path on the host
+CONTAINER_DATA_DIR = "/app/data"
+HOST_DATA_DIR_ENV = "S1_HOST_DATA_DIR"
+
+
+def file_key(path, algorithm="sha256", block_size=1024 * 1024):
+    """The store key of a file, made by hashing it"""
+    file_hash = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+    return f"{algorithm}-{file_hash.hexdigest()}"
+
+
+def _write_atomic(path, text):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def reflink(src, dest):
+    """Clones src to dest with the FICLONE ioctl. Raises OSError if the filesystem cannot"""
+    with open(str(src), "rb") as src_file, open(str(dest), "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dest_file.close()
+            os.remove(str(dest))
+            raise
+
+
+def link_file(src, dest):
+    """
+    Puts src at dest without copying its bytes: a hardlink, else a reflink, else a symlink
+
+    Returns
+    -------
+    str
+        "hardlink", "reflink" or "symlink"
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if os.path.lexists(str(dest)):
+        os.remove(str(dest))
+    try:
+        os.link(str(src), str(dest))
+        return "hardlink"
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    try:
+        reflink(src, dest)
+        return "reflink"
+    except OSError:
+        pass
+    os.symlink(os.path.abspath(str(src)), str(dest))
+    return "symlink"
+
+
+def container_path_map():
+    """
+    (container path, host path) of the data directory when run inside a container told its
+    host path, else None
+    """
+    host_data_dir = os.environ.get(HOST_DATA_DIR_ENV)
+    if not host_data_dir:
+        return None
+    return CONTAINER_DATA_DIR, host_data_dir
+
+
+class ProductStore:
+    """
+    A content-addressed store of product zips with reference counts.
+
+    Parameters
+    ----------
+    root : str
+        The directory of the store, shared by every project using it
+    gc_grace_hours : float, optional
+        References younger than this are never pruned, so a link being made while the
+        garbage collector runs is not lost. Default is 1.
+    path_map : (str, str), optional
+        A (container path, host path) prefix pair, e.g. from container_path_map. Links under
+        the container path are recorded by their host path.
+    """
+
+    def __init__(self, root, gc_grace_hours=1, path_map=None):
+        self.root = Path(root).expanduser().resolve()
+        self.gc_grace_hours = gc_grace_hours
+        self.path_map = path_map
+        for sub_dir in ("objects", "titles", "refs"):
+            (self.root / sub_dir).mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, key):
+        return self.root / "objects" / key.split("-")[-1][:2] / f"{key}.zip"
+
+    def key_for_title(self, title):
+        """The key of the stored product with this title, or None"""
+        try:
+            key = (self.root / "titles" / title).read_text().strip()
+        except OSError:
+            return None
+        return key if self.object_path(key).is_file() else None
+
+    def host_path(self, link_path):
+        """The absolute path of a link as the host sees it"""
+        link_path = os.path.abspath(str(link_path))
+        if self.path_map is not None:
+            container_dir, host_dir = self.path_map
+            if link_path == container_dir or link_path.startswith(container_dir + os.sep):
+                link_path = os.path.join(host_dir, os.path.relpath(link_path, container_dir))
+        return os.path.normpath(link_path)
+
+    def ref_path(self, key, link_path):
+        link_path = self.host_path(link_path)
+        return self.root / "refs" / key / hashlib.sha1(link_path.encode("utf-8")).hexdigest()[:16]
+
+    def add_ref(self, key, link_path):
+        """Records that `link_path` links to the object `key`"""
+        _write_atomic(self.ref_path(key, link_path), self.host_path(link_path))
+
+    def remove_ref(self, key, link_path):
+        """Forgets a link to the object `key`"""
+        try:
+            self.ref_path(key, link_path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def refs(self, key):
+        """The link paths recorded for an object"""
+        ref_dir = self.root / "refs" / key
+        if not ref_dir.is_dir():
+            return []
+        links = []
+        for ref in ref_dir.iterdir():
+            try:
+                links.append(ref.read_text())
+            except OSError:
+                continue
+        return links
+
+    def refcount(self, key):
+        return len(self.refs(key))
+
+    def fetch(self, title, dest):
+        """
+        Links the stored product with this title to dest, recording the reference
+
+        Returns
+        -------
+        bool
+            True if the product was in the store
+        """
+        key = self.key_for_title(title)
+        if key is None:
+            return False
+        self.add_ref(key, dest)
+        link_file(self.object_path(key), dest)
+        log.info(f"Linked {title} from the product store to {dest}")
+        return True
+
+    def adopt(self, title, fs_path, key=None):
+        """
+        Moves a downloaded product into the store, and leaves a link to it in its place.
+        If the store already has the same content, the download is dropped for the stored copy.
+
+        Parameters
+        ----------
+        title : str
+            The product's title
+        fs_path : str
+            The downloaded zip
+        key : str, optional
+            "<algorithm>-<hexdigest>" of the zip if known (e.g. from the download), else the
+            zip is hashed
+
+        Returns
+        -------
+        str
+            The product's key
+        """
+        fs_path = Path(fs_path)
+        stored_key = self.key_for_title(title)
+        if stored_key is not None and os.path.samefile(fs_path, self.object_path(stored_key)):
+            # Already linked from the store, e.g. by fetch
+            self.add_ref(stored_key, fs_path)
+            return stored_key
+        if fs_path.is_symlink():
+            # Already a link into the store (or a mirror), nothing to move
+            target = fs_path.resolve()
+            if target.parent.parent == self.root / "objects":
+                self.add_ref(target.stem, fs_path)
+                return target.stem
+        key = key or file_key(fs_path)
+        object_path = self.object_path(key)
+        self.add_ref(key, fs_path)
+        if not object_path.is_file():
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = object_path.with_name(f"{object_path.name}.{os.getpid()}.tmp")
+            try:
+                os.link(fs_path, tmp_path)
+            except OSError:
+                # Different filesystem, so the bytes have to be copied once
+                shutil.copyfile(fs_path, tmp_path)
+            os.replace(tmp_path, object_path)
+        elif os.path.samefile(fs_path, object_path):
+            _write_atomic(self.root / "titles" / title, key)
+            return key
+        _write_atomic(self.root / "titles" / title, key)
+        link_file(object_path, fs_path)
+        return key
+
+    def relink(self, link_path, dest):
+        """
+        Moves a project's link to a stored product (e.g. when archiving it) without copying
+        the product, keeping its reference up to date
+        """
+        link_path = Path(link_path)
+        target = link_path.resolve() if link_path.is_symlink() else None
+        if target is None or target.parent.parent != self.root / "objects":
+            # A plain (hard linked) file: find its object by name through the titles index
+            key = self.key_for_title(link_path.name[: -len(".zip")])
+            if key is None or not os.path.samefile(link_path, self.object_path(key)):
+                shutil.move(str(link_path), str(dest))
+                return
+            target = self.object_path(key)
+        key = target.stem
+        self.add_ref(key, dest)
+        link_file(target, dest)
+        link_path.unlink()
+        self.remove_ref(key, link_path)
+
+    def gc(self, dry_run=False):
+        """
+        Prunes references whose link is gone (or no longer points at the object),
+        then deletes the objects no reference is left for
+
+        Returns
+        -------
+        (int, int)
+            The number of objects deleted (or that would be, if dry_run) and their total bytes
+        """
+        grace = time.time() - self.gc_grace_hours * 3600
+        deleted = 0
+        freed = 0
+        for object_path in (self.root / "objects").glob("*/*.zip"):
+            key = object_path.stem
+            ref_dir = self.root / "refs" / key
+            live = 0
+            for ref in list(ref_dir.iterdir()) if ref_dir.is_dir() else []:
+                try:
+                    link_path = ref.read_text()
+                    if ref.stat().st_mtime > grace or os.path.samefile(link_path, object_path):
+                        live += 1
+                        continue
+                except OSError:
+                    pass
+                if not dry_run:
+                    ref.unlink()
+            if live:
+                continue
+            deleted += 1
+            freed += object_path.stat().st_size
+            log.info(f"Product store: {object_path.name} is no longer used by any project")
+            if not dry_run:
+                object_path.unlink()
+                if ref_dir.is_dir():
+                    shutil.rmtree(ref_dir, ignore_errors=True)
+        if not dry_run:
+            for title_path in (self.root / "titles").iterdir():
+                try:
+                    key = title_path.read_text().strip()
+                except OSError:
+                    continue
+                if not self.object_path(key).is_file():
+                    title_path.unlink()
+        log.info(
+            f"Product store: {'would free' if dry_run else 'freed'} {freed / 1e9:.2f} GB "
+            f"from {deleted} unused products"
+        )
+        return deleted, freed
+
+
+if __name__ == "__main__":
+    # e.g. python product_store.py /shared/s1_store [--dry-run]
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO)
+    ProductStore(sys.argv[1]).gc(dry_run="--dry-run" in sys.argv[2:])
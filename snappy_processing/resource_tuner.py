@@ -0,0 +1,272 @@
+#!/bin/env/python
+"""
+Description: Picks the JVM and SNAP settings of a processing run from what it has to work with:
+             the CPUs and memory of the host, or of the cgroup (e.g. docker container) it runs
+             in, and the size of the products, read from the annotation of their SAFE.
+                 heap            -Xmx
+                 tile cache      snap.jai.tileCacheSize (MB)
+                 tile size       snap.jai.defaultTileSize (pixels)
+                 parallelism     snap.parallelism (threads), and SNAPHU's number of processors
+             and the memory a container needs, which decides how many run at once.
+             A JVM started by snappy reads the settings from JAVA_TOOL_OPTIONS, gpt from its
+             command line (see SnapSettings).
+             Used both inside the docker container (python 3.6) and by the host scripts.
+"""
+import logging
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+
+# An IW GRDH product: about 16700 lines by 25500 samples, in VV and VH
+TYPICAL_DIMENSIONS = (16700, 25500, 2)
+
+# The image annotations of a SAFE, one per swath and polarisation
+# (not those in annotation/calibration/)
+ANNOTATION_PATTERN = re.compile(r"(^|/)annotation/[^/]+\.xml$")
+
+TILE_SIZES = (1024, 512, 256)
+
+
+def _read(path):
+    with open(str(path), "r") as f:
+        return f.read().strip()
+
+
+def cgroup_dirs(controller, root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """
+    The directories of this process's cgroup for a controller (e.g. "memory"), and of each of
+    its ancestors, innermost first. The cgroup is found in /proc/self/cgroup: the "0::<path>"
+    line on cgroup v2 (under root), the controller's line on v1 (under root/<controller>).
+    A limit on any of them applies, e.g. that of the PBS or Slurm job a task runs in.
+    Inside a container, whose cgroup is its own root, this is just the root.
+    """
+    try:
+        lines = _read(proc_cgroup).splitlines()
+    except OSError:
+        lines = []
+    dirs = []
+    for line in lines:
+        try:
+            hierarchy, controllers, path = line.split(":", 2)
+        except ValueError:
+            continue
+        if hierarchy == "0" and not controllers:
+            base = Path(root)
+        elif controller in controllers.split(","):
+            base = Path(root, controller)
+        else:
+            continue
+        relative = Path(path.lstrip("/"))
+        dirs += [base / parent for parent in [relative, *relative.parents]]
+    dirs += [Path(root), Path(root, controller)]
+    # Without duplicates, in order
+    return list(dict.fromkeys(dirs))
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """
+    The CPUs this process's cgroup may use (the lowest CPU quota of it and its ancestors),
+    or None if it is not limited
+    """
+    limits = []
+    for cgroup_dir in cgroup_dirs("cpu", root, proc_cgroup):
+        try:
+            # cgroup v2, e.g. "400000 100000", or "max 100000"
+            quota, period = _read(cgroup_dir / "cpu.max").split()
+            if quota != "max":
+                limits.append(int(quota) / int(period))
+            continue
+        except (OSError, ValueError):
+            pass
+        try:
+            # cgroup v1, with -1 for no quota
+            quota = int(_read(cgroup_dir / "cpu.cfs_quota_us"))
+            period = int(_read(cgroup_dir / "cpu.cfs_period_us"))
+            if quota > 0:
+                limits.append(quota / period)
+        except (OSError, ValueError):
+            pass
+    return min(limits) if limits else None
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """
+    The memory limit (in bytes) of this process's cgroup (the lowest of it and its
+    ancestors), or None if it is not limited
+    """
+    limits = []
+    for cgroup_dir in cgroup_dirs("memory", root, proc_cgroup):
+        for name in ("memory.max", "memory.limit_in_bytes"):
+            try:
+                value = _read(cgroup_dir / name)
+            except OSError:
+                continue
+            # cgroup v1 gives a huge number for no limit
+            if value.isdigit() and int(value) < 2**60:
+                limits.append(int(value))
+            break
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """The CPUs this process may run on, no more than its cgroup's CPU quota"""
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu_limit = cgroup_cpu_limit()
+    if cpu_limit is not None:
+        cpus = cpus[: max(1, math.floor(cpu_limit))]
+    return cpus
+
+
+def available_memory_gb():
+    """The host's memory in GB, or the cgroup's limit if that is less"""
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    memory_limit = cgroup_memory_limit()
+    if memory_limit is not None:
+        memory = min(memory, memory_limit)
+    return memory / 1024**3
+
+
+def product_dimensions(path):
+    """
+    The size of a Sentinel-1 product, from the image annotations of its zip or SAFE directory
+
+    Parameters
+    ----------
+    path : str
+        The product's zip or SAFE directory
+
+    Returns
+    -------
+    tuple of int or None
+        (lines, samples, images) of its largest image, with an image for each swath and
+        polarisation. None if the annotations can't be read.
+    """
+    path = Path(path)
+    try:
+        if path.is_dir():
+            annotations = [p.read_bytes() for p in path.glob("annotation/*.xml")]
+        else:
+            with zipfile.ZipFile(str(path)) as zf:
+                annotations = [
+                    zf.read(name) for name in zf.namelist() if ANNOTATION_PATTERN.search(name)
+                ]
+        sizes = []
+        for annotation in annotations:
+            info = ET.fromstring(annotation).find(".//imageAnnotation/imageInformation")
+            lines = int(info.findtext("numberOfLines"))
+            sizes.append((lines, int(info.findtext("numberOfSamples"))))
+    except (OSError, zipfile.BadZipFile, ET.ParseError, AttributeError, TypeError, ValueError):
+        log.warning(f"Unable to read the dimensions of {path.name} from its annotation")
+        return None
+    if not sizes:
+        return None
+    lines, samples = max(sizes, key=lambda size: size[0] * size[1])
+    return lines, samples, len(sizes)
+
+
+def product_memory_gb(dimensions=None):
+    """
+    The heap a product needs, roughly: each image as float32, kept twice (the source and the
+    output of the operator at work)
+
+    Parameters
+    ----------
+    dimensions : tuple of int, optional
+        (lines, samples, images) from product_dimensions. Default is an IW GRDH product.
+    """
+    lines, samples, images = dimensions or TYPICAL_DIMENSIONS
+    return 2 * lines * samples * images * 4 / 1024**3
+
+
+def largest_product_memory_gb(paths):
+    """The product_memory_gb of the largest of some products, or of a typical one"""
+    dimensions = [product_dimensions(path) for path in paths or []]
+    return max([product_memory_gb(d) for d in dimensions if d] or [product_memory_gb()])
+
+
+def pick_tile_size(tile_cache_mb, parallelism, images=2):
+    """
+    The largest tile size leaving the tile cache room for a few float32 tiles of every image
+    for each thread, so threads don't evict each other's tiles
+    """
+    tiles_in_flight = 4 * parallelism * images
+    for tile_size in TILE_SIZES:
+        if tile_size**2 * 4 * tiles_in_flight <= tile_cache_mb * 1024**2:
+            return tile_size
+    return TILE_SIZES[-1]
+
+
+class SnapSettings:
+    """
+    The JVM and SNAP settings of a processing run with some CPUs and memory
+
+    Parameters
+    ----------
+    cpus : int
+        The number of CPUs the run has
+    memory_gb : float
+        The memory the run has
+    heap_fraction : float, optional
+        Fraction of the memory given to the JVM heap, the rest is left for python, GDAL and the
+        JVM itself. Default is 0.75.
+    tile_cache_fraction : float, optional
+        Fraction of the heap given to SNAP's tile cache. Default is 0.5.
+    product_gb : float, optional
+        The heap a product needs (see product_memory_gb), to warn when it does not fit
+    """
+
+    def __init__(
+        self, cpus, memory_gb, heap_fraction=0.75, tile_cache_fraction=0.5, product_gb=None
+    ):
+        self.parallelism = max(1, int(cpus))
+        self.memory_gb = memory_gb
+        self.heap_gb = max(1, int(memory_gb * heap_fraction))
+        self.tile_cache_mb = max(256, int(self.heap_gb * 1024 * tile_cache_fraction))
+        self.tile_size = pick_tile_size(self.tile_cache_mb, self.parallelism)
+        if product_gb and product_gb > self.heap_gb:
+            log.warning(
+                f"A {self.heap_gb}GB heap is less than the {product_gb:.1f}GB a product needs, "
+                "so SNAP will spill tiles and slow down"
+            )
+
+    @classmethod
+    def for_this_process(cls, **kwargs):
+        """The settings for the CPUs and memory (or cgroup limits) this process has"""
+        return cls(len(available_cpus()), available_memory_gb(), **kwargs)
+
+    def java_options(self):
+        return (
+            f"-Xmx{self.heap_gb}g -Dsnap.jai.tileCacheSize={self.tile_cache_mb} "
+            f"-Dsnap.jai.defaultTileSize={self.tile_size} -Dsnap.parallelism={self.parallelism}"
+        )
+
+    def environment(self):
+        """Environment variables passing the settings to a JVM started by snappy"""
+        return {"JAVA_TOOL_OPTIONS": self.java_options()}
+
+    def gpt_options(self):
+        """
+        gpt's own options for the settings. gpt sets its heap from gpt.vmoptions, which would
+        override JAVA_TOOL_OPTIONS, so it is given on the command line.
+        """
+        return [
+            f"-J-Xmx{self.heap_gb}G",
+            "-c",
+            f"{self.tile_cache_mb}M",
+            "-q",
+            str(self.parallelism),
+        ]
+
+    def __str__(self):
+        return (
+            f"{self.parallelism} threads, {self.heap_gb}GB heap, "
+            f"{self.tile_cache_mb}MB tile cache, {self.tile_size}px tiles"
+        )
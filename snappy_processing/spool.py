@@ -0,0 +1,227 @@
+#!/bin/env/python
+"""
+Description: A spool directory of processing jobs, shared by the host and long-lived worker
+             containers (see `main.py --worker`). Workers start once, keep the JVM warm and
+             take jobs from the spool, so a product no longer pays for a container, python,
+             snappy and JVM start up. The spool is in the data directory, which the
+             container already mounts, so no ports are needed.
+             Used both inside the docker container (python 3.6) and by the host scripts.
+
+             Layout of the spool root:
+                 queue/<job id>.json        jobs waiting for a worker, taken in name order
+                 running/<job id>.json      jobs claimed by a worker. A job is claimed by
+                                            renaming it out of queue/, so only one worker gets it
+                 status/<job id>.json       the state of each job: queued, running, done or failed
+                 workers/<worker id>.json   each worker's heartbeat, with the job it is on
+                 stop                       asks the workers to exit once they are idle
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+FINISHED_STATES = ("done", "failed")
+
+# The exit code of a worker that cannot run at all (EX_CONFIG), e.g. when its pre-checks fail.
+# It is also left in the worker's heartbeat, as the host does not see the exit codes of workers.
+WORKER_FAILED_EXIT_CODE = 78
+
+
+def _write_json(path, data):
+    """Writes a json file atomically, so a reader never sees half of it"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(str(tmp_path), "w") as f:
+        json.dump(data, f)
+    os.replace(str(tmp_path), str(path))
+
+
+def _read_json(path):
+    try:
+        with open(str(path), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class Spool:
+    """
+    A spool directory of processing jobs.
+
+    Parameters
+    ----------
+    root : str
+        The spool directory, created if needed
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        for sub_dir in ("queue", "running", "status", "workers"):
+            (self.root / sub_dir).mkdir(parents=True, exist_ok=True)
+
+    def submit(self, filename, operators=None):
+        """
+        Queues a job
+
+        Parameters
+        ----------
+        filename : str
+            The raw zip to process, in data_raw
+        operators : list of dict, optional
+            The operators to apply, in place of the config's s1tbx_operator_order
+
+        Returns
+        -------
+        str
+            The job's id
+        """
+        # Ids sort in submission order, so jobs are taken first in, first out
+        job_id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        job = {"id": job_id, "filename": os.path.basename(filename), "operators": operators}
+        self.set_status(job_id, "queued", filename=job["filename"])
+        _write_json(self.root / "queue" / f"{job_id}.json", job)
+        return job_id
+
+    def claim(self, worker_id):
+        """The next queued job, now claimed by this worker, or None if the queue is empty"""
+        for name in sorted(os.listdir(str(self.root / "queue"))):
+            if not name.endswith(".json"):
+                continue
+            running_path = self.root / "running" / name
+            try:
+                os.rename(str(self.root / "queue" / name), str(running_path))
+            except FileNotFoundError:
+                # Another worker claimed it first
+                continue
+            job = _read_json(running_path)
+            if job is None:
+                running_path.unlink()
+                continue
+            self.set_status(job["id"], "running", filename=job["filename"], worker=worker_id)
+            return job
+        return None
+
+    def finish(self, job, state, **fields):
+        """Records a job's final state ("done" or "failed") and drops it from running/"""
+        self.set_status(job["id"], state, filename=job["filename"], **fields)
+        try:
+            (self.root / "running" / f"{job['id']}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def set_status(self, job_id, state, **fields):
+        _write_json(
+            self.root / "status" / f"{job_id}.json",
+            dict(fields, id=job_id, state=state, time=time.time()),
+        )
+
+    def status(self, job_id):
+        """The status of a job, a dict with at least "state", or None if it is unknown"""
+        return _read_json(self.root / "status" / f"{job_id}.json")
+
+    def forget(self, job_id):
+        """Removes a finished job's status"""
+        try:
+            (self.root / "status" / f"{job_id}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def requeue_running(self):
+        """
+        Puts the jobs claimed by workers that are gone back in the queue.
+        Only to be called while no worker is running.
+        """
+        requeued = 0
+        for path in (self.root / "running").glob("*.json"):
+            os.rename(str(path), str(self.root / "queue" / path.name))
+            requeued += 1
+        if requeued:
+            log.info(f"Requeued {requeued} jobs left running by stopped workers")
+        return requeued
+
+    def requeue(self, job_id):
+        """
+        Puts a job claimed by a worker that is gone back in the queue, ahead of the jobs
+        submitted after it. Returns False if it is no longer claimed (e.g. it has just finished).
+        """
+        running_path = self.root / "running" / f"{job_id}.json"
+        queue_path = self.root / "queue" / running_path.name
+        job = _read_json(running_path)
+        if job is None:
+            return False
+        try:
+            os.rename(str(running_path), str(queue_path))
+        except FileNotFoundError:
+            return False
+        if (self.status(job_id) or {}).get("state") in FINISHED_STATES:
+            # It finished after all
+            try:
+                queue_path.unlink()
+            except FileNotFoundError:
+                pass
+            return False
+        self.set_status(job_id, "queued", filename=job["filename"])
+        return True
+
+    def fail_lost(self, job_id, error):
+        """Fails a job claimed by a worker that is gone. False if it is no longer claimed."""
+        job = _read_json(self.root / "running" / f"{job_id}.json")
+        if job is None:
+            return False
+        self.finish(job, "failed", error=error)
+        return True
+
+    def fail_queued(self, error):
+        """Fails every job waiting for a worker, e.g. when no worker can run. Returns how many."""
+        failed = 0
+        for name in sorted(os.listdir(str(self.root / "queue"))):
+            if not name.endswith(".json"):
+                continue
+            queue_path = self.root / "queue" / name
+            job = _read_json(queue_path)
+            try:
+                queue_path.unlink()
+            except FileNotFoundError:
+                # Claimed by a worker in the meantime
+                continue
+            if job is None:
+                continue
+            self.set_status(job["id"], "failed", filename=job["filename"], error=error)
+            failed += 1
+        return failed
+
+    def heartbeat_of(self, worker_id):
+        """
+        A worker's last heartbeat ("worker", "pid", "job" or None, "time", and "exit_code" and
+        "error" if it could not run), or None
+        """
+        return _read_json(self.root / "workers" / f"{worker_id}.json")
+
+    def forget_worker(self, worker_id):
+        """Removes a worker's heartbeat, e.g. before the worker is started again"""
+        try:
+            (self.root / "workers" / f"{worker_id}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, worker_id, job_id=None, **fields):
+        _write_json(
+            self.root / "workers" / f"{worker_id}.json",
+            dict(fields, worker=worker_id, pid=os.getpid(), job=job_id, time=time.time()),
+        )
+
+    def request_stop(self):
+        (self.root / "stop").touch()
+
+    def stop_requested(self):
+        return (self.root / "stop").exists()
+
+    def clear_stop(self):
+        try:
+            (self.root / "stop").unlink()
+        except FileNotFoundError:
+            pass
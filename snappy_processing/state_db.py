@@ -0,0 +1,316 @@
+#!/bin/env/python
+"""
+Description: A SQLite manifest of every product's state, with one row per product (by title)
+             recording when it was searched, downloaded (size and checksum), processed
+             (config hash, output path and timing) and converted to a COG.
+             It replaces the '.downloaded/<md5(url)>' and '.processed/<fname>.done' marker
+             files, so skip checks are indexed lookups rather than stats and directory scans.
+             The database is in WAL mode and every update is a transaction, so a crash leaves
+             either the old or the new state. Existing marker files are imported once.
+             Used both inside the docker container (python 3.6) and by the host scripts, which
+             share the database in data_directory.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    title TEXT PRIMARY KEY,
+    url TEXT,
+    url_hash TEXT,
+    provider TEXT,
+    searched_at REAL,
+    downloaded_at REAL,
+    raw_path TEXT,
+    size INTEGER,
+    checksum TEXT,
+    processed_at REAL,
+    config_hash TEXT,
+    processed_path TEXT,
+    processing_seconds REAL,
+    cog_at REAL,
+    cog_path TEXT
+);
+CREATE INDEX IF NOT EXISTS products_url_hash ON products (url_hash);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+# The column recording when a product reached each stage
+STAGE_COLUMNS = {
+    "searched": "searched_at",
+    "downloaded": "downloaded_at",
+    "processed": "processed_at",
+    "cog": "cog_at",
+}
+
+# S1A_IW_GRDH_1SDV_20230131T214327_20230131T214352_046992_05A2B5_2F4A
+TITLE_PATTERN = re.compile(
+    r"S1[A-D]_\w{2}_\w{4}_\w{4}_\d{8}T\d{6}_\d{8}T\d{6}_\d{6}_[0-9A-F]{6}_[0-9A-F]{4}"
+)
+
+
+def url_hash(url):
+    """The hash EODAG (and the '.downloaded' records) name a download link by"""
+    return hashlib.md5(url.encode("utf-8")).hexdigest()
+
+
+def product_title(fname):
+    """
+    The title of a product from any of its files, e.g. its zip, its snappy output
+    (<title>_processed.tif) or its COG (<title>_processed_cog.tif)
+    """
+    name = os.path.basename(str(fname).rstrip("/"))
+    return re.sub(r"(_processed)?(_cog)?\.(zip|tif|SAFE)$", "", name)
+
+
+def config_hash(*configs):
+    """A short hash of processing settings, to tell which settings made an output"""
+    text = json.dumps(configs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def for_data_path(data_path, fname=".state.sqlite"):
+    """
+    The (shared) state database of the project holding a data directory, e.g. its data_raw or
+    data_processed. The database is kept beside them, in the project's data directory.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(data_path)), fname)
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = StateDB(path)
+        return _databases[path]
+
+
+class StateDB:
+    """
+    The state of every product of a project, in a SQLite database.
+
+    Parameters
+    ----------
+    path : str
+        The database file, created if needed
+    timeout : float, optional
+        Seconds to wait for another process's transaction to finish. Default is 60.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = Path(path).expanduser().resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        # sqlite3 connections can't be shared between threads, so each thread has its own
+        self._local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def relative(self, path):
+        """
+        A path relative to the database's directory. Paths are stored this way, as the host and
+        the container see the data directory at different places.
+        """
+        return os.path.relpath(os.path.abspath(path), str(self.path.parent))
+
+    def absolute(self, path):
+        """A stored path, as seen from this process"""
+        return os.path.normpath(os.path.join(str(self.path.parent), path))
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode, with transactions opened explicitly by `transaction`
+            conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction, committed on success and rolled back on any exception"""
+        conn = self.connection()
+        # Take the write lock up front, so concurrent writers wait rather than deadlock
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _update(conn, title, fields):
+        conn.execute("INSERT OR IGNORE INTO products (title) VALUES (?)", (title,))
+        if fields:
+            columns = ", ".join(f"{name} = ?" for name in fields)
+            conn.execute(
+                f"UPDATE products SET {columns} WHERE title = ?", (*fields.values(), title)
+            )
+
+    def update(self, title, **fields):
+        """Sets fields of a product's row, creating it if needed. Fields given as None are kept."""
+        fields = {name: value for name, value in fields.items() if value is not None}
+        with self.transaction() as conn:
+            self._update(conn, title, fields)
+
+    def row(self, title):
+        """A product's row as a dict, or None"""
+        row = self.connection().execute(
+            "SELECT * FROM products WHERE title = ?", (title,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def mark_searched(self, title, url=None, provider=None):
+        self.update(
+            title,
+            url=url,
+            url_hash=url_hash(url) if url else None,
+            provider=provider,
+            searched_at=time.time(),
+        )
+
+    def mark_downloaded(self, title, url=None, raw_path=None, size=None, checksum=None):
+        if size is None and raw_path and os.path.isfile(raw_path):
+            size = os.path.getsize(raw_path)
+        self.update(
+            title,
+            url=url,
+            url_hash=url_hash(url) if url else None,
+            downloaded_at=time.time(),
+            raw_path=self.relative(raw_path) if raw_path else None,
+            size=size,
+            checksum=checksum,
+        )
+
+    def forget_download(self, title, url=None):
+        """Clears a product's download, e.g. after a corrupt zip is removed"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE products SET downloaded_at = NULL, raw_path = NULL, size = NULL, "
+                "checksum = NULL WHERE title = ? OR url_hash = ?",
+                (title, url_hash(url) if url else None),
+            )
+
+    def mark_processed(self, title, processed_path, config_hash=None, seconds=None):
+        """Records a product's snappy output, the hash of the settings and the seconds it took"""
+        self.update(
+            title,
+            processed_at=time.time(),
+            processed_path=self.relative(processed_path),
+            config_hash=config_hash,
+            processing_seconds=seconds,
+        )
+
+    def mark_cog(self, title, cog_path):
+        self.update(title, cog_at=time.time(), cog_path=self.relative(cog_path))
+
+    def is_downloaded(self, title, url=None):
+        """Whether a product's download was recorded, found by title or download link"""
+        row = self.connection().execute(
+            "SELECT 1 FROM products WHERE downloaded_at IS NOT NULL "
+            "AND (title = ? OR url_hash = ?) LIMIT 1",
+            (title, url_hash(url) if url else None),
+        ).fetchone()
+        return row is not None
+
+    def processed_path(self, title):
+        """The recorded snappy output of a product, or None"""
+        row = self.connection().execute(
+            "SELECT processed_path FROM products WHERE title = ? AND processed_at IS NOT NULL",
+            (title,),
+        ).fetchone()
+        return self.absolute(row[0]) if row is not None else None
+
+    def cog_path(self, title):
+        """The recorded COG of a product, or None"""
+        row = self.connection().execute(
+            "SELECT cog_path FROM products WHERE title = ? AND cog_at IS NOT NULL", (title,)
+        ).fetchone()
+        return self.absolute(row[0]) if row is not None else None
+
+    def titles(self, stage):
+        """
+        The set of titles recorded as having reached a stage:
+        "searched", "downloaded", "processed" or "cog"
+        """
+        column = STAGE_COLUMNS[stage]
+        rows = self.connection().execute(f"SELECT title FROM products WHERE {column} IS NOT NULL")
+        return {row[0] for row in rows}
+
+    def import_markers(self, raw_data_path, final_data_path):
+        """
+        Imports the '.downloaded' and '.processed' marker files of a project, once.
+        The markers are left in place.
+
+        Parameters
+        ----------
+        raw_data_path : str
+            The directory holding '.downloaded'
+        final_data_path : str
+            The directory holding '.processed'
+
+        Returns
+        -------
+        int
+            The number of markers imported, 0 if they had already been
+        """
+        # Named relative to the database, which the host and the container see at different paths
+        name = "markers_imported:" + "|".join(
+            self.relative(path) for path in (raw_data_path, final_data_path)
+        )
+        imported = 0
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE name = ?", (name,)).fetchone():
+                return 0
+            download_records = Path(raw_data_path, ".downloaded")
+            for record in download_records.iterdir() if download_records.is_dir() else []:
+                try:
+                    url = record.read_text().strip()
+                except OSError:
+                    continue
+                match = TITLE_PATTERN.search(url)
+                title = match.group(0) if match else product_title(url.split("?")[0])
+                raw_path = Path(raw_data_path, f"{title}.zip")
+                fields = {
+                    "url": url,
+                    # The record is named by the hash of the link it was made with
+                    "url_hash": record.name,
+                    "downloaded_at": record.stat().st_mtime,
+                }
+                if raw_path.is_file():
+                    fields["raw_path"] = self.relative(raw_path)
+                    fields["size"] = raw_path.stat().st_size
+                self._update(conn, title, fields)
+                imported += 1
+            processed_records = Path(final_data_path, ".processed")
+            for record in processed_records.glob("*.done") if processed_records.is_dir() else []:
+                fname = record.name[: -len(".done")]
+                path = self.relative(Path(final_data_path, fname))
+                if fname.endswith("_cog.tif"):
+                    fields = {"cog_at": record.stat().st_mtime, "cog_path": path}
+                else:
+                    fields = {"processed_at": record.stat().st_mtime, "processed_path": path}
+                self._update(conn, product_title(fname), fields)
+                imported += 1
+            conn.execute("INSERT INTO meta (name, value) VALUES (?, ?)", (name, str(time.time())))
+        log.info(f"Imported {imported} marker files into {self.path}")
+        return imported
+
+
+if __name__ == "__main__":
+    # e.g. python state_db.py ~/data/S1_data/.state.sqlite ~/data/S1_data/data_raw \
+    #          ~/data/S1_data/data_processed
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO)
+    StateDB(sys.argv[1]).import_markers(sys.argv[2], sys.argv[3])
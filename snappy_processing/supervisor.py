@@ -0,0 +1,128 @@
+#!/bin/env/python
+"""
+Description: The entrypoint of the docker image, which runs main.py.
+             Python's gc.collect() does not free what SNAP keeps in the JVM (e.g. its tile cache),
+             so a JVM processing a long file list slowly grows until it runs out of heap.
+             Given a file list and --recycle-every and/or --max-heap-fraction, main.py is run
+             in rounds, each over the part of the list that is left, with a fresh JVM:
+                 --recycle-every N          a round processes at most N products
+                 --max-heap-fraction F      main.py ends its round early (exit code 75) once
+                                            more than F of the JVM's heap is still in use
+                                            after a product
+             main.py appends each product it has finished to a progress file, so the next
+             round carries on from there. A product that crashes its round is skipped.
+             A worker (--worker) given --max-heap-fraction is restarted the same way.
+             Anything else is passed straight to main.py.
+             Runs inside the docker container (python 3.6), and does not import snappy.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+log = logging.getLogger(__name__)
+
+# The exit code of main.py when it stops early for a fresh JVM (EX_TEMPFAIL)
+RECYCLE_EXIT_CODE = 75
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def read_file_list(path):
+    """The zips listed in a file list, one per line"""
+    try:
+        with open(path, "r") as f:
+            return [line.strip() for line in f if ".zip" in line]
+    except FileNotFoundError:
+        return []
+
+
+def run_main(args):
+    return subprocess.call([sys.executable, MAIN, *args])
+
+
+def run_rounds(filelist, recycle_every=0, max_heap_fraction=None, args=()):
+    """
+    Processes a file list with main.py in rounds, each with a fresh JVM
+
+    Parameters
+    ----------
+    filelist : str
+        The file list, as given to main.py
+    recycle_every : int, optional
+        The most products processed by one JVM, 0 for no limit
+    max_heap_fraction : float, optional
+        The heap use (a fraction of the maximum) after a product at which main.py stops early
+    args : list of str, optional
+        Further arguments to main.py
+
+    Returns
+    -------
+    int
+        0, or the exit code of the last round that failed
+    """
+    remaining = read_file_list(filelist)
+    round_list = f"{filelist}.round"
+    progress_file = f"{filelist}.progress"
+    heap_args = ["--max-heap-fraction", str(max_heap_fraction)] if max_heap_fraction else []
+    exit_code = 0
+    num_round = 0
+    while remaining:
+        chunk = remaining[:recycle_every] if recycle_every else remaining
+        with open(round_list, "w") as f:
+            f.write("\n".join(chunk))
+        open(progress_file, "w").close()
+        num_round += 1
+        log.info(f"Starting JVM round {num_round}: {len(chunk)} of {len(remaining)} products left")
+        round_exit_code = run_main(
+            ["--filelist", round_list, "--progress-file", progress_file, *heap_args, *args]
+        )
+        finished = set(read_file_list(progress_file))
+        left = [fname for fname in remaining if fname not in finished]
+        if round_exit_code not in (0, RECYCLE_EXIT_CODE):
+            exit_code = round_exit_code
+            # The product being processed when the round died is the first not finished
+            crashed = next((fname for fname in chunk if fname not in finished), None)
+            if crashed is not None:
+                log.error(f"main.py exited with {round_exit_code} on {crashed}, skipping it")
+                left.remove(crashed)
+        elif len(left) == len(remaining):
+            log.error(f"No products were finished in round {num_round}, stopping")
+            exit_code = exit_code or 1
+            break
+        remaining = left
+    for path in (round_list, progress_file):
+        if os.path.exists(path):
+            os.remove(path)
+    return exit_code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--filelist", default=None)
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--recycle-every", type=int, default=0)
+    parser.add_argument("--max-heap-fraction", type=float, default=None)
+    known, args = parser.parse_known_args(argv)
+
+    if known.filelist and (known.recycle_every or known.max_heap_fraction):
+        return run_rounds(known.filelist, known.recycle_every, known.max_heap_fraction, args)
+    if known.worker and known.max_heap_fraction:
+        args = ["--worker", "--max-heap-fraction", str(known.max_heap_fraction), *args]
+        while True:
+            exit_code = run_main(args)
+            if exit_code != RECYCLE_EXIT_CODE:
+                return exit_code
+            log.info("Restarting the worker with a fresh JVM")
+    # Nothing to supervise, main.py takes the place of this process
+    os.execv(sys.executable, [sys.executable, MAIN, *sys.argv[1:]])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,6 +25,8 @@ import snappy
 import shapefile
 import pygeoif
 
+import state_db
+
 
 logging.basicConfig(
     format="%(asctime)s %(name)s %(levelname)-8s %(message)s",
@@ -44,9 +46,12 @@ def pre_checks(
     archive_data_path,
     do_archive_data,
     shapefile_subdirectory,
+    worker=False,
 ):
     """perform directory structure check
 
+    :param worker: checks for a worker (`main.py --worker`), which is given no file up front,
+        and waits for raw files in the raw data directory rather than stopping without any
     :return: if return = 0 -> no file to processs | if return = -1 -> Error | else: Success
     :rtype: int
     """
@@ -59,7 +64,7 @@ def pre_checks(
     if filename and filelist:
         log.error("Please only give one of filename or filelist")
         return -1
-    if not (filename or filelist):
+    if not (filename or filelist or worker):
         log.error("Please give at least one of filename or filelist")
         return -1
 
@@ -67,7 +72,7 @@ def pre_checks(
         log.error("could not find config file in data/config.py")
         return -1
 
-    if (not os.path.exists(os.path.join(cwd, raw_data_path))) and (filename is not None):
+    if (not os.path.exists(os.path.join(cwd, raw_data_path))) and (filename or worker):
         log.error(
             "Raw data directory {} does not exist. Terminating execution ...".format(raw_data_path)
         )
@@ -105,7 +110,7 @@ def pre_checks(
     num_files = [f for f in os.listdir(raw_data_dir) if ".zip" in f]
     if num_files:
         log.info("found {} zip files to process".format(len(num_files)))
-    else:
+    elif not worker:
         log.warning("No file found to process in {}".format(raw_data_dir))
         return 0
 
@@ -203,28 +208,38 @@ def prepare_shapefile_subset(shapefile_params, source, shapefile_subdirectory):
     return shapefile_params
 
 
-def check_file_processed(fname, final_data_path="./data/data_processed/", zip_file_given=True):
-    """Checks if a file has already been processed"""
+def check_file_processed(
+    fname, final_data_path="./data/data_processed/", zip_file_given=True, state_db_fname=None
+):
+    """Checks if a file has already been processed, from the project's state database"""
     fname = basename(fname)
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = join(final_data_path, ".processed")
-    file_suffix = ".done"
-    meta_file_exists = isfile(join(meta_dir, fname + file_suffix))
-    og_file_exists = isfile(join(final_data_path, fname))
-    if meta_file_exists and og_file_exists:
-        return True
-    else:
-        return False
-
-
-def create_proc_metadata(fname, final_data_path="./data/data_processed/", zip_file_given=False):
-    """Creates metadata that the file has been processed for future use in '.processed'."""
-    import re
-
+    state = state_db.for_data_path(final_data_path, state_db_fname or ".state.sqlite")
+    output_path = state.processed_path(state_db.product_title(fname))
+    return output_path is not None and isfile(output_path)
+
+
+def create_proc_metadata(
+    fname,
+    final_data_path="./data/data_processed/",
+    zip_file_given=False,
+    state_db_fname=None,
+    config_hash=None,
+    seconds=None,
+):
+    """
+    Records that the file has been processed in the project's state database, for future use,
+    with the hash of the processing settings and the seconds it took
+    """
     fname = basename(fname)
     if zip_file_given:
         fname = re.sub("(.zip)$", "_processed.tif", fname)
-    meta_dir = join(final_data_path, ".processed")
-    Path(join(meta_dir, fname + ".done")).touch()
+    state = state_db.for_data_path(final_data_path, state_db_fname or ".state.sqlite")
+    state.mark_processed(
+        state_db.product_title(fname),
+        join(final_data_path, fname),
+        config_hash=config_hash,
+        seconds=seconds,
+    )
     return
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Description: Builds a local index of the Sentinel-1 products on NCI's THREDDS server by
+             crawling its catalog XML, so searches in THREDDS mode need neither an EODAG
+             search nor rewriting a quicklook path into a download url.
+             The catalog is laid out as <year>/<year>-<month>/<tile>/<product>.zip, with tiles
+             named by their corners (e.g. 20S115E-25S120E). A product is filed under one tile
+             but may reach into its neighbours, so tiles are searched with a margin of a scene's
+             width. A product's footprint is the geospatialCoverage the catalog gives it, if any.
+             Without one, it has no footprint, and is only matched by its tile.
+             The index is cached as one JSONL file per month.
+             The crawler accepts a local directory of catalog.xml files in place of the server.
+"""
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+from search_shards import parse_date
+from snappy_processing import http_transport
+
+log = logging.getLogger(__name__)
+
+THREDDS_CATALOG_URL = (
+    "https://dapds00.nci.org.au/thredds/catalog/fj7/Copernicus/Sentinel-1/C-SAR/{product_type}/"
+)
+THREDDS_FILE_SERVER_URL = "https://dapds00.nci.org.au/thredds/fileServer/"
+
+# EODAG product types, and the THREDDS folder holding them
+PRODUCT_TYPES = {"S1_SAR_GRD": "GRD", "S1_SAR_SLC": "SLC"}
+
+SIZE_UNITS = {"bytes": 1, "kbytes": 1e3, "mbytes": 1e6, "gbytes": 1e9, "tbytes": 1e12}
+TILE_PATTERN = re.compile(r"(\d+)([NS])(\d+)([EW])-(\d+)([NS])(\d+)([EW])")
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# How far (in degrees) a product may reach beyond the tile it is filed under: the width of an
+# IW or EW scene (250-400 km)
+TILE_MARGIN_DEGREES = 4
+
+# Bumped when the entries of the month indexes change, so older indexes are crawled again
+INDEX_VERSION = 2
+
+
+class ThreddsProduct:
+    """
+    A product found in the THREDDS index. Has the parts of an EODAG EOProduct the
+    THREDDS download path uses: `properties` (title, id, dates, ...), `provider` and
+    `remote_location`, the url the zip is downloaded from.
+    """
+
+    provider = "thredds"
+
+    def __init__(self, entry):
+        self.entry = entry
+        start, stop = entry["title"].split("_")[4:6]
+        self.properties = {
+            "id": entry["id"],
+            "title": entry["title"],
+            "startTimeFromAscendingNode": _title_date(start).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "completionTimeFromAscendingNode": _title_date(stop).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "sensorMode": entry["title"].split("_")[1],
+            "downloadLink": entry["url"],
+            "thredds_url": entry["url"],
+            "size": entry["size"],
+            "thredds_tile": entry["tile"],
+        }
+        if entry.get("footprint") is not None:
+            self.properties["footprint"] = entry["footprint"]
+        self.remote_location = entry["url"]
+        self.location = entry["url"]
+
+    def __repr__(self):
+        return f"ThreddsProduct({self.properties['title']})"
+
+
+def _title_date(text):
+    return datetime.strptime(text, "%Y%m%dT%H%M%S")
+
+
+def tile_footprint(name):
+    """
+    The [lonmin, latmin, lonmax, latmax] box of a THREDDS tile folder, e.g. 20S115E-25S120E,
+    or None if the name is not a tile
+    """
+    match = TILE_PATTERN.fullmatch(name)
+    if match is None:
+        return None
+    lat1, ns1, lon1, ew1, lat2, ns2, lon2, ew2 = match.groups()
+    lats = [float(lat1) * (-1 if ns1 == "S" else 1), float(lat2) * (-1 if ns2 == "S" else 1)]
+    lons = [float(lon1) * (-1 if ew1 == "W" else 1), float(lon2) * (-1 if ew2 == "W" else 1)]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def boxes_intersect(box_a, box_b):
+    """Whether two [lonmin, latmin, lonmax, latmax] boxes overlap"""
+    return not (
+        box_a[2] < box_b[0] or box_b[2] < box_a[0] or box_a[3] < box_b[1] or box_b[3] < box_a[1]
+    )
+
+
+def widen_box(box, margin):
+    """A [lonmin, latmin, lonmax, latmax] box grown by `margin` degrees on every side"""
+    return [box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin]
+
+
+def geospatial_coverage(element):
+    """
+    The [lonmin, latmin, lonmax, latmax] box of a catalog dataset's own geospatialCoverage
+    (directly or in its metadata), or None if it has none
+    """
+    for child in element.iter():
+        if child.tag.rsplit("}", 1)[-1] != "geospatialCoverage":
+            continue
+        ranges = {}
+        for axis in child:
+            name = axis.tag.rsplit("}", 1)[-1]
+            values = {item.tag.rsplit("}", 1)[-1]: item.text for item in axis}
+            try:
+                ranges[name] = (float(values["start"]), float(values["size"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if "eastwest" not in ranges or "northsouth" not in ranges:
+            return None
+        (lon, lon_size), (lat, lat_size) = ranges["eastwest"], ranges["northsouth"]
+        lons, lats = sorted([lon, lon + lon_size]), sorted([lat, lat + lat_size])
+        return [lons[0], lats[0], lons[1], lats[1]]
+    return None
+
+
+def read_catalog(location):
+    """
+    Reads one THREDDS catalog, from a url or a local catalog.xml
+
+    Returns
+    -------
+    (list of dict, list of (str, str))
+        The datasets in the catalog, each with its "name", "urlPath", "size" in bytes and
+        "coverage" (see geospatial_coverage), and the (title, location) of each catalog it
+        refers to, resolved against `location`
+    """
+    if location.startswith(("http://", "https://")):
+        response = http_transport.get(location)
+        response.raise_for_status()
+        root = ElementTree.fromstring(response.content)
+    else:
+        root = ElementTree.parse(location).getroot()
+
+    datasets = []
+    refs = []
+    for element in root.iter():
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "catalogRef":
+            href = element.get(XLINK_HREF) or element.get("href")
+            title = element.get("{http://www.w3.org/1999/xlink}title") or element.get("name")
+            if not href:
+                continue
+            if location.startswith(("http://", "https://")):
+                ref_location = urljoin(location, href)
+            else:
+                ref_location = os.path.normpath(os.path.join(os.path.dirname(location), href))
+            refs.append((title or href.split("/")[0], ref_location))
+        elif tag == "dataset" and element.get("urlPath"):
+            size = 0
+            for child in element:
+                if child.tag.rsplit("}", 1)[-1] == "dataSize":
+                    units = SIZE_UNITS.get((child.get("units") or "bytes").lower(), 1)
+                    size = int(float(child.text) * units)
+            datasets.append(
+                {
+                    "name": element.get("name"),
+                    "urlPath": element.get("urlPath"),
+                    "size": size,
+                    "coverage": geospatial_coverage(element),
+                }
+            )
+    return datasets, refs
+
+
+def crawl_month(month_location, bbox=None, file_server_url=THREDDS_FILE_SERVER_URL, workers=8):
+    """
+    Lists the products in one month's catalog, reading its tile catalogs in parallel
+
+    Parameters
+    ----------
+    month_location : str
+        The url or local path of the month's catalog.xml
+    bbox : list, optional
+        [lonmin, latmin, lonmax, latmax]. Only tiles within TILE_MARGIN_DEGREES of it are read.
+    file_server_url : str, optional
+        Prefix turning a dataset's urlPath into its download url
+    workers : int, optional
+        Number of tile catalogs read at once. Default is 8.
+
+    Returns
+    -------
+    list of dict
+        One entry per product, with "id", "title", "url", "size" (bytes), "tile" (the box of
+        the tile it is filed under) and "footprint" (its geospatialCoverage box, or None)
+    """
+    _, tile_refs = read_catalog(month_location)
+    tiles = []
+    for title, location in tile_refs:
+        tile = tile_footprint(title.strip("/"))
+        if tile is None:
+            continue
+        if bbox is not None and not boxes_intersect(widen_box(tile, TILE_MARGIN_DEGREES), bbox):
+            continue
+        tiles.append((tile, location))
+
+    def read_tile(tile_and_location):
+        tile, location = tile_and_location
+        datasets, _ = read_catalog(location)
+        return [
+            {
+                "id": dataset["name"][: -len(".zip")],
+                "title": dataset["name"][: -len(".zip")],
+                "url": file_server_url + dataset["urlPath"],
+                "size": dataset["size"],
+                "tile": tile,
+                "footprint": dataset["coverage"],
+            }
+            for dataset in datasets
+            if dataset["name"].endswith(".zip")
+        ]
+
+    entries = []
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        for tile_entries in executor.map(read_tile, tiles):
+            entries.extend(tile_entries)
+    return entries
+
+
+def month_catalogs(catalog_root, start, end):
+    """Yields (year, month, location) for every month catalog between two datetimes"""
+    root_location = catalog_root
+    if not root_location.startswith(("http://", "https://")):
+        root_location = os.path.join(root_location, "catalog.xml")
+    elif not root_location.endswith(".xml"):
+        root_location = root_location.rstrip("/") + "/catalog.xml"
+    _, year_refs = read_catalog(root_location)
+    for year_title, year_location in year_refs:
+        year_title = year_title.strip("/")
+        if not year_title.isdigit() or not start.year <= int(year_title) <= end.year:
+            continue
+        _, month_refs = read_catalog(year_location)
+        for month_title, month_location in month_refs:
+            try:
+                month = datetime.strptime(month_title.strip("/"), "%Y-%m")
+            except ValueError:
+                continue
+            if (start.year, start.month) <= (month.year, month.month) <= (end.year, end.month):
+                yield month.year, month.month, month_location
+
+
+def month_is_cached(path, year, month, ttl_hours):
+    """
+    A month's index is reused if it was written well after the month ended (the catalog for
+    that month should no longer change), or if it is younger than `ttl_hours`
+    """
+    path = Path(path)
+    if not path.is_file():
+        return False
+    written = path.stat().st_mtime
+    month_end = datetime(year + month // 12, month % 12 + 1, 1)
+    settled = time.mktime(month_end.timetuple()) + 30 * 86400
+    return written > settled or (time.time() - written) < ttl_hours * 3600
+
+
+def search_index(
+    search_criteria,
+    index_dir,
+    catalog_root=None,
+    file_server_url=THREDDS_FILE_SERVER_URL,
+    ttl_hours=24,
+):
+    """
+    Yields the products on THREDDS matching EODAG style search criteria,
+    crawling and caching the index of each month in the date range as needed
+
+    Parameters
+    ----------
+    search_criteria : dict
+        EODAG style criteria. "start", "end", "productType", "sensorMode" and a
+        {"lonmin", "latmin", "lonmax", "latmax"} "geom" are used.
+    index_dir : str or Path
+        Directory holding the cached month indexes
+    catalog_root : str, optional
+        The url or local directory of the catalog for the product type.
+        Defaults to NCI's catalog for the product type.
+    file_server_url : str, optional
+        Prefix turning a dataset's urlPath into its download url
+    ttl_hours : float, optional
+        How long the index of a recent month (which may still change) is reused. Default is 24.
+
+    Yields
+    ------
+    ThreddsProduct
+        In order of sensing time within each month
+    """
+    product_type = PRODUCT_TYPES.get(search_criteria.get("productType"), "GRD")
+    if catalog_root is None:
+        catalog_root = THREDDS_CATALOG_URL.format(product_type=product_type)
+    start = parse_date(search_criteria["start"])
+    end = parse_date(search_criteria["end"])
+    geom = search_criteria.get("geom")
+    bbox = None
+    if isinstance(geom, dict):
+        lons = sorted([geom["lonmin"], geom["lonmax"]])
+        lats = sorted([geom["latmin"], geom["latmax"]])
+        bbox = [lons[0], lats[0], lons[1], lats[1]]
+    sensor_mode = search_criteria.get("sensorMode")
+    ignored = set(search_criteria) - {"productType", "start", "end", "geom", "sensorMode"}
+    if ignored:
+        log.warning(f"The THREDDS index cannot filter on {sorted(ignored)}, these are ignored")
+
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for year, month, month_location in month_catalogs(catalog_root, start, end):
+        # The whole month is indexed, so other search boxes can reuse it
+        path = index_dir / f"thredds_{product_type}_{year}-{month:02d}.v{INDEX_VERSION}.jsonl"
+        if month_is_cached(path, year, month, ttl_hours):
+            with open(path, "r") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        else:
+            log.info(f"Indexing THREDDS catalog {month_location}")
+            entries = crawl_month(month_location, file_server_url=file_server_url)
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, path)
+
+        entries.sort(key=lambda entry: entry["title"].split("_")[4])
+        for entry in entries:
+            product_start = _title_date(entry["title"].split("_")[4])
+            if not start <= product_start <= end:
+                continue
+            if sensor_mode and entry["title"].split("_")[1] != sensor_mode:
+                continue
+            if bbox is not None:
+                footprint = entry["footprint"]
+                if footprint is None:
+                    # Only the tile is known, and the product may reach beyond it
+                    footprint = widen_box(entry["tile"], TILE_MARGIN_DEGREES)
+                if not boxes_intersect(footprint, bbox):
+                    continue
+            count += 1
+            yield ThreddsProduct(entry)
+    log.info(f"THREDDS index search found {count} products")
+
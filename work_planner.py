@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Description: Works out what a run has left to do before anything is downloaded or a container
+             is started. The zips in data_raw and in the archive, the snappy outputs and COGs in
+             data_processed, and the stages recorded in the state database are each read once,
+             and every product wanted is put in exactly one group with set operations:
+                 done      its COG is recorded and on disk, there is nothing to do
+                 cog       its snappy output is recorded and on disk, only the COG is left
+                 process   its zip is in data_raw, it only needs the container
+                 restore   its zip was archived, and is moved back to data_raw to be processed
+                 download  it needs downloading and processing
+"""
+import logging
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+GROUPS = ("done", "cog", "process", "restore", "download")
+
+
+def host_path(container_path, data_directory):
+    """
+    The host path of a directory the config gives inside the container,
+    e.g. "./data/data_archived/" is <data_directory>/data_archived
+    """
+    return os.path.join(data_directory, os.path.relpath(container_path, "./data"))
+
+
+def _titles(directory, suffix):
+    """The titles of the files in a directory ending with suffix"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return set()
+    return {name[: -len(suffix)] for name in names if name.endswith(suffix)}
+
+
+class WorkPlan:
+    """
+    The products of a run, in the groups of GROUPS
+
+    Parameters
+    ----------
+    groups : dict
+        {group: sorted list of titles}
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __getitem__(self, group):
+        return self.groups[group]
+
+    @property
+    def pending(self):
+        """The titles with work left"""
+        return sorted(title for group in GROUPS[1:] for title in self.groups[group])
+
+    def log(self, verbose=False):
+        """Logs the number of products in each group, and with verbose, their titles"""
+        counts = ", ".join(f"{len(self.groups[group])} {group}" for group in GROUPS)
+        log.info(f"Work plan: {counts}")
+        if verbose:
+            for group in GROUPS:
+                for title in self.groups[group]:
+                    log.info(f"    {group:<8} {title}")
+
+
+class WorkPlanner:
+    """
+    Reads what a project already holds, to sort the products of a run into the groups of GROUPS.
+
+    Parameters
+    ----------
+    data_directory : str
+        The project's data directory, holding data_raw and data_processed
+    state : snappy_processing.state_db.StateDB
+        The project's state database
+    archive_dir : str, optional
+        Where the container archives raw zips after processing them (on the host)
+    store : snappy_processing.product_store.ProductStore, optional
+        The shared product store, for moving archived links back without copying
+    """
+
+    def __init__(self, data_directory, state, archive_dir=None, store=None):
+        self.raw_data_path = os.path.join(data_directory, "data_raw")
+        final_data_path = os.path.join(data_directory, "data_processed")
+        self.archive_dir = archive_dir
+        self.store = store
+        self.raw = _titles(self.raw_data_path, ".zip")
+        self.archived = _titles(archive_dir, ".zip") if archive_dir else set()
+        # Outputs count only when both recorded and on disk: a recorded output may have been
+        # deleted since, and a file on disk may be what is left of a crashed run
+        self.cogs = _titles(final_data_path, "_processed_cog.tif") & state.titles("cog")
+        self.processed = _titles(final_data_path, "_processed.tif") & state.titles("processed")
+        self.skipped = 0
+
+    def group(self, title):
+        """The group of a single product"""
+        if title in self.cogs:
+            return "done"
+        if title in self.processed:
+            return "cog"
+        if title in self.raw:
+            return "process"
+        if title in self.archived:
+            return "restore"
+        return "download"
+
+    def plan(self, titles):
+        """The WorkPlan of the products with these titles"""
+        wanted = set(titles)
+        done = wanted & self.cogs
+        cog = (wanted - done) & self.processed
+        left = wanted - done - cog
+        groups = {
+            "done": done,
+            "cog": cog,
+            "process": left & self.raw,
+            "restore": (left - self.raw) & self.archived,
+            "download": left - self.raw - self.archived,
+        }
+        return WorkPlan({group: sorted(titles) for group, titles in groups.items()})
+
+    def restore(self, title):
+        """Moves an archived zip back into data_raw"""
+        src = os.path.join(self.archive_dir, f"{title}.zip")
+        dest = os.path.join(self.raw_data_path, f"{title}.zip")
+        if self.store is not None:
+            # Moves the link to the shared store, rather than the product itself
+            self.store.relink(src, dest)
+        else:
+            shutil.move(src, dest)
+        self.archived.discard(title)
+        self.raw.add(title)
+        log.info(f"Moved {title} back from the archive to be processed again")
+
+    def pending(self, products):
+        """
+        Yields (product, group) for the products of a search with work left, in search order.
+        Archived zips are moved back as they come, so they are not downloaded again.
+        """
+        for product in products:
+            title = product.properties["title"]
+            group = self.group(title)
+            if group == "done":
+                self.skipped += 1
+                log.info(f"Skipping {title}, its COG already exists")
+                continue
+            if group == "restore":
+                try:
+                    self.restore(title)
+                    group = "process"
+                except OSError as exc:
+                    log.warning(f"Unable to move {title} back from the archive ({exc})")
+                    group = "download"
+            yield product, group
+        log.info(f"Work planner skipped {self.skipped} products that are already processed")